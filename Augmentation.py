@@ -0,0 +1,85 @@
+from typing import Dict, Tuple
+
+import torch
+import itertools
+
+
+class VolumeAugmentation(object):
+    """
+    Class augments training batches on the device. Every scan of a batch is randomly flipped along each axis,
+    translated by a small number of voxels (rolled, so the volume wraps around) and its intensities are scaled and
+    shifted. One random axis permutation is applied to the whole batch, since permuted volumes of different shape could
+    not be stacked. Flips and translations of all scans are performed by a single gather, the sampled coordinates are
+    mapped accordingly and the occupancy labels of the coordinates stay valid.
+    """
+
+    def __init__(self, side_len: int = 8, flip_probability: float = 0.5, permutation_probability: float = 0.5,
+                 max_translation: int = 2, intensity_scale: float = 0.1, intensity_shift: float = 0.0) -> None:
+        """
+        Constructor method
+        :param side_len: (int) Size of a voxel of the volumes in full resolution coordinates (side length times the
+        pooling factor of the dataset)
+        :param flip_probability: (float) Probability of flipping a scan along each axis
+        :param permutation_probability: (float) Probability of permuting the axes of a batch
+        :param max_translation: (int) Maximal translation along each axis in voxels of the volumes
+        :param intensity_scale: (float) Intensities are multiplied by a factor in [1 - scale, 1 + scale]
+        :param intensity_shift: (float) Intensities are shifted by a value in [-shift, shift]
+        """
+        self.side_len = side_len
+        self.flip_probability = flip_probability
+        self.permutation_probability = permutation_probability
+        self.max_translation = max_translation
+        self.intensity_scale = intensity_scale
+        self.intensity_shift = intensity_shift
+        # All permutations except the identity
+        self.permutations = list(itertools.permutations(range(3)))[1:]
+
+    @torch.no_grad()
+    def __call__(self, volumes: torch.Tensor, coordinates: torch.Tensor,
+                 labels: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Method augments a batch
+        :param volumes: (torch.Tensor) Volumes of shape (batch size, 1, x, y, z)
+        :param coordinates: (torch.Tensor) Full resolution coordinates of shape (batch size * samples, 3), see
+        Misc.many_to_one_collate_fn_sample
+        :param labels: (torch.Tensor) Occupancy labels of the coordinates (batch size * samples, 1)
+        :return: (Tuple[torch.Tensor, torch.Tensor, torch.Tensor]) Augmented volumes, coordinates and labels
+        """
+        batch_size, device = volumes.shape[0], volumes.device
+        coordinates = coordinates.view(batch_size, -1, 3).clone()
+        # Source index of every output voxel along each axis (batch size, size of the axis)
+        indexes = []
+        for axis, size in enumerate(volumes.shape[2:]):
+            flip = torch.rand(batch_size, device=device) < self.flip_probability
+            translation = torch.randint(-self.max_translation, self.max_translation + 1, (batch_size,), device=device)
+            index = torch.remainder(torch.arange(size, device=device)[None] - translation[:, None], size)
+            indexes.append(torch.where(flip[:, None], size - 1 - index, index))
+            # Voxel i covers [i * side_len, (i + 1) * side_len), so a flip maps c to size * side_len - 1 - c
+            size = size * self.side_len
+            axis_coordinates = coordinates[..., axis]
+            axis_coordinates = torch.where(flip[:, None], size - 1 - axis_coordinates, axis_coordinates)
+            coordinates[..., axis] = torch.remainder(axis_coordinates + (translation * self.side_len)[:, None], size)
+        # Flip and translate all volumes by one gather, channels are moved to the end for advanced indexing
+        batch_index = torch.arange(batch_size, device=device)[:, None, None, None]
+        volumes = volumes.movedim(1, -1)[batch_index, indexes[0][:, :, None, None], indexes[1][:, None, :, None],
+                                         indexes[2][:, None, None, :]].movedim(-1, 1)
+        # Permute axes of the whole batch
+        if torch.rand(1).item() < self.permutation_probability:
+            permutation = list(self.permutations[torch.randint(len(self.permutations), (1,)).item()])
+            volumes = volumes.permute(0, 1, *[axis + 2 for axis in permutation])
+            coordinates = coordinates[..., permutation]
+        # Intensity jitter of every scan
+        shape = (batch_size,) + (1,) * (volumes.ndim - 1)
+        scale = 1.0 + self.intensity_scale * (2.0 * torch.rand(shape, device=device) - 1.0)
+        shift = self.intensity_shift * (2.0 * torch.rand(shape, device=device) - 1.0)
+        volumes = (volumes * scale + shift).contiguous()
+        return volumes, coordinates.view(-1, 3), labels
+
+    def get_parameters(self) -> Dict[str, float]:
+        """
+        Method returns the parameters of the augmentation, e.g. to save them as hyperparameters
+        :return: (Dict[str, float]) Parameters
+        """
+        return dict(flip_probability=self.flip_probability, permutation_probability=self.permutation_probability,
+                    max_translation=self.max_translation, intensity_scale=self.intensity_scale,
+                    intensity_shift=self.intensity_shift)
@@ -0,0 +1,344 @@
+from typing import Any, Dict, List, Tuple
+
+import torch
+import torch.nn as nn
+import numpy as np
+import os
+import json
+import time
+import datetime
+import platform
+import subprocess
+
+import Models
+import Misc
+import Memory
+import Inference
+
+
+def synchronize(device: str) -> None:
+    """
+    Function waits for all kernels of the device, so measured times include the actual computation
+    :param device: (str) Device utilized
+    """
+    if 'cuda' in device:
+        torch.cuda.synchronize(device)
+
+
+def get_model_variants(small_encoder: List[bool] = [False, True]) -> Dict[str, Dict[str, bool]]:
+    """
+    Function returns the model variants compared in Results_low_low and Results_low_high and the CNN decoder variant
+    :param small_encoder: (List[bool]) Encoder sizes to include
+    :return: (Dict[str, Dict[str, bool]]) Parameters of Models.get_occupancy_network for each variant name
+    """
+    variants = dict()
+    for encoder in small_encoder:
+        for use_cat in [True, False]:
+            for use_cbn in [True, False]:
+                variants['cat_{}_cbn_{}_encoder_{}'.format(int(use_cat), int(use_cbn), int(encoder))] = dict(
+                    use_cat=use_cat, use_cbn=use_cbn, small_encoder=encoder)
+        variants['cnn_decoder_encoder_{}'.format(int(encoder))] = dict(small_encoder=encoder, use_cnn_decoder=True)
+    return variants
+
+
+def benchmark_step(occupancy_network: nn.Module, batch_size: int, number_of_points: int,
+                   volume_shape: Tuple[int, int, int, int] = (1, 80, 48, 64), side_len: int = 8,
+                   device: str = 'cpu', training: bool = True, precision: str = 'float32', repetitions: int = 5,
+                   warm_up: int = 2) -> Dict[str, float]:
+    """
+    Function measures the time and peak memory of training or inference steps on synthetic tensors
+    :param occupancy_network: (nn.Module) Occupancy network
+    :param batch_size: (int) Number of volumes per step
+    :param number_of_points: (int) Number of points per volume
+    :param volume_shape: (Tuple[int, int, int, int]) Shape of one input volume (channels, x, y, z)
+    :param side_len: (int) Downscale factor of the volume, coordinates are sampled in full resolution
+    :param device: (str) Device to use
+    :param training: (bool) True if training steps (forward, backward, optimizer step) should be measured
+    :param precision: (str) Precision of forward passes ('float32' or 'bfloat16' autocast)
+    :param repetitions: (int) Number of measured steps
+    :param warm_up: (int) Number of steps performed before measuring
+    :return: (Dict[str, float]) Mean and min ms per step, points per second and peak memory in MB
+    """
+    occupancy_network = occupancy_network.to(device)
+    occupancy_network.train(training)
+    optimizer = torch.optim.Adam(occupancy_network.parameters(), lr=1e-04) if training else None
+    loss_function = nn.BCELoss()
+    # Init synthetic tensors
+    volumes = torch.rand(batch_size, *volume_shape, device=device)
+    coordinates = torch.stack([torch.randint(high=dimension * side_len, size=(batch_size * number_of_points,),
+                                             device=device) for dimension in volume_shape[1:]], dim=1).float()
+    labels = (torch.rand(batch_size * number_of_points, 1, device=device) > 0.5).float()
+    Memory.reset_peak_memory(device)
+    durations = []
+    for index in range(warm_up + repetitions):
+        synchronize(device)
+        start = time.perf_counter()
+        if training:
+            occupancy_network.zero_grad()
+            with Misc.get_autocast(device, precision):
+                prediction = occupancy_network(volumes, coordinates)
+            loss = loss_function(prediction.float().clamp(0.0, 1.0), labels)
+            loss.backward()
+            optimizer.step()
+        else:
+            with torch.no_grad(), Misc.get_autocast(device, precision):
+                occupancy_network(volumes, coordinates)
+        synchronize(device)
+        if index >= warm_up:
+            durations.append(time.perf_counter() - start)
+    return dict(ms_per_step=float(np.mean(durations) * 1e3), min_ms_per_step=float(np.min(durations) * 1e3),
+                points_per_second=float(batch_size * number_of_points / np.mean(durations)),
+                peak_memory_mb=Memory.get_peak_memory_mb(device))
+
+
+def get_meta_data(device: str) -> Dict[str, Any]:
+    """
+    Function returns information about the environment, used to compare results of different versions
+    :param device: (str) Device utilized
+    :return: (Dict[str, Any]) Meta data
+    """
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                           stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return dict(date=str(datetime.datetime.now()), git_revision=revision, torch_version=torch.__version__,
+                python_version=platform.python_version(), machine=platform.machine(), device=device,
+                device_name=torch.cuda.get_device_name(device) if 'cuda' in device else platform.processor(),
+                number_of_threads=torch.get_num_threads())
+
+
+def run_benchmark(variants: Dict[str, Dict[str, bool]], batch_sizes: List[int], numbers_of_points: List[int],
+                  device: str = 'cpu', precision: str = 'float32', modes: List[str] = ['training', 'inference'],
+                  volume_shape: Tuple[int, int, int, int] = (1, 80, 48, 64), repetitions: int = 5,
+                  warm_up: int = 2, path: str = None) -> Dict[str, Any]:
+    """
+    Function sweeps all combinations of model variants, batch sizes, points per volume and modes. Configurations which
+    fail (e.g. out of memory) are reported with the error message.
+    :param variants: (Dict[str, Dict[str, bool]]) Parameters of Models.get_occupancy_network for each variant name
+    :param batch_sizes: (List[int]) Batch sizes
+    :param numbers_of_points: (List[int]) Numbers of points per volume
+    :param device: (str) Device to use
+    :param precision: (str) Precision of forward passes ('float32' or 'bfloat16' autocast)
+    :param modes: (List[str]) Modes to measure ('training' and/or 'inference')
+    :param volume_shape: (Tuple[int, int, int, int]) Shape of one input volume (channels, x, y, z)
+    :param repetitions: (int) Number of measured steps per configuration
+    :param warm_up: (int) Number of steps performed before measuring
+    :param path: (str) Path of the json file to save the results (default=None)
+    :return: (Dict[str, Any]) Meta data and list of results
+    """
+    results = []
+    for name, parameters in variants.items():
+        occupancy_network = Models.get_occupancy_network(**parameters)
+        number_of_parameters = Misc.get_number_of_network_parameters(occupancy_network)
+        for mode in modes:
+            for batch_size in batch_sizes:
+                for number_of_points in numbers_of_points:
+                    result = dict(variant=name, mode=mode, batch_size=batch_size, number_of_points=number_of_points,
+                                  precision=precision, parameters=number_of_parameters)
+                    try:
+                        result.update(benchmark_step(occupancy_network, batch_size, number_of_points,
+                                                     volume_shape=volume_shape, device=device,
+                                                     training=mode == 'training', precision=precision,
+                                                     repetitions=repetitions, warm_up=warm_up))
+                    except RuntimeError as error:
+                        result['error'] = str(error).split('\n')[0]
+                    results.append(result)
+                    print('{variant} {mode} batch size={batch_size} points={number_of_points}: '.format(**result)
+                          + ('{ms_per_step:.1f}ms/step, {points_per_second:.0f} points/sec, peak memory='
+                             '{peak_memory_mb}MB'.format(**result) if 'error' not in result else result['error']))
+    benchmark = dict(meta_data=get_meta_data(device), results=results)
+    # Save results
+    if path is not None:
+        with open(path, 'w') as json_file:
+            json.dump(benchmark, json_file, indent=1)
+    return benchmark
+
+
+def compare_benchmarks(path_reference: str, path: str, tolerance: float = 0.1) -> List[Dict[str, Any]]:
+    """
+    Function compares two benchmark results and reports configurations which got slower by more than the tolerance
+    :param path_reference: (str) Path of the reference json file
+    :param path: (str) Path of the json file to compare
+    :param tolerance: (float) Relative slow down tolerated
+    :return: (List[Dict[str, Any]]) Regressed configurations with the relative change of ms per step
+    """
+    with open(path_reference, 'r') as json_file:
+        reference = json.load(json_file)
+    with open(path, 'r') as json_file:
+        current = json.load(json_file)
+    # Match configurations by variant, mode, batch size, number of points and precision
+    keys = ['variant', 'mode', 'batch_size', 'number_of_points', 'precision']
+    reference_results = {tuple(result[key] for key in keys): result for result in reference['results']
+                         if 'error' not in result}
+    regressions = []
+    for result in current['results']:
+        key = tuple(result[key] for key in keys)
+        if 'error' in result or key not in reference_results:
+            continue
+        change = result['ms_per_step'] / reference_results[key]['ms_per_step'] - 1.0
+        if change > tolerance:
+            regressions.append(dict(zip(keys, key), change=change))
+            print('Regression {}: {:+.1f}% ms/step'.format(' '.join(str(value) for value in key), change * 100))
+    return regressions
+
+
+def benchmark_detection(occupancy_network: nn.Module, volumes: List[torch.Tensor], side_len: int = 8,
+                        stride: int = None, coarse_strides: List[int] = [16, 32, 64], threshold: float = 0.5,
+                        logits: bool = False, device: str = 'cpu', precision: str = 'float32',
+                        path: str = None) -> Dict[str, Any]:
+    """
+    Function compares the bounding box detection (Inference.detect_bounding_box) with the dense prediction of the
+    grid of the same stride on real scans. Boxes are compared as voxel boxes, so the max coordinates are extended by
+    the stride.
+    :param occupancy_network: (nn.Module) Occupancy network in eval mode
+    :param volumes: (List[torch.Tensor]) Preprocessed volumes of shape (1, x, y, z)
+    :param side_len: (int) Downscale factor of the volumes
+    :param stride: (int) Distance of dense grid points and resolution of the detection (default=None uses side_len)
+    :param coarse_strides: (List[int]) Coarse strides of the detection to measure
+    :param threshold: (float) Threshold in the output space of the model (probability or logit)
+    :param logits: (bool) True if the model outputs logits
+    :param device: (str) Device to use
+    :param precision: (str) Precision of forward passes ('float32' or 'bfloat16' autocast)
+    :param path: (str) Path of the json file to save the results (default=None)
+    :return: (Dict[str, Any]) Meta data and mean ms per scan, decoder queries and box iou with the dense box
+    """
+    stride = side_len if stride is None else stride
+    occupancy_network = occupancy_network.to(device).eval()
+
+    def to_voxel_box(box: np.ndarray) -> np.ndarray:
+        return None if box is None else box + np.array([[0.0], [float(stride)]])
+
+    # Dense path
+    dense_boxes = []
+    dense_times = []
+    number_of_queries = []
+    for volume in volumes:
+        synchronize(device)
+        start = time.perf_counter()
+        with torch.no_grad(), Misc.get_autocast(device, precision):
+            coordinates = Inference.get_grid_coordinates(volume.shape, side_len=side_len, stride=stride).to(device)
+            prediction = occupancy_network(volume.view(1, 1, *volume.shape[-3:]).to(device), coordinates).float()
+            dense_boxes.append(to_voxel_box(Inference.get_result(prediction, coordinates,
+                                                                 threshold=threshold)['bounding_box']))
+        synchronize(device)
+        dense_times.append((time.perf_counter() - start) * 1e3)
+        number_of_queries.append(coordinates.shape[0])
+    results = [dict(method='dense', stride=stride, ms_per_scan=float(np.mean(dense_times)),
+                    number_of_queries=float(np.mean(number_of_queries)), bounding_box_iou=1.0)]
+    # Detection
+    for coarse_stride in coarse_strides:
+        times = []
+        number_of_queries = []
+        ious = []
+        for volume, dense_box in zip(volumes, dense_boxes):
+            synchronize(device)
+            start = time.perf_counter()
+            detection = Inference.detect_bounding_box(occupancy_network, volume, threshold=threshold,
+                                                      side_len=side_len, stride=stride, coarse_stride=coarse_stride,
+                                                      logits=logits, device=device, precision=precision)
+            synchronize(device)
+            times.append((time.perf_counter() - start) * 1e3)
+            number_of_queries.append(detection['number_of_queries'])
+            ious.append(Misc.intersection_over_union_boxes(to_voxel_box(detection['bounding_box']), dense_box))
+        results.append(dict(method='detection', stride=stride, coarse_stride=coarse_stride,
+                            ms_per_scan=float(np.mean(times)), number_of_queries=float(np.mean(number_of_queries)),
+                            bounding_box_iou=float(np.mean(ious)), exact=float(np.mean(np.array(ious) == 1.0))))
+    for result in results:
+        print('{}{}: {:.1f}ms/scan ({:.1f}x), {:.0f} queries/scan ({:.0f}x fewer), box iou with dense={:.3f}'.format(
+            result['method'], ' coarse stride={}'.format(result['coarse_stride']) if 'coarse_stride' in result
+            else '', result['ms_per_scan'], results[0]['ms_per_scan'] / result['ms_per_scan'],
+            result['number_of_queries'], results[0]['number_of_queries'] / result['number_of_queries'],
+            result['bounding_box_iou']))
+    benchmark = dict(meta_data=get_meta_data(device), results=results)
+    # Save results
+    if path is not None:
+        with open(path, 'w') as json_file:
+            json.dump(benchmark, json_file, indent=1)
+    return benchmark
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    # Process command line arguments
+    parser = ArgumentParser()
+
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='Device to use (default=cpu)')
+
+    parser.add_argument('--precision', type=str, default='float32', choices=['float32', 'bfloat16'],
+                        help='Precision of forward passes, bfloat16 utilizes autocast (default=float32)')
+
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8],
+                        help='Batch sizes to benchmark (default=1 8)')
+
+    parser.add_argument('--points_exponents', type=int, nargs='+', default=[10, 12, 14, 16, 18],
+                        help='Exponents of the numbers of points per volume (2^x) (default=10 12 14 16 18)')
+
+    parser.add_argument('--modes', type=str, nargs='+', default=['training', 'inference'],
+                        choices=['training', 'inference'],
+                        help='Modes to benchmark (default=training inference)')
+
+    parser.add_argument('--variants', type=str, nargs='+', default=None,
+                        help='Model variants to benchmark, e.g. cat_1_cbn_1_encoder_0 (default=None uses all)')
+
+    parser.add_argument('--repetitions', type=int, default=5,
+                        help='Number of measured steps per configuration (default=5)')
+
+    parser.add_argument('--output', type=str, default='benchmark.json',
+                        help='Path of the json file to save the results (default=benchmark.json)')
+
+    parser.add_argument('--compare_to', type=str, default=None,
+                        help='Path of a reference json file to report regressions (default=None)')
+
+    parser.add_argument('--detection_scans', type=str, default=None,
+                        help='Directory or manifest of scans to compare the bounding box detection with the dense '
+                             'prediction on instead of the sweep, requires --model (default=None)')
+
+    parser.add_argument('--model', type=str, default=None,
+                        help='Path to model or checkpoint used for the detection benchmark (default=None)')
+
+    parser.add_argument('--coarse_strides', type=int, nargs='+', default=[16, 32, 64],
+                        help='Coarse strides of the detection benchmark (default=16 32 64)')
+
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='Probability threshold of the detection benchmark (default=0.5)')
+
+    parser.add_argument('--use_cat', type=int, default=1,
+                        help='True if concatenation is utilized in O-Net, used for checkpoints (default=1 (True))')
+
+    parser.add_argument('--use_cbn', type=int, default=1,
+                        help='True if conditional batch normalization is utilized, used for checkpoints '
+                             '(default=1 (True))')
+
+    parser.add_argument('--small_encoder', type=int, default=0, choices=[0, 1],
+                        help='If true the smaller encoder is utilized, used for checkpoints (default=0 (False))')
+
+    parser.add_argument('--logits', type=int, default=0, choices=[0, 1],
+                        help='If true the model outputs logits (default=0 (False))')
+
+    args = parser.parse_args()
+
+    if args.detection_scans is not None:
+        assert args.model is not None, 'The detection benchmark requires a trained model!'
+        occupancy_network = Inference.load_occupancy_network(args.model, device=args.device,
+                                                             use_cat=bool(args.use_cat), use_cbn=bool(args.use_cbn),
+                                                             small_encoder=bool(args.small_encoder),
+                                                             logits=bool(args.logits))
+        # Threshold is given as probability and applied in the output space of the model
+        benchmark_detection(occupancy_network,
+                            [Inference.load_volume(path) for path in Inference.get_scan_paths(args.detection_scans)],
+                            coarse_strides=args.coarse_strides,
+                            threshold=Misc.probability_to_logit(args.threshold) if bool(args.logits)
+                            else args.threshold, logits=bool(args.logits), device=args.device,
+                            precision=args.precision, path=args.output)
+    else:
+        variants = get_model_variants()
+        if args.variants is not None:
+            variants = {name: variants[name] for name in args.variants}
+        run_benchmark(variants, batch_sizes=args.batch_sizes,
+                      numbers_of_points=[2 ** exponent for exponent in args.points_exponents], device=args.device,
+                      precision=args.precision, modes=args.modes, repetitions=args.repetitions, path=args.output)
+        if args.compare_to is not None:
+            compare_benchmarks(args.compare_to, args.output)
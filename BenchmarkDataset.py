@@ -0,0 +1,198 @@
+from typing import Any, Callable, Dict, List, Tuple
+
+import torch
+from torch.utils.data.dataloader import DataLoader
+import numpy as np
+import os
+import json
+import time
+
+import Datasets
+import Misc
+import Benchmark
+
+
+def make_synthetic_scans(path: str, number_of_scans: int = 16,
+                         volume_shape: Tuple[int, int, int, int] = (1, 80, 48, 64), side_len: int = 8,
+                         weapon_shape: Tuple[int, int, int] = (128, 64, 32), seed: int = 0) -> None:
+    """
+    Function saves synthetic scans in the format of the weapon dataset. Each scan includes a downscaled volume
+    (<index>.npy) and the full resolution coordinates of one box shaped weapon (<index>_label.npy).
+    :param path: (str) Folder to save scans
+    :param number_of_scans: (int) Number of scans
+    :param volume_shape: (Tuple[int, int, int, int]) Shape of the downscaled volume (channels, x, y, z)
+    :param side_len: (int) Downscale factor of the volume
+    :param weapon_shape: (Tuple[int, int, int]) Full resolution edge lengths of the weapon
+    :param seed: (int) Seed of the scans
+    """
+    random_state = np.random.RandomState(seed)
+    # Make folder
+    if not os.path.exists(path):
+        os.makedirs(path)
+    full_resolution_shape = np.array(volume_shape[1:]) * side_len
+    for index in range(number_of_scans):
+        np.save(os.path.join(path, '{}.npy'.format(index)), random_state.rand(*volume_shape).astype(np.float32))
+        # Place weapon randomly inside the volume
+        offset = random_state.randint(0, full_resolution_shape - np.array(weapon_shape) + 1)
+        label = np.stack(np.meshgrid(*[np.arange(offset[axis], offset[axis] + weapon_shape[axis]) for axis in
+                                       range(3)], indexing='ij'), axis=-1).reshape(-1, 3)
+        np.save(os.path.join(path, '{}_label.npy'.format(index)), label)
+
+
+def get_dataset(path: str, number_of_scans: int, sampling: str, npoints: int, share_box: float, test: bool,
+                side_len: int = 8) -> Datasets.WeaponDataset:
+    """
+    Function returns a weapon dataset of synthetic scans
+    :param path: (str) Folder of the synthetic scans
+    :param number_of_scans: (int) Number of scans
+    :param sampling: (str) Sampling mode ('default', 'one_fast' or 'one')
+    :param npoints: (int) Number of points per scan
+    :param share_box: (float) Share of points sampled inside the weapon
+    :param test: (bool) True if the full resolution label is returned as well
+    :param side_len: (int) Downscale factor of the volumes
+    :return: (Datasets.WeaponDataset) Dataset
+    """
+    return Datasets.WeaponDataset(target_path_volume=path, target_path_label=path, length=number_of_scans,
+                                  npoints=npoints, side_len=side_len, sampling=sampling, test=test,
+                                  share_box=share_box, permutation_path=path)
+
+
+def benchmark_sampling(dataset: Datasets.WeaponDataset, number_of_samples: int = 16) -> Dict[str, float]:
+    """
+    Function measures the latency of loading and sampling single scans in the current process
+    :param dataset: (Datasets.WeaponDataset) Dataset
+    :param number_of_samples: (int) Number of samples to measure
+    :return: (Dict[str, float]) Mean, median and 95th percentile latency in ms and samples per second
+    """
+    durations = []
+    for index in range(number_of_samples):
+        start = time.perf_counter()
+        dataset[index % len(dataset)]
+        durations.append(time.perf_counter() - start)
+    durations = np.array(durations) * 1e3
+    return dict(mean_ms=float(durations.mean()), median_ms=float(np.median(durations)),
+                p95_ms=float(np.percentile(durations, 95)), samples_per_second=float(1e3 / durations.mean()))
+
+
+def benchmark_loader(dataset: Datasets.WeaponDataset, batch_size: int, num_workers: int, pin_memory: bool,
+                     collate_fn: Callable, number_of_batches: int = 16) -> Dict[str, float]:
+    """
+    Function measures the throughput of a dataloader including worker start up
+    :param dataset: (Datasets.WeaponDataset) Dataset
+    :param batch_size: (int) Batch size
+    :param num_workers: (int) Number of worker processes
+    :param pin_memory: (bool) True if batches are copied into pinned memory
+    :param collate_fn: (Callable) Collate function
+    :param number_of_batches: (int) Number of batches to load
+    :return: (Dict[str, float]) Samples per second, latency of the first batch and mean latency of following batches
+    """
+    data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                             pin_memory=pin_memory and torch.cuda.is_available(), collate_fn=collate_fn)
+    number_of_samples = 0
+    start = time.perf_counter()
+    first_batch_ms = None
+    while number_of_samples < number_of_batches * batch_size:
+        for batch in data_loader:
+            number_of_samples += batch[0].shape[0]
+            if first_batch_ms is None:
+                first_batch_ms = (time.perf_counter() - start) * 1e3
+                start_steady = time.perf_counter()
+            if number_of_samples >= number_of_batches * batch_size:
+                break
+    duration = time.perf_counter() - start
+    steady_batches = max(number_of_samples // batch_size - 1, 1)
+    return dict(samples_per_second=float(number_of_samples / duration), first_batch_ms=float(first_batch_ms),
+                batch_ms=float((time.perf_counter() - start_steady) * 1e3 / steady_batches))
+
+
+def run_benchmark(path: str, samplings: List[str] = ['default', 'one_fast', 'one'],
+                  numbers_of_points: List[int] = [2 ** 14, 2 ** 16, 2 ** 18], shares_box: List[float] = [0.0, 0.6],
+                  numbers_of_workers: List[int] = [0, 2, 4, 8], pin_memory: List[bool] = [False, True],
+                  batch_size: int = 8, loader_npoints: int = 2 ** 14, number_of_scans: int = 16,
+                  number_of_batches: int = 16, output: str = None) -> Dict[str, Any]:
+    """
+    Function benchmarks the sampling latency for all sampling modes, numbers of points and shares of box points and
+    the dataloader throughput for all sampling modes, numbers of workers, pinned memory and both collate functions
+    :param path: (str) Folder of the synthetic scans
+    :param samplings: (List[str]) Sampling modes
+    :param numbers_of_points: (List[int]) Numbers of points per scan of the sampling benchmark
+    :param shares_box: (List[float]) Shares of points sampled inside the weapon
+    :param numbers_of_workers: (List[int]) Numbers of dataloader workers
+    :param pin_memory: (List[bool]) Pinned memory settings
+    :param batch_size: (int) Batch size of the dataloader benchmark
+    :param loader_npoints: (int) Number of points per scan of the dataloader benchmark
+    :param number_of_scans: (int) Number of synthetic scans
+    :param number_of_batches: (int) Number of batches loaded per dataloader configuration
+    :param output: (str) Path of the json file to save the results (default=None)
+    :return: (Dict[str, Any]) Meta data and results of both benchmarks
+    """
+    sampling_results = []
+    for sampling in samplings:
+        for npoints in numbers_of_points:
+            for share_box in shares_box:
+                result = dict(sampling=sampling, npoints=npoints, share_box=share_box)
+                try:
+                    result.update(benchmark_sampling(
+                        get_dataset(path, number_of_scans, sampling, npoints, share_box, test=False),
+                        number_of_samples=number_of_scans))
+                except ValueError as error:
+                    # Weapon includes less points than requested inside the box
+                    result['error'] = str(error)
+                sampling_results.append(result)
+                print('Sampling {sampling} npoints={npoints} share_box={share_box}: '.format(**result)
+                      + ('{mean_ms:.1f}ms mean, {p95_ms:.1f}ms p95, {samples_per_second:.1f} samples/sec'.format(
+                          **result) if 'error' not in result else result['error']))
+    loader_results = []
+    for sampling in samplings:
+        for collate_fn, test in [(Misc.many_to_one_collate_fn_sample, False),
+                                 (Misc.many_to_one_collate_fn_sample_down, True)]:
+            for num_workers in numbers_of_workers:
+                for pin in pin_memory:
+                    result = dict(sampling=sampling, collate_fn=collate_fn.__name__, num_workers=num_workers,
+                                  pin_memory=pin, batch_size=batch_size, npoints=loader_npoints)
+                    result.update(benchmark_loader(
+                        get_dataset(path, number_of_scans, sampling, loader_npoints, 0.6 if not test else 0.0, test),
+                        batch_size=batch_size, num_workers=num_workers, pin_memory=pin, collate_fn=collate_fn,
+                        number_of_batches=number_of_batches))
+                    loader_results.append(result)
+                    print('Loader {sampling} {collate_fn} workers={num_workers} pin_memory={pin_memory}: '
+                          '{samples_per_second:.1f} samples/sec, first batch {first_batch_ms:.0f}ms, '
+                          '{batch_ms:.1f}ms/batch'.format(**result))
+    benchmark = dict(meta_data=Benchmark.get_meta_data('cpu'), sampling=sampling_results, loader=loader_results)
+    # Save results
+    if output is not None:
+        with open(output, 'w') as json_file:
+            json.dump(benchmark, json_file, indent=1)
+    return benchmark
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    # Process command line arguments
+    parser = ArgumentParser()
+
+    parser.add_argument('--path', type=str, default='synthetic_scans/',
+                        help='Folder to save the synthetic scans to (default=synthetic_scans/)')
+
+    parser.add_argument('--number_of_scans', type=int, default=16,
+                        help='Number of synthetic scans (default=16)')
+
+    parser.add_argument('--points_exponents', type=int, nargs='+', default=[14, 16, 18],
+                        help='Exponents of the numbers of points per scan (2^x) to benchmark (default=14 16 18)')
+
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4, 8],
+                        help='Numbers of dataloader workers to benchmark (default=0 2 4 8)')
+
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='Batch size of the dataloader benchmark (default=8)')
+
+    parser.add_argument('--output', type=str, default='benchmark_dataset.json',
+                        help='Path of the json file to save the results (default=benchmark_dataset.json)')
+
+    args = parser.parse_args()
+
+    make_synthetic_scans(args.path, number_of_scans=args.number_of_scans)
+    run_benchmark(args.path, numbers_of_points=[2 ** exponent for exponent in args.points_exponents],
+                  numbers_of_workers=args.workers, batch_size=args.batch_size, number_of_scans=args.number_of_scans,
+                  output=args.output)
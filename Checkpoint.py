@@ -0,0 +1,108 @@
+from typing import Any, Dict
+
+import torch
+import numpy as np
+import os
+import random
+import threading
+import queue
+
+import Profiler
+
+
+def copy_to_cpu(state: Any) -> Any:
+    """
+    Function copies all tensors of a (nested) state to the cpu, the result is a snapshot independent of training
+    :param state: (Any) State dict, list, tuple, tensor or primitive
+    :return: (Any) Snapshot of the state
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        return {key: copy_to_cpu(value) for key, value in state.items()}
+    elif isinstance(state, (list, tuple)):
+        return type(state)(copy_to_cpu(value) for value in state)
+    return state
+
+
+def get_rng_state() -> Dict[str, Any]:
+    """
+    Function returns the state of all random number generators utilized
+    :return: (Dict[str, Any]) Random number generator states
+    """
+    rng_state = dict()
+    rng_state['torch'] = torch.get_rng_state()
+    rng_state['numpy'] = np.random.get_state()
+    rng_state['python'] = random.getstate()
+    if torch.cuda.is_available():
+        rng_state['cuda'] = torch.cuda.get_rng_state_all()
+    return rng_state
+
+
+def set_rng_state(rng_state: Dict[str, Any]) -> None:
+    """
+    Function restores the state of all random number generators utilized
+    :param rng_state: (Dict[str, Any]) Random number generator states
+    """
+    torch.set_rng_state(rng_state['torch'])
+    np.random.set_state(rng_state['numpy'])
+    random.setstate(rng_state['python'])
+    if 'cuda' in rng_state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+
+
+def load_checkpoint(path: str, map_location: str = 'cpu') -> Any:
+    """
+    Function loads a checkpoint or a pickled model
+    :param path: (str) Path of the checkpoint
+    :param map_location: (str) Device to map tensors to
+    :return: (Any) Checkpoint dict or model
+    """
+    # Checkpoints include numpy and python rng states, thus not only weights are loaded
+    return torch.load(path, map_location=map_location, weights_only=False)
+
+
+class CheckpointWriter(object):
+    """
+    Class writes checkpoints in a background thread, so training does not stall while serializing
+    """
+
+    def __init__(self, profiler: Profiler.StepProfiler = None) -> None:
+        """
+        Constructor method
+        :param profiler: (Profiler.StepProfiler) Profiler to record the time of writing checkpoints (default=None)
+        """
+        self.profiler = profiler if profiler is not None else Profiler.StepProfiler()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        """
+        Method writes queued checkpoints
+        """
+        while True:
+            state, path = self.queue.get()
+            try:
+                # Write to temporary file first, so an interrupted write never corrupts an existing checkpoint
+                with self.profiler.phase('checkpoint_write'):
+                    torch.save(state, path + '.tmp')
+                    os.replace(path + '.tmp', path)
+            except Exception as exception:
+                print('Checkpoint {} could not be saved: {}'.format(path, exception))
+            finally:
+                self.queue.task_done()
+
+    def save(self, state: Dict[str, Any], path: str) -> None:
+        """
+        Method queues a snapshot of the given state to be saved
+        :param state: (Dict[str, Any]) State to be saved, tensors are copied to the cpu before returning
+        :param path: (str) Path to save the checkpoint
+        """
+        self.queue.put((copy_to_cpu(state), path))
+
+    def wait(self) -> None:
+        """
+        Method blocks until all queued checkpoints are written
+        """
+        self.queue.join()
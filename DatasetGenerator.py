@@ -7,6 +7,8 @@ import numpy as np
 import itk
 import time
 
+import Inference
+
 class Timer():
     def __init__(self):
         self.start = time.process_time()
@@ -73,20 +75,17 @@ class WeaponDatasetGenerator():
             image = itk.imread(data_file)
 
             volume_n = itk.GetArrayFromImage(image)
-            volume_n = (volume_n - self.threshold_min).astype(np.float) / float(self.threshold_max - self.threshold_min)
-            volume_n = np.expand_dims(volume_n, axis = 0) 
 
             print("Read image", t2.stop())
 
             t3 = Timer()
-            volume_pooled_tg = nn.functional.avg_pool3d(torch.from_numpy(volume_n).to(self.device), self.side_len, self.side_len)
-            print("Downsampling", t3.stop())
-            t4 = Timer()
-            volume_pooled_tg = volume_pooled_tg[:,0:self.dim_max,:,:]
-            volume_pooled_tg = nn.functional.pad(volume_pooled_tg, 
-                                                            (0,0,0,0,0,self.dim_max-volume_pooled_tg.shape[1]))
-            print("Padding", t4.stop())
-            np.save(self.target_path +str(index) + ".npy", volume_pooled_tg.cpu().numpy().astype(np.float32))
+            # Normalization, downsampling and padding are shared with the inference path
+            volume_pooled_tg = Inference.preprocess_volume(volume_n, side_len=self.side_len,
+                                                           threshold_min=self.threshold_min,
+                                                           threshold_max=self.threshold_max,
+                                                           dim_max=self.dim_max * self.side_len, device=self.device)
+            print("Preprocessing", t3.stop())
+            np.save(self.target_path +str(index) + ".npy", volume_pooled_tg.numpy().astype(np.float32))
 
             # Take care of labels and store coords
             labels_n = itk.GetArrayFromImage(labels)
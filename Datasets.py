@@ -1,17 +1,24 @@
-from typing import Tuple
+from typing import Any, Dict, Iterator, List, Tuple
 
 import torch
+import torch.nn as nn
 from torch.utils import data
 import numpy as np
+import os
+import json
+import hashlib
 from pykdtree.kdtree import KDTree
 
 import Misc
+import Profiler
 
 
 class WeaponDataset(data.Dataset):
     def __init__(self, target_path_volume: str, target_path_label: str, length: int, dim_max: int = 640,
                  npoints: int = 2 ** 10, side_len: int = 32,
-                 sampling: str = 'one', offset: int = 0, test: bool = False, share_box: float = 0.6) -> None:
+                 sampling: str = 'one', offset: int = 0, test: bool = False, share_box: float = 0.6,
+                 profile_path: str = None, permutation_path: str = None, pooling_factor: int = 1,
+                 scan_cache: 'ScanCache' = None) -> None:
         """
         Constructor method
         :param target_path_volume: (str)
@@ -24,6 +31,13 @@ class WeaponDataset(data.Dataset):
         :param offset: (int)
         :param share_box: (float)
         :param test: (bool)
+        :param profile_path: (str) Folder to save timings of the loading, sampling and kd tree stages (default=None)
+        :param permutation_path: (str) Folder including the label files to be permuted (default=None uses the
+        default folder of Misc.FilePermutation)
+        :param pooling_factor: (int) Volumes are additionally downsampled by average pooling with this factor, e.g. for
+        the coarse network of a cascade, coordinates stay in full resolution (default=1)
+        :param scan_cache: (ScanCache) Memory mapped cache of the volumes and labels, e.g. shared by the runs of a
+        sweep (default=None loads the files of every scan)
         """
         self.npoints = npoints
         self.side_len = side_len
@@ -34,8 +48,12 @@ class WeaponDataset(data.Dataset):
         self.length = length
         self.offset = offset
         self.test = test
-        self.index_wrapper = Misc.FilePermutation()
+        self.index_wrapper = Misc.FilePermutation() if permutation_path is None \
+            else Misc.FilePermutation(permutation_path)
         self.share_box = share_box
+        self.profiler = Profiler.WorkerProfiler(profile_path)
+        self.pooling_factor = pooling_factor
+        self.scan_cache = scan_cache
 
     def __getitem__(self, index: int) -> Tuple[torch.tensor]:
         """
@@ -43,24 +61,95 @@ class WeaponDataset(data.Dataset):
         :param index: (int) Index
         :return: (Tuple[torch.tensor]) Batch of volume, coordinates and label
         """
+        return self.get_sample(index)
+
+    def get_sample(self, index: int, random_state: np.random.RandomState = None) -> Tuple[torch.tensor]:
+        """
+        Method loads a scan and samples its coordinates
+        :param index: (int) Index
+        :param random_state: (np.random.RandomState) Random state utilized to sample the coordinates (default=None
+        uses the global numpy random state)
+        :return: (Tuple[torch.tensor]) Batch of volume, coordinates and label
+        """
         # Calc index
         index = index + self.offset
         index = self.index_wrapper[index]
         # Load volume and label
-        volume_n = np.load(self.target_path_volume + str(index) + ".npy")
-        label_n = np.load(self.target_path_label + str(index) + "_label.npy")
+        with self.profiler.phase('dataset_load'):
+            volume_n = self.load_volume(index)
+            label_n = self.load_label(index)
+        with self.profiler.phase('dataset_sampling'):
+            coords, labels = self.sample(volume_n, label_n, random_state=random_state)
+        # Pool after sampling, so coordinates cover the full volume
+        volume = self.pool_volume(torch.from_numpy(volume_n).float())
+        if self.test:
+            return volume, torch.from_numpy(coords).float(), torch.from_numpy(
+                labels).float(), torch.from_numpy(label_n.astype(int)).float()
+        else:
+            return volume, torch.from_numpy(coords).float(), torch.from_numpy(
+                labels).float()
+
+    def get_file_index(self, index: int) -> int:
+        """
+        Method returns the index of the files of a scan
+        :param index: (int) Index in the dataset
+        :return: (int) Index used in the file names of the volume and the label
+        """
+        return self.index_wrapper[index + self.offset]
+
+    def load_volume(self, file_index: str) -> np.ndarray:
+        """
+        Method loads the volume of a scan from the scan cache if given or from its file
+        :param file_index: (str) Index used in the file names, see get_file_index
+        :return: (np.ndarray) Volume of shape (1, x, y, z)
+        """
+        if self.scan_cache is not None:
+            return self.scan_cache.get_volume(file_index)
+        return np.load(self.target_path_volume + str(file_index) + ".npy")
+
+    def load_label(self, file_index: str) -> np.ndarray:
+        """
+        Method loads the label of a scan from the scan cache if given or from its file
+        :param file_index: (str) Index used in the file names, see get_file_index
+        :return: (np.ndarray) Coordinates of the weapon (points, 3)
+        """
+        if self.scan_cache is not None:
+            return self.scan_cache.get_label(file_index)
+        return np.load(self.target_path_label + str(file_index) + "_label.npy")
+
+    def pool_volume(self, volume: torch.Tensor) -> torch.Tensor:
+        """
+        Method downsamples a volume by the pooling factor
+        :param volume: (torch.Tensor) Volume of shape (1, x, y, z)
+        :return: (torch.Tensor) Pooled volume
+        """
+        if self.pooling_factor > 1:
+            return nn.functional.avg_pool3d(volume.unsqueeze(dim=0), self.pooling_factor).squeeze(dim=0)
+        return volume
 
+    def sample(self, volume_n: np.ndarray, label_n: np.ndarray,
+               random_state: np.random.RandomState = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Method samples coordinates and their labels
+        :param volume_n: (np.ndarray) Volume of the scan
+        :param label_n: (np.ndarray) Coordinates of the weapon
+        :param random_state: (np.random.RandomState) Random state utilized to sample (default=None uses the global
+        numpy random state)
+        :return: (Tuple[np.ndarray, np.ndarray]) Coordinates and labels
+        """
+        random = np.random if random_state is None else random_state
         sampling_shapes_tc = [0, volume_n.shape[1] * self.side_len, volume_n.shape[2] * self.side_len,
                               volume_n.shape[3] * self.side_len]
 
         if self.sampling == 'default':
             # Mixed Coords
-            x_n = np.random.randint(sampling_shapes_tc[1], size=(int(self.npoints), 1))
-            y_n = np.random.randint(sampling_shapes_tc[2], size=(int(self.npoints), 1))
-            z_n = np.random.randint(sampling_shapes_tc[3], size=(int(self.npoints), 1))
+            x_n = random.randint(sampling_shapes_tc[1], size=(int(self.npoints), 1))
+            y_n = random.randint(sampling_shapes_tc[2], size=(int(self.npoints), 1))
+            z_n = random.randint(sampling_shapes_tc[3], size=(int(self.npoints), 1))
             coords_zero = np.concatenate((x_n, y_n, z_n), axis=1)
-            kd_tree = KDTree(label_n, leafsize=16)
-            dist, _ = kd_tree.query(coords_zero, k=1)
+            with self.profiler.phase('dataset_kd_tree'):
+                kd_tree = KDTree(label_n, leafsize=16)
+                dist, _ = kd_tree.query(coords_zero, k=1)
             labels_zero = np.expand_dims(dist == 0, axis=1).astype(float)
 
             coords = coords_zero
@@ -68,13 +157,13 @@ class WeaponDataset(data.Dataset):
 
         elif self.sampling == 'one_fast':
             # Coords with one as label
-            coords_one = label_n[np.random.choice(label_n.shape[0], int(self.npoints * self.share_box), replace=False),
+            coords_one = label_n[random.choice(label_n.shape[0], int(self.npoints * self.share_box), replace=False),
                          :]
 
             # Mixed Coords
-            x_n = np.random.randint(sampling_shapes_tc[1], size=(int(self.npoints * (1 - self.share_box)), 1))
-            y_n = np.random.randint(sampling_shapes_tc[2], size=(int(self.npoints * (1 - self.share_box)), 1))
-            z_n = np.random.randint(sampling_shapes_tc[3], size=(int(self.npoints * (1 - self.share_box)), 1))
+            x_n = random.randint(sampling_shapes_tc[1], size=(int(self.npoints * (1 - self.share_box)), 1))
+            y_n = random.randint(sampling_shapes_tc[2], size=(int(self.npoints * (1 - self.share_box)), 1))
+            z_n = random.randint(sampling_shapes_tc[3], size=(int(self.npoints * (1 - self.share_box)), 1))
             coords_zero = np.concatenate((x_n, y_n, z_n), axis=1)
 
             coords = np.concatenate((coords_one, coords_zero), axis=0)
@@ -82,16 +171,17 @@ class WeaponDataset(data.Dataset):
 
         elif self.sampling == 'one':
             # Coords with one as label
-            coords_one = label_n[np.random.choice(label_n.shape[0], int(self.npoints * self.share_box), replace=False),
+            coords_one = label_n[random.choice(label_n.shape[0], int(self.npoints * self.share_box), replace=False),
                          :]
 
             # Mixed Coords
-            x_n = np.random.randint(sampling_shapes_tc[1], size=(int(self.npoints * (1 - self.share_box)), 1))
-            y_n = np.random.randint(sampling_shapes_tc[2], size=(int(self.npoints * (1 - self.share_box)), 1))
-            z_n = np.random.randint(sampling_shapes_tc[3], size=(int(self.npoints * (1 - self.share_box)), 1))
+            x_n = random.randint(sampling_shapes_tc[1], size=(int(self.npoints * (1 - self.share_box)), 1))
+            y_n = random.randint(sampling_shapes_tc[2], size=(int(self.npoints * (1 - self.share_box)), 1))
+            z_n = random.randint(sampling_shapes_tc[3], size=(int(self.npoints * (1 - self.share_box)), 1))
             coords_zero = np.concatenate((x_n, y_n, z_n), axis=1)
-            kd_tree = KDTree(label_n, leafsize=16)
-            dist, _ = kd_tree.query(coords_zero, k=1)
+            with self.profiler.phase('dataset_kd_tree'):
+                kd_tree = KDTree(label_n, leafsize=16)
+                dist, _ = kd_tree.query(coords_zero, k=1)
             labels_zero = np.expand_dims(dist == 0, axis=1).astype(float)
 
             coords = np.concatenate((coords_one, coords_zero), axis=0)
@@ -99,13 +189,7 @@ class WeaponDataset(data.Dataset):
 
         else:
             raise NotImplementedError
-        # print("Access time", t.stop())
-        if self.test:
-            return torch.from_numpy(volume_n).float(), torch.from_numpy(coords).float(), torch.from_numpy(
-                labels).float(), torch.from_numpy(label_n.astype(int)).float()
-        else:
-            return torch.from_numpy(volume_n).float(), torch.from_numpy(coords).float(), torch.from_numpy(
-                labels).float()
+        return coords, labels
 
     def __len__(self) -> int:
         """
@@ -121,28 +205,311 @@ class WeaponDataset(data.Dataset):
         """
         return self.side_len
 
-    def write_obj(self, index: int) -> None:
+    def write_obj(self, index: int, path: str = '', file_format: str = 'obj') -> None:
         """
-        ???
+        Method saves the volume (voxels above 15% of the maximum, colored by intensity) and the label of a scan as point
+        clouds (outfile_org and outfile_labels) in full resolution coordinates
         :param index: (int) Index
+        :param path: (str) Folder to save the files to (default='' uses the current folder)
+        :param file_format: (str) File format ('obj', 'ply' or 'npz')
         """
-        vol = self.__getitem__(index)[0].cpu().numpy()
+        sample = self.__getitem__(index)
+        vol = sample[0].cpu().numpy()
         maximum = np.max(vol)
         vol = vol / maximum
         vol[vol - 0.15 < 0] = 0
+        # Coordinates of all voxels not set to zero
+        voxels = np.stack(np.nonzero(vol[0]), axis=1)
+        color = vol[0][tuple(voxels.T)]
+        Misc.write_point_cloud(os.path.join(path, 'outfile_org.' + file_format), voxels * self.side_len,
+                               np.stack((color, np.full_like(color, 0.5), np.full_like(color, 0.5)), axis=1))
+        label = sample[3].cpu().numpy()
+        Misc.write_point_cloud(os.path.join(path, 'outfile_labels.' + file_format), label,
+                               np.tile([0.0, 0.0, 1.0], (label.shape[0], 1)))
+
+
+class FrozenValidationSet(object):
+    """
+    Validation set materialized once with fixed coordinates and precomputed occupancy labels. All tensors stay
+    resident on the device, so validation needs no data loading and no kd tree queries. Scans with equal shape are
+    encoded and decoded in batches.
+    """
+
+    def __init__(self, validation_data: data.DataLoader, device: str = 'cuda', batch_size: int = 4,
+                 cache_latents: bool = False, seed: int = 0) -> None:
+        """
+        Constructor method
+        :param validation_data: (data.DataLoader) Dataloader including a WeaponDataset with test=True, only the
+        indexes of its sampler are used (e.g. the shard of a distributed process)
+        :param device: (str) Device to keep the validation set on
+        :param batch_size: (int) Maximal number of scans encoded and decoded at once
+        :param cache_latents: (bool) If true latents are cached until the encoder is updated
+        :param seed: (int) Seed utilized to draw the fixed coordinates
+        """
+        self.device = device
+        self.batch_size = batch_size
+        self.cache_latents = cache_latents
+        # Cached latents and version of the encoder which produced them
+        self.latents = None
+        self.latent_version = None
+        # Draw fixed coordinates with an own random state, the global numpy random state is not touched
+        random_state = np.random.RandomState(seed)
+        volumes, coordinates, labels, occupancy_labels = [], [], [], []
+        for index in sorted(iter(validation_data.sampler)):
+            volume, coordinates_, labels_, actual = validation_data.dataset.get_sample(index, random_state=random_state)
+            volumes.append(volume.to(device))
+            coordinates.append(coordinates_.to(device))
+            labels.append(labels_.to(device))
+            # Ground truth is computed once for all coordinates
+            occupancy_labels.append(Misc.get_occupancy_labels(coordinates_, actual).to(device))
+        # Group scans of equal shape and number of points into batches
+        self.batches = []
+        shapes = dict()
+        for index in range(len(volumes)):
+            shapes.setdefault((tuple(volumes[index].shape), coordinates[index].shape[0]), []).append(index)
+        for indexes in shapes.values():
+            for start in range(0, len(indexes), batch_size):
+                batch_indexes = indexes[start:start + batch_size]
+                self.batches.append((torch.stack([volumes[index] for index in batch_indexes], dim=0),
+                                     torch.cat([coordinates[index] for index in batch_indexes], dim=0),
+                                     [labels[index] for index in batch_indexes],
+                                     [occupancy_labels[index] for index in batch_indexes]))
+
+    def __len__(self) -> int:
+        """
+        Returns the number of scans
+        :return: (int) Number of scans
+        """
+        return sum(len(batch[2]) for batch in self.batches)
+
+    def get_latents(self, occupancy_network: nn.Module, version: int = None) -> List[torch.Tensor]:
+        """
+        Method returns the latents of all batches, cached latents are reused if the encoder was not updated
+        :param occupancy_network: (nn.Module) Occupancy network including an encode method
+        :param version: (int) Version of the encoder weights, used to invalidate cached latents (default=None disables
+        the cache)
+        :return: (List[torch.Tensor]) Latent tensor of each batch
+        """
+        if self.cache_latents and self.latents is not None and version is not None and version == self.latent_version:
+            return self.latents
+        latents = [occupancy_network.encode(volumes) for volumes, _, _, _ in self.batches]
+        if self.cache_latents:
+            self.latents, self.latent_version = latents, version
+        return latents
+
+    def __iter__(self) -> Iterator[Tuple[torch.Tensor, torch.Tensor, List[torch.Tensor], List[torch.Tensor]]]:
+        """
+        Iterates over all batches
+        :return: (Iterator) Batches of stacked volumes, concatenated coordinates, labels and occupancy labels per scan
+        """
+        return iter(self.batches)
+
+
+def get_encoder_fingerprint(occupancy_network: nn.Module) -> str:
+    """
+    Function returns a hash of the encoder weights, used to detect outdated latent caches
+    :param occupancy_network: (nn.Module) Occupancy network including an encoding module
+    :return: (str) Hex digest of the encoder state dict
+    """
+    fingerprint = hashlib.sha1()
+    for name, tensor in occupancy_network.encoding.state_dict().items():
+        fingerprint.update(name.encode())
+        fingerprint.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return fingerprint.hexdigest()
+
+
+@torch.no_grad()
+def build_latent_cache(occupancy_network: nn.Module, dataset: WeaponDataset, path: str, device: str = 'cuda',
+                       precision: str = 'float32') -> None:
+    """
+    Function encodes the volume of every scan once and saves the latents memory mapped (latents.npy) together with
+    the shapes of the volumes (volume_shapes.npy). An existing cache is reused if it was computed by the same encoder
+    for the same number of scans.
+    :param occupancy_network: (nn.Module) Occupancy network with a trained encoder
+    :param dataset: (WeaponDataset) Dataset of the scans
+    :param path: (str) Folder of the cache
+    :param device: (str) Device to encode on
+    :param precision: (str) Precision of the encoder ('float32' or 'bfloat16' autocast), latents are saved as float32
+    """
+    meta_data = dict(length=len(dataset), pooling_factor=dataset.pooling_factor,
+                     encoder=get_encoder_fingerprint(occupancy_network))
+    if os.path.exists(os.path.join(path, 'meta_data.json')):
+        with open(os.path.join(path, 'meta_data.json'), 'r') as json_file:
+            if json.load(json_file) == meta_data:
+                return
+    if not os.path.exists(path):
+        os.makedirs(path)
+    occupancy_network = occupancy_network.to(device).eval()
+    latents = None
+    volume_shapes = np.zeros((len(dataset), 4), dtype=np.int64)
+    for index in range(len(dataset)):
+        volume_n = dataset.load_volume(dataset.get_file_index(index))
+        volume_shapes[index] = volume_n.shape
+        volume = dataset.pool_volume(torch.from_numpy(volume_n).float()).unsqueeze(dim=0).to(device)
+        with Misc.get_autocast(device, precision):
+            latent = occupancy_network.encode(volume)[0].float().cpu().numpy()
+        if latents is None:
+            # Cache is written to a temporary file first, so an interrupted build is not reused
+            latents = np.lib.format.open_memmap(os.path.join(path, 'latents.tmp.npy'), mode='w+', dtype=np.float32,
+                                                shape=(len(dataset),) + latent.shape)
+        latents[index] = latent
+    latents.flush()
+    del latents
+    os.replace(os.path.join(path, 'latents.tmp.npy'), os.path.join(path, 'latents.npy'))
+    np.save(os.path.join(path, 'volume_shapes.npy'), volume_shapes)
+    with open(os.path.join(path, 'meta_data.json'), 'w') as json_file:
+        json.dump(meta_data, json_file)
+
+
+class LatentDataset(data.Dataset):
+    """
+    Dataset yields the cached latent of a frozen encoder instead of the volume, coordinates and labels are sampled
+    like in the wrapped WeaponDataset. Volumes are not loaded, latents are read from a memory mapped file.
+    """
+
+    def __init__(self, dataset: WeaponDataset, path: str) -> None:
+        """
+        Constructor method
+        :param dataset: (WeaponDataset) Dataset the cache was built for, see build_latent_cache
+        :param path: (str) Folder of the cache
+        """
+        self.dataset = dataset
+        self.latents = np.load(os.path.join(path, 'latents.npy'), mmap_mode='r')
+        self.volume_shapes = np.load(os.path.join(path, 'volume_shapes.npy'))
+        assert self.latents.shape[0] == len(dataset), 'Latent cache does not match the dataset!'
+
+    def __getitem__(self, index: int) -> Tuple[torch.tensor]:
+        """
+        Getter method
+        :param index: (int) Index
+        :return: (Tuple[torch.tensor]) Latent, coordinates and labels (and the label coordinates if test is true)
+        """
+        with self.dataset.profiler.phase('dataset_load'):
+            label_n = self.dataset.load_label(self.dataset.get_file_index(index))
+            latent = torch.from_numpy(np.array(self.latents[index]))
+        with self.dataset.profiler.phase('dataset_sampling'):
+            # Only the shape of the volume is used for sampling, a broadcast scalar needs no memory
+            coords, labels = self.dataset.sample(np.broadcast_to(np.float32(0), self.volume_shapes[index]), label_n)
+        if self.dataset.test:
+            return latent, torch.from_numpy(coords).float(), torch.from_numpy(labels).float(), torch.from_numpy(
+                label_n.astype(int)).float()
+        return latent, torch.from_numpy(coords).float(), torch.from_numpy(labels).float()
+
+    def __len__(self) -> int:
+        """
+        Returns the length of the whole dataset
+        :return: (int) Length of the dataset
+        """
+        return len(self.dataset)
+
+
+def build_scan_cache(target_path_volume: str, target_path_label: str, file_indices: List[str], path: str) -> None:
+    """
+    Function copies the volumes and labels of all scans into two memory mapped files (volumes.npy and labels.npy),
+    every scan is saved flattened and located by its offset. Processes reading the cache share the pages of the
+    operating system instead of loading the files of every scan. An existing cache is reused if it was built from the
+    same folders and scans.
+    :param target_path_volume: (str) Folder of the volumes (<index>.npy)
+    :param target_path_label: (str) Folder of the labels (<index>_label.npy)
+    :param file_indices: (List[str]) Indexes of the scans used in the file names, see Misc.FilePermutation
+    :param path: (str) Folder of the cache
+    """
+    file_indices = [str(file_index) for file_index in file_indices]
+    meta_data = dict(target_path_volume=target_path_volume, target_path_label=target_path_label,
+                     file_indices=file_indices)
+    if os.path.exists(os.path.join(path, 'meta_data.json')):
+        with open(os.path.join(path, 'meta_data.json'), 'r') as json_file:
+            if json.load(json_file) == meta_data:
+                return
+    if not os.path.exists(path):
+        os.makedirs(path)
+    # Read shapes from the headers of the files
+    volume_shapes = np.array([np.load(target_path_volume + file_index + ".npy", mmap_mode='r').shape
+                              for file_index in file_indices], dtype=np.int64)
+    label_shapes = np.array([np.load(target_path_label + file_index + "_label.npy", mmap_mode='r').shape
+                             for file_index in file_indices], dtype=np.int64)
+    volume_offsets = np.append(0, np.cumsum(np.prod(volume_shapes, axis=1)))
+    label_offsets = np.append(0, np.cumsum(np.prod(label_shapes, axis=1)))
+    # Cache is written to temporary files first, so an interrupted build is not reused
+    volumes = np.lib.format.open_memmap(os.path.join(path, 'volumes.tmp.npy'), mode='w+', dtype=np.float32,
+                                        shape=(int(volume_offsets[-1]),))
+    # Label coordinates are in full resolution (< 2^16), so they are saved as uint16 and cast when read
+    labels = np.lib.format.open_memmap(os.path.join(path, 'labels.tmp.npy'), mode='w+', dtype=np.uint16,
+                                       shape=(int(label_offsets[-1]),))
+    for index, file_index in enumerate(file_indices):
+        volumes[volume_offsets[index]:volume_offsets[index + 1]] = \
+            np.load(target_path_volume + file_index + ".npy").reshape(-1)
+        label_n = np.load(target_path_label + file_index + "_label.npy").reshape(-1)
+        if label_n.shape[0] > 0 and (label_n.min() < 0 or label_n.max() > np.iinfo(np.uint16).max):
+            raise ValueError('Label coordinates of scan {} do not fit into uint16!'.format(file_index))
+        labels[label_offsets[index]:label_offsets[index + 1]] = label_n
+    volumes.flush()
+    labels.flush()
+    del volumes, labels
+    os.replace(os.path.join(path, 'volumes.tmp.npy'), os.path.join(path, 'volumes.npy'))
+    os.replace(os.path.join(path, 'labels.tmp.npy'), os.path.join(path, 'labels.npy'))
+    np.savez(os.path.join(path, 'shapes.npz'), volume_shapes=volume_shapes, label_shapes=label_shapes,
+             volume_offsets=volume_offsets, label_offsets=label_offsets)
+    with open(os.path.join(path, 'meta_data.json'), 'w') as json_file:
+        json.dump(meta_data, json_file)
+
+
+class ScanCache(object):
+    """
+    Class reads volumes and labels from a cache built by build_scan_cache. The files are memory mapped on first access,
+    so a pickled cache (e.g. in the dataset of a dataloader worker) only includes the path and the offsets.
+    """
 
-        with open('outfile_org.obj', 'w') as f:
-            for i in range(vol.shape[1]):
-                for j in range(vol.shape[2]):
-                    for k in range(vol.shape[3]):
-                        color = vol[0][i][j][k]
-                        if color == 0:
-                            continue
-                        f.write("v " + " " + str(i * self.side_len) + " " + str(j * self.side_len) + " " + str(
-                            k * self.side_len) +
-                                " " + str(color) + " " + str(0.5) + " " + str(0.5) + "\n")
-        with open('outfile_labels.obj', 'w') as f:
-            label = self.__getitem__(index)[3].cpu().numpy()
-            for i in range(label.shape[0]):
-                f.write("v " + " " + str(label[i][0]) + " " + str(label[i][1]) + " " + str(label[i][2]) +
-                        " " + str(0) + " " + str(0) + " " + str(1) + "\n")
+    def __init__(self, path: str) -> None:
+        """
+        Constructor method
+        :param path: (str) Folder of the cache
+        """
+        self.path = path
+        with open(os.path.join(path, 'meta_data.json'), 'r') as json_file:
+            file_indices = json.load(json_file)['file_indices']
+        self.positions = {file_index: position for position, file_index in enumerate(file_indices)}
+        shapes = np.load(os.path.join(path, 'shapes.npz'))
+        self.volume_shapes = shapes['volume_shapes']
+        self.label_shapes = shapes['label_shapes']
+        self.volume_offsets = shapes['volume_offsets']
+        self.label_offsets = shapes['label_offsets']
+        self.volumes = None
+        self.labels = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """
+        Method excludes the memory mapped files from pickling
+        :return: (Dict[str, Any]) State of the cache
+        """
+        return dict(self.__dict__, volumes=None, labels=None)
+
+    def open(self) -> None:
+        """
+        Method memory maps the files of the cache
+        """
+        if self.volumes is None:
+            self.volumes = np.load(os.path.join(self.path, 'volumes.npy'), mmap_mode='r')
+            self.labels = np.load(os.path.join(self.path, 'labels.npy'), mmap_mode='r')
+
+    def get_volume(self, file_index: str) -> np.ndarray:
+        """
+        Method returns the volume of a scan
+        :param file_index: (str) Index of the scan used in the file names
+        :return: (np.ndarray) Volume of shape (1, x, y, z)
+        """
+        self.open()
+        position = self.positions[str(file_index)]
+        return np.array(self.volumes[self.volume_offsets[position]:self.volume_offsets[position + 1]]).reshape(
+            self.volume_shapes[position])
+
+    def get_label(self, file_index: str) -> np.ndarray:
+        """
+        Method returns the label of a scan
+        :param file_index: (str) Index of the scan used in the file names
+        :return: (np.ndarray) Coordinates of the weapon (points, 3)
+        """
+        self.open()
+        position = self.positions[str(file_index)]
+        return self.labels[self.label_offsets[position]:self.label_offsets[position + 1]].astype(np.int64).reshape(
+            self.label_shapes[position])
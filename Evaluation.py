@@ -0,0 +1,159 @@
+from typing import Dict
+
+import torch
+import numpy as np
+import os
+import json
+
+
+class ThresholdSweep(object):
+    """
+    Class evaluates many thresholds in one pass over the test set. For every scan the prediction scores are binned
+    into histograms split by the ground truth label and the minimum and maximum coordinates of the points in every bin
+    are saved. Suffix sums over the bins give true and false positives and suffix minima and maxima give the predicted
+    bounding box for every threshold at once. Metrics equal Misc.intersection_over_union_from_labels,
+    Misc.intersection_over_union_bounding_box_from_labels, Misc.precision and Misc.recall at each threshold.
+    """
+
+    def __init__(self, number_of_thresholds: int = 201, logits: bool = False,
+                 offset: torch.Tensor = torch.tensor([10.0, 10.0, 10.0])) -> None:
+        """
+        Constructor method
+        :param number_of_thresholds: (int) Number of thresholds evenly spaced in [0, 1], 201 includes 0.5
+        :param logits: (bool) True if predictions are logits, thresholds are always probabilities
+        :param offset: (torch.Tensor) Offset added to the label bounding box as in the test method
+        """
+        self.thresholds = torch.linspace(0.0, 1.0, number_of_thresholds, dtype=torch.float64)
+        self.logits = logits
+        self.offset = offset
+        # Per scan number of positives and negatives, true positives and false positives (scans, thresholds) and
+        # bounding box iou (scans, thresholds)
+        self.positives = []
+        self.negatives = []
+        self.true_positives = []
+        self.false_positives = []
+        self.bounding_box_iou = []
+
+    @torch.no_grad()
+    def add(self, prediction: torch.Tensor, coordinates: torch.Tensor, occupancy_labels: torch.Tensor) -> None:
+        """
+        Method adds one scan
+        :param prediction: (torch.Tensor) Raw prediction of the O-Net (samples)
+        :param coordinates: (torch.Tensor) Input coordinates of the O-Net (samples, 3)
+        :param occupancy_labels: (torch.Tensor) Occupancy of each coordinate (samples), see Misc.get_occupancy_labels
+        """
+        scores = prediction.detach().view(-1).double()
+        if self.logits:
+            scores = torch.sigmoid(scores)
+        occupancy_labels = occupancy_labels.view(-1).bool()
+        coordinates = coordinates.view(-1, 3).double()
+        thresholds = self.thresholds.to(scores.device)
+        number_of_bins = thresholds.shape[0] + 1
+        # Bin i includes scores in (threshold[i - 1], threshold[i]], so score > threshold[j] holds for all bins > j
+        bins = torch.bucketize(scores, thresholds)
+        histogram_positive = torch.bincount(bins[occupancy_labels], minlength=number_of_bins)
+        histogram_negative = torch.bincount(bins[~occupancy_labels], minlength=number_of_bins)
+        # Counts of scores above every threshold by suffix sums over the bins
+        true_positives = histogram_positive.flip(0).cumsum(0).flip(0)[1:]
+        false_positives = histogram_negative.flip(0).cumsum(0).flip(0)[1:]
+        self.positives.append(int(occupancy_labels.sum()))
+        self.negatives.append(int((~occupancy_labels).sum()))
+        self.true_positives.append(true_positives.cpu().numpy())
+        self.false_positives.append(false_positives.cpu().numpy())
+        # Min and max coordinates of every bin
+        index = bins.view(-1, 1).expand(-1, 3)
+        minimum = torch.full((number_of_bins, 3), np.inf, dtype=torch.float64, device=scores.device)
+        maximum = torch.full((number_of_bins, 3), -np.inf, dtype=torch.float64, device=scores.device)
+        minimum = minimum.scatter_reduce(0, index, coordinates, reduce='amin')
+        maximum = maximum.scatter_reduce(0, index, coordinates, reduce='amax')
+        # Predicted bounding box for every threshold by suffix minima and maxima over the bins
+        minimum_prediction = torch.cummin(minimum.flip(0), dim=0)[0].flip(0)[1:]
+        maximum_prediction = torch.cummax(maximum.flip(0), dim=0)[0].flip(0)[1:]
+        if not occupancy_labels.any():
+            self.bounding_box_iou.append(np.zeros(thresholds.shape[0]))
+            return
+        # Bounding box of the label including the offset
+        offset = self.offset.to(scores.device).double()
+        maximum_label = coordinates[occupancy_labels].max(dim=0)[0] + offset
+        minimum_label = coordinates[occupancy_labels].min(dim=0)[0] - offset
+        volume_label = torch.prod(torch.abs(maximum_label - minimum_label))
+        volume_prediction = torch.prod(torch.abs(maximum_prediction - minimum_prediction), dim=1)
+        overlap = torch.clamp(torch.min(maximum_prediction, maximum_label)
+                              - torch.max(minimum_prediction, minimum_label), min=0.0)
+        intersection = torch.prod(overlap, dim=1)
+        iou = intersection / (volume_prediction + volume_label - intersection + 1e-9)
+        # No point above the threshold results in an iou of zero
+        iou[(true_positives + false_positives) == 0] = 0.0
+        self.bounding_box_iou.append(iou.cpu().numpy())
+
+    def get_curves(self) -> Dict[str, np.ndarray]:
+        """
+        Method computes all metrics for every threshold. Iou, bounding box iou, precision and recall are averaged over
+        scans like in the test method. The precision recall and the ROC curve are computed from the points of all
+        scans.
+        :return: (Dict[str, np.ndarray]) Thresholds, mean metrics, curves and the area under the curves
+        """
+        positives = np.array(self.positives, dtype=np.float64)[:, None]
+        true_positives = np.stack(self.true_positives).astype(np.float64)
+        false_positives = np.stack(self.false_positives).astype(np.float64)
+        false_negatives = positives - true_positives
+        negatives = np.array(self.negatives, dtype=np.float64)
+        curves = dict(thresholds=self.thresholds.numpy())
+        # Per scan metrics averaged over scans
+        curves['iou'] = np.mean(true_positives / (true_positives + false_positives + false_negatives + 1e-9), axis=0)
+        curves['bounding_box_iou'] = np.mean(np.stack(self.bounding_box_iou), axis=0)
+        curves['precision'] = np.mean(true_positives / (true_positives + false_positives + 1e-9), axis=0)
+        curves['recall'] = np.mean(true_positives / (true_positives + false_negatives + 1e-9), axis=0)
+        # Curves over the points of all scans
+        true_positives_sum = true_positives.sum(axis=0)
+        false_positives_sum = false_positives.sum(axis=0)
+        curves['pr_precision'] = true_positives_sum / np.maximum(true_positives_sum + false_positives_sum, 1e-9)
+        curves['pr_recall'] = true_positives_sum / max(positives.sum(), 1e-9)
+        curves['roc_false_positive_rate'] = false_positives_sum / max(negatives.sum(), 1e-9)
+        curves['roc_true_positive_rate'] = curves['pr_recall']
+        # Areas under the curves, thresholds are increasing so recall and false positive rate are decreasing
+        curves['average_precision'] = np.array(
+            np.sum(-np.diff(np.append(curves['pr_recall'], 0.0)) * curves['pr_precision']))
+        true_positive_rate = np.append(curves['roc_true_positive_rate'], 0.0)
+        false_positive_rate = np.append(curves['roc_false_positive_rate'], 0.0)
+        curves['roc_auc'] = np.array(np.sum(-np.diff(false_positive_rate)
+                                            * (true_positive_rate[1:] + true_positive_rate[:-1]) / 2))
+        return curves
+
+    def get_best_thresholds(self, curves: Dict[str, np.ndarray] = None) -> Dict[str, Dict[str, float]]:
+        """
+        Method returns the threshold maximizing each metric
+        :param curves: (Dict[str, np.ndarray]) Curves of get_curves (default=None computes them)
+        :return: (Dict[str, Dict[str, float]]) Best threshold and value of iou, bounding box iou and f1 score
+        """
+        curves = self.get_curves() if curves is None else curves
+        curves = dict(curves, f1=2 * curves['precision'] * curves['recall']
+                                 / (curves['precision'] + curves['recall'] + 1e-9))
+        best = dict()
+        for metric_name in ['iou', 'bounding_box_iou', 'f1']:
+            index = int(np.argmax(curves[metric_name]))
+            best[metric_name] = dict(threshold=float(curves['thresholds'][index]),
+                                     value=float(curves[metric_name][index]))
+        return best
+
+    def save(self, path: str) -> Dict[str, Dict[str, float]]:
+        """
+        Method saves all curves (threshold_sweep.npz), a csv table of the metrics per threshold
+        (threshold_sweep.csv) and the best thresholds (best_thresholds.json) into a folder
+        :param path: (str) Folder to save to
+        :return: (Dict[str, Dict[str, float]]) Best threshold and value of iou, bounding box iou and f1 score
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        curves = self.get_curves()
+        np.savez(os.path.join(path, 'threshold_sweep.npz'), **curves)
+        columns = ['thresholds', 'iou', 'bounding_box_iou', 'precision', 'recall', 'pr_precision', 'pr_recall',
+                   'roc_false_positive_rate']
+        np.savetxt(os.path.join(path, 'threshold_sweep.csv'), np.stack([curves[name] for name in columns], axis=1),
+                   delimiter=',', header=','.join(columns), comments='')
+        best = self.get_best_thresholds(curves)
+        best['average_precision'] = float(curves['average_precision'])
+        best['roc_auc'] = float(curves['roc_auc'])
+        with open(os.path.join(path, 'best_thresholds.json'), 'w') as json_file:
+            json.dump(best, json_file, indent=1)
+        return best
@@ -0,0 +1,216 @@
+from typing import Dict, Tuple, Union
+
+import torch
+import torch.nn as nn
+import numpy as np
+import os
+import copy
+import json
+import time
+
+
+class EncoderGraph(nn.Module):
+    """
+    Module wrapping the encoding path of an occupancy network for tracing and export
+    """
+
+    def __init__(self, occupancy_network: nn.Module) -> None:
+        """
+        Constructor method
+        :param occupancy_network: (nn.Module) Occupancy network including an encode method
+        """
+        # Call super constructor
+        super(EncoderGraph, self).__init__()
+        # Save occupancy network
+        self.occupancy_network = occupancy_network
+
+    def forward(self, volume: torch.Tensor) -> torch.Tensor:
+        """
+        Forward pass
+        :param volume: (torch.Tensor) Input volume of shape (batch size, 1, x, y, z)
+        :return: (torch.Tensor) Latent tensor of shape (batch size, features)
+        """
+        return self.occupancy_network.encode(volume)
+
+
+class DecoderGraph(nn.Module):
+    """
+    Module wrapping the decoding path of an occupancy network for tracing and export
+    """
+
+    def __init__(self, occupancy_network: nn.Module) -> None:
+        """
+        Constructor method
+        :param occupancy_network: (nn.Module) Occupancy network including a decode method
+        """
+        # Call super constructor
+        super(DecoderGraph, self).__init__()
+        # Save occupancy network
+        self.occupancy_network = occupancy_network
+
+    def forward(self, latent: torch.Tensor, coordinates: torch.Tensor) -> torch.Tensor:
+        """
+        Forward pass
+        :param latent: (torch.Tensor) Latent tensor of shape (batch size, features)
+        :param coordinates: (torch.Tensor) Coordinates of shape (batch size * points, 3)
+        :return: (torch.Tensor) Occupancy prediction of shape (batch size * points, 1)
+        """
+        return self.occupancy_network.decode(latent, coordinates)
+
+
+def export_occupancy_network(occupancy_network: nn.Module, path: str,
+                             volume_shape: Tuple[int, int, int, int] = (1, 80, 48, 64),
+                             number_of_points: int = 2 ** 12, export_onnx: bool = True) -> None:
+    """
+    Function exports the encoding and decoding path of an occupancy network as traced and frozen TorchScript graphs
+    and optionally as ONNX graphs. The number of points and the batch size are dynamic in all exported graphs.
+    Only OccupancyNetwork and OccupancyNetworkNoCat are supported since both provide a flattened latent tensor.
+    :param occupancy_network: (nn.Module) Occupancy network to be exported
+    :param path: (str) Folder to save the exported graphs
+    :param volume_shape: (Tuple[int, int, int, int]) Shape of one input volume (channels, x, y, z)
+    :param number_of_points: (int) Number of points per volume used while tracing
+    :param export_onnx: (bool) True if ONNX graphs should be exported additionally
+    """
+    # Get model if data parallel is utilized
+    if isinstance(occupancy_network, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        occupancy_network = occupancy_network.module
+    # Make folder
+    if not os.path.exists(path):
+        os.makedirs(path)
+    # Export a copy on cpu in eval mode, the model of the caller is not moved
+    occupancy_network = copy.deepcopy(occupancy_network).cpu().eval()
+    encoder = EncoderGraph(occupancy_network).eval()
+    decoder = DecoderGraph(occupancy_network).eval()
+    # Init example inputs
+    volume = torch.rand(1, *volume_shape)
+    coordinates = torch.randint(low=0, high=min(volume_shape[1:]), size=(number_of_points, 3)).float()
+    with torch.no_grad():
+        latent = encoder(volume)
+        # Trace and freeze graphs to fold parameters into the graph
+        traced_encoder = torch.jit.freeze(torch.jit.trace(encoder, volume))
+        traced_decoder = torch.jit.freeze(torch.jit.trace(decoder, (latent, coordinates)))
+    torch.jit.save(traced_encoder, os.path.join(path, 'encoder.pt'))
+    torch.jit.save(traced_decoder, os.path.join(path, 'decoder.pt'))
+    # Export onnx graphs
+    if export_onnx:
+        torch.onnx.export(encoder, (volume,), os.path.join(path, 'encoder.onnx'),
+                          input_names=['volume'], output_names=['latent'],
+                          dynamic_axes={'volume': {0: 'batch_size'}, 'latent': {0: 'batch_size'}})
+        torch.onnx.export(decoder, (latent, coordinates), os.path.join(path, 'decoder.onnx'),
+                          input_names=['latent', 'coordinates'], output_names=['prediction'],
+                          dynamic_axes={'latent': {0: 'batch_size'}, 'coordinates': {0: 'points'},
+                                        'prediction': {0: 'points'}})
+    # Save meta data needed to run the exported graphs
+    meta_data = dict()
+    meta_data['volume_shape'] = list(volume_shape)
+    meta_data['latent_features'] = int(latent.shape[1])
+    meta_data['onnx'] = export_onnx
+    with open(os.path.join(path, 'export.json'), 'w') as json_file:
+        json.dump(meta_data, json_file)
+
+
+class ExportedOccupancyNetwork(object):
+    """
+    Class runs exported occupancy network graphs without the need of the model source code
+    """
+
+    def __init__(self, path: str, backend: str = 'torchscript', number_of_threads: int = None) -> None:
+        """
+        Constructor method
+        :param path: (str) Folder including the exported graphs
+        :param backend: (str) Backend to use ('torchscript' or 'onnx')
+        :param number_of_threads: (int) Number of intra op threads to use (default=None uses all cores)
+        """
+        assert backend in ['torchscript', 'onnx'], 'Backend {} is not available!'.format(backend)
+        self.backend = backend
+        # Load meta data
+        with open(os.path.join(path, 'export.json'), 'r') as json_file:
+            self.meta_data = json.load(json_file)
+        if backend == 'torchscript':
+            if number_of_threads is not None:
+                torch.set_num_threads(number_of_threads)
+            self.encoder = torch.jit.load(os.path.join(path, 'encoder.pt'), map_location='cpu')
+            self.decoder = torch.jit.load(os.path.join(path, 'decoder.pt'), map_location='cpu')
+        else:
+            # Onnx runtime is only needed for the onnx backend
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if number_of_threads is not None:
+                options.intra_op_num_threads = number_of_threads
+            self.encoder = onnxruntime.InferenceSession(os.path.join(path, 'encoder.onnx'), options,
+                                                        providers=['CPUExecutionProvider'])
+            self.decoder = onnxruntime.InferenceSession(os.path.join(path, 'decoder.onnx'), options,
+                                                        providers=['CPUExecutionProvider'])
+
+    @torch.no_grad()
+    def encode(self, volume: torch.Tensor) -> torch.Tensor:
+        """
+        Method performs the encoding path
+        :param volume: (torch.Tensor) Input volume of shape (batch size, 1, x, y, z)
+        :return: (torch.Tensor) Latent tensor of shape (batch size, features)
+        """
+        if self.backend == 'torchscript':
+            return self.encoder(volume)
+        return torch.from_numpy(self.encoder.run(None, {'volume': volume.cpu().numpy()})[0])
+
+    @torch.no_grad()
+    def decode(self, latent: torch.Tensor, coordinates: torch.Tensor) -> torch.Tensor:
+        """
+        Method performs the decoding path
+        :param latent: (torch.Tensor) Latent tensor of shape (batch size, features)
+        :param coordinates: (torch.Tensor) Coordinates of shape (batch size * points, 3)
+        :return: (torch.Tensor) Occupancy prediction of shape (batch size * points, 1)
+        """
+        if self.backend == 'torchscript':
+            return self.decoder(latent, coordinates)
+        return torch.from_numpy(self.decoder.run(None, {'latent': latent.cpu().numpy(),
+                                                        'coordinates': coordinates.cpu().numpy()})[0])
+
+    def __call__(self, volume: torch.Tensor, coordinates: torch.Tensor) -> torch.Tensor:
+        """
+        Full prediction of the exported occupancy network
+        :param volume: (torch.Tensor) Input volume of shape (batch size, 1, x, y, z)
+        :param coordinates: (torch.Tensor) Coordinates of shape (batch size * points, 3)
+        :return: (torch.Tensor) Occupancy prediction of shape (batch size * points, 1)
+        """
+        return self.decode(self.encode(volume), coordinates)
+
+
+@torch.no_grad()
+def compare_latency(occupancy_network: nn.Module,
+                    exported_occupancy_networks: Dict[str, Union[ExportedOccupancyNetwork, nn.Module]],
+                    volume: torch.Tensor, coordinates: torch.Tensor, repetitions: int = 10,
+                    warm_up: int = 2) -> Dict[str, Dict[str, float]]:
+    """
+    Function measures the cpu latency of eager mode and of exported occupancy networks
+    :param occupancy_network: (nn.Module) Occupancy network in eager mode
+    :param exported_occupancy_networks: (Dict[str, ExportedOccupancyNetwork]) Exported networks with name
+    :param volume: (torch.Tensor) Input volume of shape (batch size, 1, x, y, z)
+    :param coordinates: (torch.Tensor) Coordinates of shape (batch size * points, 3)
+    :param repetitions: (int) Number of measured predictions
+    :param warm_up: (int) Number of predictions performed before measuring
+    :return: (Dict[str, Dict[str, float]]) Latency in ms (mean, min) and max abs. deviation to eager mode per network
+    """
+    # Copy of the eager model on cpu in eval mode, the model of the caller is not moved
+    if isinstance(occupancy_network, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        occupancy_network = occupancy_network.module
+    occupancy_network = copy.deepcopy(occupancy_network).cpu().eval()
+    volume = volume.cpu()
+    coordinates = coordinates.cpu()
+    reference = occupancy_network(volume, coordinates)
+    networks = dict(eager=occupancy_network)
+    networks.update(exported_occupancy_networks)
+    results = dict()
+    for name, network in networks.items():
+        for _ in range(warm_up):
+            network(volume, coordinates)
+        latencies = []
+        for _ in range(repetitions):
+            start = time.perf_counter()
+            prediction = network(volume, coordinates)
+            latencies.append((time.perf_counter() - start) * 1e3)
+        results[name] = dict(mean_ms=float(np.mean(latencies)), min_ms=float(np.min(latencies)),
+                             max_deviation=float(torch.max(torch.abs(prediction - reference)).item()))
+        print('{}: mean latency = {:.2f}ms, min latency = {:.2f}ms, max deviation to eager = {:.2e}'.format(
+            name, results[name]['mean_ms'], results[name]['min_ms'], results[name]['max_deviation']))
+    return results
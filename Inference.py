@@ -0,0 +1,787 @@
+from typing import Any, Dict, List, Tuple, Union
+
+import torch
+import torch.nn as nn
+import numpy as np
+import time
+import threading
+import queue
+import os
+import json
+import collections
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from tqdm import tqdm
+
+import Misc
+import Models
+import Checkpoint
+
+
+def preprocess_volume(volume: np.ndarray, side_len: int = 8, threshold_min: float = 0, threshold_max: float = 50000,
+                      dim_max: int = 640, device: str = 'cpu') -> torch.Tensor:
+    """
+    Function preprocesses a raw scan like the WeaponDatasetGenerator: values are normalized, the volume is
+    downsampled by average pooling and the first axis is cropped or zero padded to dim_max / side_len
+    :param volume: (np.ndarray) Raw volume of shape (x, y, z)
+    :param side_len: (int) Downscale factor
+    :param threshold_min: (float) Value mapped to zero
+    :param threshold_max: (float) Value mapped to one
+    :param dim_max: (int) Full resolution size of the first axis after cropping or padding
+    :param device: (str) Device to perform the pooling on
+    :return: (torch.Tensor) Preprocessed volume of shape (1, x / side_len, y / side_len, z / side_len) on the cpu
+    """
+    dim_max = int(dim_max / side_len)
+    volume = (volume - threshold_min).astype(np.float32) / float(threshold_max - threshold_min)
+    volume_pooled = nn.functional.avg_pool3d(torch.from_numpy(volume).unsqueeze(dim=0).to(device), side_len, side_len)
+    volume_pooled = volume_pooled[:, 0:dim_max, :, :]
+    volume_pooled = nn.functional.pad(volume_pooled, (0, 0, 0, 0, 0, dim_max - volume_pooled.shape[1]))
+    return volume_pooled.float().cpu()
+
+
+def load_volume(path: str, side_len: int = 8, **kwargs: Any) -> torch.Tensor:
+    """
+    Function loads a scan. Raw scans (.mha) are preprocessed, volumes saved by the WeaponDatasetGenerator (.npy) are
+    already preprocessed.
+    :param path: (str) Path of the scan
+    :param side_len: (int) Downscale factor of raw scans
+    :param kwargs: (Any) Further parameters of preprocess_volume
+    :return: (torch.Tensor) Preprocessed volume of shape (1, x, y, z)
+    """
+    if path.endswith('.npy'):
+        volume = torch.from_numpy(np.load(path).astype(np.float32))
+        # Volumes are saved with a leading channel dimension
+        return volume.view(1, *volume.shape[-3:])
+    if path.endswith('.mha'):
+        # itk is only needed for raw scans
+        import itk
+        return preprocess_volume(itk.GetArrayFromImage(itk.imread(path)), side_len=side_len, **kwargs)
+    raise ValueError('Scan format of {} is not supported!'.format(path))
+
+
+def get_grid_coordinates(volume_shape: Tuple[int, ...], side_len: int = 8, stride: int = None) -> torch.Tensor:
+    """
+    Function returns a regular grid of full resolution coordinates covering a volume
+    :param volume_shape: (Tuple[int, ...]) Shape of the downscaled volume (..., x, y, z)
+    :param side_len: (int) Downscale factor of the volume
+    :param stride: (int) Distance of grid points in full resolution (default=None uses side_len)
+    :return: (torch.Tensor) Coordinates of shape (points, 3)
+    """
+    stride = side_len if stride is None else stride
+    axes = [torch.arange(0, dimension * side_len, stride, dtype=torch.float32) for dimension in volume_shape[-3:]]
+    return torch.stack(torch.meshgrid(*axes, indexing='ij'), dim=-1).view(-1, 3)
+
+
+def get_result(prediction: torch.Tensor, coordinates: torch.Tensor, threshold: float = 0.5,
+               output: str = 'bounding_box', voxel_size: float = 8) -> Dict[str, Any]:
+    """
+    Function converts the prediction of one scan into the requested output
+    :param prediction: (torch.Tensor) Prediction of shape (points, 1)
+    :param coordinates: (torch.Tensor) Coordinates of shape (points, 3)
+    :param threshold: (float) Threshold in the output space of the model (probability or logit)
+    :param output: (str) Output type: 'bounding_box' (min and max of weapon coordinates), 'mask' (weapon coordinates),
+    'scores' (all predictions) or 'instances' (bounding box and number of points of every connected component)
+    :param voxel_size: (float) Voxel size of the connected components, usually the distance of grid points
+    :return: (Dict[str, Any]) Number of weapon points and the requested output as numpy arrays
+    """
+    weapon = prediction.view(-1) > threshold
+    result = dict(number_of_weapon_points=int(weapon.sum()))
+    if output == 'scores':
+        result['scores'] = prediction.view(-1).float().cpu().numpy()
+    elif output == 'mask':
+        result['mask'] = coordinates[weapon].cpu().numpy()
+    elif output == 'instances':
+        _, boxes, sizes = Misc.get_connected_components(coordinates[weapon], voxel_size=voxel_size)
+        result['instances'] = [dict(bounding_box=box.tolist(), number_of_points=size)
+                               for box, size in zip(boxes.cpu().numpy(), sizes.tolist())]
+    elif result['number_of_weapon_points'] > 0:
+        weapon_coordinates = coordinates[weapon]
+        result['bounding_box'] = torch.stack((weapon_coordinates.min(dim=0)[0],
+                                              weapon_coordinates.max(dim=0)[0])).cpu().numpy()
+    else:
+        result['bounding_box'] = None
+    return result
+
+
+AUGMENTATIONS = ['identity', 'flip_x', 'flip_y', 'flip_z', 'rot90_xy', 'rot90_xz', 'rot90_yz']
+
+
+def augment_volumes(volumes: torch.Tensor, augmentation: str) -> torch.Tensor:
+    """
+    Function flips or rotates volumes
+    :param volumes: (torch.Tensor) Volumes of shape (batch size, 1, x, y, z)
+    :param augmentation: (str) Augmentation, see AUGMENTATIONS
+    :return: (torch.Tensor) Augmented volumes, rotations swap the sizes of the two axes
+    """
+    assert augmentation in AUGMENTATIONS, 'Augmentation {} is not available!'.format(augmentation)
+    if augmentation.startswith('flip'):
+        return volumes.flip('xyz'.index(augmentation[-1]) + 2)
+    if augmentation.startswith('rot90'):
+        return torch.rot90(volumes, k=1, dims=('xyz'.index(augmentation[-2]) + 2, 'xyz'.index(augmentation[-1]) + 2))
+    return volumes
+
+
+def augment_coordinates(coordinates: torch.Tensor, augmentation: str, volume_shape: Tuple[int, ...],
+                        side_len: int = 8) -> torch.Tensor:
+    """
+    Function maps full resolution coordinates into the frame of an augmented volume, so the augmented volume at the
+    mapped coordinates equals the original volume at the coordinates
+    :param coordinates: (torch.Tensor) Coordinates of shape (..., 3)
+    :param augmentation: (str) Augmentation, see AUGMENTATIONS
+    :param volume_shape: (Tuple[int, ...]) Shape of the original downscaled volume (..., x, y, z)
+    :param side_len: (int) Downscale factor of the volume
+    :return: (torch.Tensor) Mapped coordinates
+    """
+    # Full resolution size of every axis, voxel i covers [i * side_len, (i + 1) * side_len)
+    sizes = [dimension * side_len for dimension in volume_shape[-3:]]
+    if augmentation.startswith('flip'):
+        axis = 'xyz'.index(augmentation[-1])
+        coordinates = coordinates.clone()
+        coordinates[..., axis] = sizes[axis] - 1 - coordinates[..., axis]
+    elif augmentation.startswith('rot90'):
+        # torch.rot90 maps index (i, j) of the plane to (size_j - 1 - j, i)
+        first, second = 'xyz'.index(augmentation[-2]), 'xyz'.index(augmentation[-1])
+        coordinates = coordinates.clone()
+        coordinates[..., first], coordinates[..., second] = \
+            sizes[second] - 1 - coordinates[..., second], coordinates[..., first].clone()
+    return coordinates
+
+
+def encode_augmented(occupancy_network: nn.Module, volumes: torch.Tensor, augmentations: List[str]) -> torch.Tensor:
+    """
+    Function encodes all augmentations of a batch of volumes. Augmentations resulting in the same shape (e.g. all
+    flips) are encoded in one call.
+    :param occupancy_network: (nn.Module) Occupancy network
+    :param volumes: (torch.Tensor) Volumes of shape (batch size, 1, x, y, z)
+    :param augmentations: (List[str]) Augmentations, see AUGMENTATIONS
+    :return: (torch.Tensor) Latents of shape (augmentations * batch size, ...) ordered by augmentation
+    """
+    augmented = [augment_volumes(volumes, augmentation) for augmentation in augmentations]
+    groups = dict()
+    for index, volume in enumerate(augmented):
+        groups.setdefault(tuple(volume.shape), []).append(index)
+    latents = [None] * len(augmentations)
+    for indexes in groups.values():
+        group_latents = occupancy_network.encode(torch.cat([augmented[index] for index in indexes], dim=0))
+        for index, latent in zip(indexes, group_latents.split(volumes.shape[0], dim=0)):
+            latents[index] = latent
+    return torch.cat(latents, dim=0)
+
+
+def decode_augmented(occupancy_network: nn.Module, latents: torch.Tensor, coordinates: torch.Tensor,
+                     volume_shape: Tuple[int, ...], augmentations: List[str], side_len: int = 8) -> torch.Tensor:
+    """
+    Function decodes the coordinates in the frame of every augmentation in one call and averages the predictions
+    :param occupancy_network: (nn.Module) Occupancy network
+    :param latents: (torch.Tensor) Latents of encode_augmented
+    :param coordinates: (torch.Tensor) Coordinates of shape (batch size, points, 3) in the original frame
+    :param volume_shape: (Tuple[int, ...]) Shape of the original downscaled volumes (..., x, y, z)
+    :param augmentations: (List[str]) Augmentations used for the latents
+    :param side_len: (int) Downscale factor of the volumes
+    :return: (torch.Tensor) Mean prediction over all augmentations (in the output space of the model) of shape
+    (batch size * points, 1)
+    """
+    augmented_coordinates = torch.cat([augment_coordinates(coordinates, augmentation, volume_shape, side_len)
+                                       for augmentation in augmentations], dim=0)
+    prediction = occupancy_network.decode(latents, augmented_coordinates.view(-1, 3)).float()
+    return prediction.view(len(augmentations), -1, 1).mean(dim=0)
+
+
+def load_occupancy_network(path: str, device: str = 'cpu', **kwargs: bool) -> nn.Module:
+    """
+    Function loads a pickled model or a checkpoint including a state dict
+    :param path: (str) Path of the model or checkpoint
+    :param device: (str) Device to load the model to
+    :param kwargs: (bool) Parameters of Models.get_occupancy_network used for checkpoints
+    :return: (nn.Module) Occupancy network in eval mode
+    """
+    checkpoint = Checkpoint.load_checkpoint(path, map_location=device)
+    if isinstance(checkpoint, nn.Module):
+        occupancy_network = checkpoint
+    else:
+        occupancy_network = Models.get_occupancy_network(**kwargs)
+        occupancy_network.load_state_dict(checkpoint['model_state_dict'])
+    # Remove (distributed) data parallel wrapper
+    if isinstance(occupancy_network, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        occupancy_network = occupancy_network.module
+    return occupancy_network.to(device).eval()
+
+
+@torch.no_grad()
+def detect_bounding_box(occupancy_network: nn.Module, volume: torch.Tensor, threshold: float = 0.5,
+                        side_len: int = 8, stride: int = None, coarse_stride: int = 32, logits: bool = False,
+                        device: str = 'cpu', precision: str = 'float32') -> Dict[str, Any]:
+    """
+    Function localizes the predicted bounding box without a dense segmentation. The volume is encoded once and a
+    coarse grid is decoded to find the box up to the coarse stride. Afterwards every boundary plane of the box is
+    refined by a binary search along its axis between the last coarse plane outside and the first coarse plane inside
+    the box, a plane is inside if a point of its cross section is above the threshold. All six searches share one
+    decoder call per iteration. The box equals the box of the dense grid with the given stride, if the prediction
+    is a single compact object. Objects smaller than the coarse stride can be missed by the coarse grid.
+    :param occupancy_network: (nn.Module) Occupancy network in eval mode
+    :param volume: (torch.Tensor) Preprocessed volume of shape (1, x, y, z)
+    :param threshold: (float) Threshold in the output space of the model (probability or logit)
+    :param side_len: (int) Downscale factor of the volume
+    :param stride: (int) Resolution of the refined box in full resolution (default=None uses side_len)
+    :param coarse_stride: (int) Distance of coarse grid points in full resolution, multiple of the stride
+    :param logits: (bool) True if the model outputs logits, the confidence is always a probability
+    :param device: (str) Device to use
+    :param precision: (str) Precision of forward passes ('float32' or 'bfloat16' autocast)
+    :return: (Dict[str, Any]) Bounding box (min and max coordinates (2, 3) or None), confidence (max probability of
+    all queried points) and number of decoder queries
+    """
+    stride = side_len if stride is None else stride
+    assert coarse_stride % stride == 0, 'Coarse stride has to be a multiple of the stride!'
+    step = coarse_stride // stride
+    # Size of the fine grid, which is not queried densely
+    grid_shape = torch.tensor([-(-dimension * side_len // stride) for dimension in volume.shape[-3:]])
+    with Misc.get_autocast(device, precision):
+        latent = occupancy_network.encode(volume.view(1, 1, *volume.shape[-3:]).float().to(device))
+    number_of_queries = 0
+
+    def query(indices: torch.Tensor) -> torch.Tensor:
+        nonlocal number_of_queries
+        number_of_queries += indices.shape[0]
+        with Misc.get_autocast(device, precision):
+            return occupancy_network.decode(latent, (indices * stride).float().to(device)).view(-1).float().cpu()
+
+    # Coarse grid
+    axes = [torch.arange(0, int(dimension), step) for dimension in grid_shape]
+    indices = torch.stack(torch.meshgrid(*axes, indexing='ij'), dim=-1).view(-1, 3)
+    prediction = query(indices)
+    confidence = float(prediction.max())
+    weapon = prediction > threshold
+    if not weapon.any():
+        return dict(bounding_box=None, confidence=float(torch.sigmoid(torch.tensor(confidence))) if logits
+                    else confidence, number_of_queries=number_of_queries)
+    # Grid indices of the planes known to be inside and outside of every boundary (row 0 min, row 1 max)
+    inside = torch.stack((indices[weapon].min(dim=0)[0], indices[weapon].max(dim=0)[0]))
+    outside = torch.stack((torch.clamp(inside[0] - step, min=-1), torch.clamp(inside[1] + step, max=grid_shape)))
+    # Cross sections are sampled with half the coarse distance
+    plane_step = max(step // 2, 1)
+    while ((inside - outside).abs() > 1).any():
+        planes = []
+        for side in range(2):
+            for axis in range(3):
+                if abs(int(inside[side, axis] - outside[side, axis])) <= 1:
+                    continue
+                middle = (int(inside[side, axis]) + int(outside[side, axis])) // 2
+                # Cross section covers the largest box possible for the current bounds
+                axes = [torch.arange(max(int(outside[0, other]) + 1, 0), int(outside[1, other]), plane_step)
+                        if other != axis else torch.tensor([middle]) for other in range(3)]
+                planes.append((side, axis, middle, torch.stack(torch.meshgrid(*axes, indexing='ij'),
+                                                               dim=-1).view(-1, 3)))
+        # One decoder call for all boundaries
+        predictions = query(torch.cat([plane[3] for plane in planes])).split([plane[3].shape[0] for plane in planes])
+        for (side, axis, middle, _), prediction in zip(planes, predictions):
+            confidence = max(confidence, float(prediction.max()))
+            if (prediction > threshold).any():
+                inside[side, axis] = middle
+            else:
+                outside[side, axis] = middle
+    return dict(bounding_box=(inside * stride).float().numpy(),
+                confidence=float(torch.sigmoid(torch.tensor(confidence))) if logits else confidence,
+                number_of_queries=number_of_queries)
+
+
+class InferenceEngine(object):
+    """
+    Class keeps an occupancy network resident and batches requests of concurrent callers. A worker thread collects
+    requests until the batch is full or the oldest request waited for the latency cap. Volumes of equal shape are
+    encoded in one call and the coordinates of all requests are decoded together, padded to the largest request and
+    split into chunks of a maximal number of points.
+    """
+
+    def __init__(self, occupancy_network: nn.Module, device: str = 'cpu', max_batch_size: int = 8,
+                 max_latency_ms: float = 10.0, max_points_per_batch: int = 2 ** 20, precision: str = 'float32',
+                 logits: bool = False, augmentations: List[str] = None, side_len: int = 8,
+                 statistics_window: int = 10000) -> None:
+        """
+        Constructor method
+        :param occupancy_network: (nn.Module) Occupancy network including encode and decode methods
+        :param device: (str) Device to use
+        :param max_batch_size: (int) Maximal number of requests processed together
+        :param max_latency_ms: (float) Maximal time the first request of a batch waits for further requests
+        :param max_points_per_batch: (int) Maximal number of points decoded in one call
+        :param precision: (str) Precision of forward passes ('float32' or 'bfloat16' autocast)
+        :param logits: (bool) True if the network outputs logits, thresholds are then applied in logit space
+        :param augmentations: (List[str]) Test time augmentations averaged for every request, see AUGMENTATIONS
+        (default=None disables test time augmentation)
+        :param side_len: (int) Downscale factor of the volumes, used to map coordinates of augmentations
+        :param statistics_window: (int) Number of last requests and batches used for latency statistics
+        """
+        self.occupancy_network = occupancy_network.to(device).eval()
+        self.device = device
+        self.augmentations = augmentations
+        self.side_len = side_len
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms * 1e-3
+        self.max_points_per_batch = max_points_per_batch
+        self.precision = precision
+        self.logits = logits
+        self.queue = queue.Queue()
+        # Total number of requests and batches, sizes of the last batches and latencies of the last requests in ms
+        self.number_of_requests = 0
+        self.number_of_batches = 0
+        self.batch_sizes = collections.deque(maxlen=statistics_window)
+        self.latencies = collections.deque(maxlen=statistics_window)
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='inference', daemon=True)
+        self.thread.start()
+
+    def submit(self, volume: torch.Tensor, coordinates: torch.Tensor = None, threshold: float = 0.5,
+               output: str = 'bounding_box', side_len: int = 8, stride: int = None) -> Future:
+        """
+        Method queues a request
+        :param volume: (torch.Tensor) Preprocessed volume of shape (1, x, y, z)
+        :param coordinates: (torch.Tensor) Full resolution coordinates to query of shape (points, 3) (default=None
+        queries a regular grid)
+        :param threshold: (float) Probability threshold
+        :param output: (str) Output type ('bounding_box', 'mask', 'scores' or 'instances'), see get_result
+        :param side_len: (int) Downscale factor of the volume used for the grid
+        :param stride: (int) Distance of grid points in full resolution (default=None uses side_len)
+        :return: (Future) Future of the result dict, see get_result
+        """
+        # Invalid requests raise value errors, so servers can reject them
+        if output not in ['bounding_box', 'mask', 'scores', 'instances']:
+            raise ValueError('Output {} is not available!'.format(output))
+        if stride is not None and stride <= 0:
+            raise ValueError('Stride has to be positive!')
+        if not 0.0 <= threshold <= 1.0:
+            raise ValueError('Threshold has to be a probability in [0, 1]!')
+        if coordinates is None:
+            coordinates = get_grid_coordinates(volume.shape, side_len=side_len, stride=stride)
+        future = Future()
+        if self.logits:
+            threshold = Misc.probability_to_logit(threshold)
+        self.queue.put((volume.view(1, *volume.shape[-3:]).float(), coordinates.view(-1, 3).float(), threshold,
+                        output, side_len if stride is None else stride, future, time.perf_counter()))
+        return future
+
+    def __call__(self, volume: torch.Tensor, coordinates: torch.Tensor = None, **kwargs: Any) -> Dict[str, Any]:
+        """
+        Method processes a request and waits for the result
+        :param volume: (torch.Tensor) Preprocessed volume of shape (1, x, y, z)
+        :param coordinates: (torch.Tensor) Coordinates to query (default=None queries a regular grid)
+        :param kwargs: (Any) Further parameters of submit
+        :return: (Dict[str, Any]) Result, see get_result
+        """
+        return self.submit(volume, coordinates, **kwargs).result()
+
+    def get_batch(self) -> List[Tuple[Any, ...]]:
+        """
+        Method waits for the next request and collects further requests until the batch is full or the latency cap
+        of the first request is reached
+        :return: (List[Tuple[Any, ...]]) Requests
+        """
+        batch = [self.queue.get()]
+        # Stop signal
+        if batch[0] is None:
+            return batch
+        deadline = batch[0][-1] + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    @torch.no_grad()
+    def process(self, batch: List[Tuple[Any, ...]]) -> None:
+        """
+        Method processes a batch of requests and sets the results of their futures
+        :param batch: (List[Tuple[Any, ...]]) Requests
+        """
+        # Group requests by volume shape, each group is encoded in one call
+        groups = dict()
+        for request in batch:
+            groups.setdefault(tuple(request[0].shape), []).append(request)
+        for requests in groups.values():
+            volumes = torch.stack([request[0] for request in requests]).to(self.device)
+            # Pad coordinates of all requests to the largest number of points
+            numbers_of_points = [request[1].shape[0] for request in requests]
+            coordinates = torch.zeros(len(requests), max(numbers_of_points), 3)
+            for index, request in enumerate(requests):
+                coordinates[index, :numbers_of_points[index]] = request[1]
+            coordinates = coordinates.to(self.device)
+            with Misc.get_autocast(self.device, self.precision):
+                if self.augmentations is None:
+                    latent = self.occupancy_network.encode(volumes)
+                    # Decode chunks of points of all volumes at once
+                    chunk_size = max(self.max_points_per_batch // len(requests), 1)
+                    predictions = torch.cat([self.occupancy_network.decode(
+                        latent, coordinates[:, start:start + chunk_size].reshape(-1, 3)).view(len(requests), -1).float()
+                                             for start in range(0, coordinates.shape[1], chunk_size)], dim=1)
+                else:
+                    # All augmentations of all volumes are encoded and decoded together
+                    latent = encode_augmented(self.occupancy_network, volumes, self.augmentations)
+                    chunk_size = max(self.max_points_per_batch // (len(requests) * len(self.augmentations)), 1)
+                    predictions = torch.cat([decode_augmented(
+                        self.occupancy_network, latent, coordinates[:, start:start + chunk_size], volumes.shape,
+                        self.augmentations, side_len=self.side_len).view(len(requests), -1)
+                                             for start in range(0, coordinates.shape[1], chunk_size)], dim=1)
+            for index, (_, request_coordinates, threshold, output, voxel_size, future, start) in enumerate(requests):
+                result = get_result(predictions[index, :numbers_of_points[index]],
+                                    request_coordinates.to(self.device), threshold=threshold, output=output,
+                                    voxel_size=voxel_size)
+                result['latency_ms'] = (time.perf_counter() - start) * 1e3
+                result['batch_size'] = len(batch)
+                with self.lock:
+                    self.latencies.append(result['latency_ms'])
+                    self.number_of_requests += 1
+                future.set_result(result)
+        with self.lock:
+            self.batch_sizes.append(len(batch))
+            self.number_of_batches += 1
+
+    def run(self) -> None:
+        """
+        Method processes batches until a None request is queued
+        """
+        while True:
+            batch = self.get_batch()
+            # Stop signal is processed after the other requests of the batch
+            stop = any(request is None for request in batch)
+            batch = [request for request in batch if request is not None]
+            if len(batch) > 0:
+                try:
+                    self.process(batch)
+                except Exception as exception:
+                    for request in batch:
+                        if not request[5].done():
+                            request[5].set_exception(exception)
+            if stop:
+                return
+
+    def get_statistics(self) -> Dict[str, float]:
+        """
+        Method returns statistics of the processed requests
+        :return: (Dict[str, float]) Total number of requests and batches, mean batch size and latency percentiles in ms
+        of the last requests (see statistics_window)
+        """
+        with self.lock:
+            latencies = np.array(self.latencies)
+            batch_sizes = np.array(self.batch_sizes)
+            number_of_requests, number_of_batches = self.number_of_requests, self.number_of_batches
+        if latencies.shape[0] == 0 or batch_sizes.shape[0] == 0:
+            return dict(requests=number_of_requests, batches=number_of_batches)
+        return dict(requests=number_of_requests, batches=number_of_batches,
+                    mean_batch_size=float(batch_sizes.mean()), latency_p50_ms=float(np.percentile(latencies, 50)),
+                    latency_p95_ms=float(np.percentile(latencies, 95)),
+                    latency_p99_ms=float(np.percentile(latencies, 99)))
+
+    def close(self) -> None:
+        """
+        Method processes all queued requests and stops the worker thread
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+class CascadeInference(object):
+    """
+    Class performs a two stage coarse to fine inference. A cheap coarse network (Models.get_occupancy_network with a
+    pooling factor) encodes the volume downsampled by the pooling factor and decodes a coarse grid with a low
+    threshold. Scans without a point above the coarse threshold exit after this stage. Otherwise the connected
+    components of the coarse points give regions of interest and the fine network decodes its grid only inside of
+    these regions. The encoder of the fine network always sees the whole volume, since its latent is global.
+    The interface equals the InferenceEngine, so the cascade can be used by predict_scans.
+    """
+
+    def __init__(self, coarse_network: nn.Module, fine_network: nn.Module, pooling_factor: int = 4,
+                 coarse_threshold: float = 0.3, coarse_stride: int = None, margin: int = None, device: str = 'cpu',
+                 max_points_per_batch: int = 2 ** 20, precision: str = 'float32', logits: bool = False) -> None:
+        """
+        Constructor method
+        :param coarse_network: (nn.Module) Occupancy network trained with the pooling factor
+        :param fine_network: (nn.Module) Occupancy network trained on the full resolution volumes
+        :param pooling_factor: (int) Additional downscale factor of the coarse stage
+        :param coarse_threshold: (float) Probability threshold of the coarse stage, lower than the final threshold so
+        weapons are rarely missed
+        :param coarse_stride: (int) Distance of coarse grid points in full resolution (default=None uses side_len *
+        pooling_factor)
+        :param margin: (int) Margin added to every region of interest in full resolution (default=None uses the coarse
+        stride)
+        :param device: (str) Device to use
+        :param max_points_per_batch: (int) Maximal number of points decoded in one call
+        :param precision: (str) Precision of forward passes ('float32' or 'bfloat16' autocast)
+        :param logits: (bool) True if the networks output logits, thresholds are then applied in logit space
+        """
+        self.coarse_network = coarse_network.to(device).eval()
+        self.fine_network = fine_network.to(device).eval()
+        self.pooling_factor = pooling_factor
+        self.coarse_threshold = Misc.probability_to_logit(coarse_threshold) if logits else coarse_threshold
+        self.coarse_stride = coarse_stride
+        self.margin = margin
+        self.device = device
+        self.max_points_per_batch = max_points_per_batch
+        self.precision = precision
+        self.logits = logits
+        # Latencies in ms and exit stages of the last scans
+        self.latencies = collections.deque(maxlen=10000)
+        self.stages = collections.deque(maxlen=10000)
+        self.lock = threading.Lock()
+
+    def decode(self, occupancy_network: nn.Module, latent: torch.Tensor, coordinates: torch.Tensor) -> torch.Tensor:
+        """
+        Method decodes coordinates in chunks
+        :param occupancy_network: (nn.Module) Occupancy network
+        :param latent: (torch.Tensor) Latent of one volume
+        :param coordinates: (torch.Tensor) Coordinates on the device of shape (points, 3)
+        :return: (torch.Tensor) Prediction of shape (points)
+        """
+        return torch.cat([occupancy_network.decode(latent, coordinates[start:start + self.max_points_per_batch])
+                          .view(-1).float() for start in range(0, coordinates.shape[0], self.max_points_per_batch)]) \
+            if coordinates.shape[0] > 0 else torch.zeros(0, device=coordinates.device)
+
+    @torch.no_grad()
+    def __call__(self, volume: torch.Tensor, coordinates: torch.Tensor = None, threshold: float = 0.5,
+                 output: str = 'bounding_box', side_len: int = 8, stride: int = None) -> Dict[str, Any]:
+        """
+        Method processes one scan
+        :param volume: (torch.Tensor) Preprocessed volume of shape (1, x, y, z)
+        :param coordinates: (torch.Tensor) Full resolution coordinates of the fine stage (default=None queries a
+        regular grid), only coordinates inside of the regions of interest are decoded
+        :param threshold: (float) Probability threshold of the fine stage
+        :param output: (str) Output type ('bounding_box', 'mask', 'scores' or 'instances'), see get_result
+        :param side_len: (int) Downscale factor of the volume
+        :param stride: (int) Distance of fine grid points in full resolution (default=None uses side_len)
+        :return: (Dict[str, Any]) Result, see get_result, including the exit stage ('coarse' or 'fine'), the regions
+        of interest (min and max coordinates) and the number of decoded points
+        """
+        start = time.perf_counter()
+        stride = side_len if stride is None else stride
+        coarse_stride = side_len * self.pooling_factor if self.coarse_stride is None else self.coarse_stride
+        margin = coarse_stride if self.margin is None else self.margin
+        volume = volume.view(1, 1, *volume.shape[-3:]).float().to(self.device)
+        # Coarse stage
+        with Misc.get_autocast(self.device, self.precision):
+            latent = self.coarse_network.encode(nn.functional.avg_pool3d(volume, self.pooling_factor))
+            coarse_coordinates = get_grid_coordinates(volume.shape, side_len=side_len,
+                                                      stride=coarse_stride).to(self.device)
+            coarse_prediction = self.decode(self.coarse_network, latent, coarse_coordinates)
+        weapon = coarse_prediction > self.coarse_threshold
+        number_of_queries = coarse_coordinates.shape[0]
+        if not weapon.any():
+            # Nothing suspicious, exit after the coarse stage
+            coordinates = torch.zeros(0, 3)
+            result = get_result(torch.zeros(0, 1), coordinates, output=output, voxel_size=stride)
+            result.update(stage='coarse', regions_of_interest=[])
+        else:
+            # Regions of interest are the boxes of connected coarse points plus the margin
+            _, boxes, _ = Misc.get_connected_components(coarse_coordinates[weapon], voxel_size=coarse_stride)
+            boxes = boxes + torch.tensor([-margin, margin], device=boxes.device, dtype=boxes.dtype).view(1, 2, 1)
+            if coordinates is None:
+                coordinates = get_grid_coordinates(volume.shape, side_len=side_len, stride=stride)
+            coordinates = coordinates.view(-1, 3).float().to(self.device)
+            inside = ((coordinates.unsqueeze(dim=1) >= boxes[:, 0].unsqueeze(dim=0))
+                      & (coordinates.unsqueeze(dim=1) <= boxes[:, 1].unsqueeze(dim=0))).all(dim=2).any(dim=1)
+            coordinates = coordinates[inside]
+            # Fine stage
+            with Misc.get_autocast(self.device, self.precision):
+                latent = self.fine_network.encode(volume)
+                prediction = self.decode(self.fine_network, latent, coordinates)
+            result = get_result(prediction, coordinates,
+                                threshold=Misc.probability_to_logit(threshold) if self.logits else threshold,
+                                output=output, voxel_size=stride)
+            result.update(stage='fine', regions_of_interest=boxes.cpu().numpy().tolist())
+            number_of_queries += coordinates.shape[0]
+        if output == 'scores':
+            # Scores are only given for the decoded coordinates, both stages return them
+            result['coordinates'] = coordinates.cpu().numpy()
+        result['number_of_queries'] = number_of_queries
+        result['latency_ms'] = (time.perf_counter() - start) * 1e3
+        with self.lock:
+            self.latencies.append(result['latency_ms'])
+            self.stages.append(result['stage'])
+        return result
+
+    def submit(self, volume: torch.Tensor, coordinates: torch.Tensor = None, **kwargs: Any) -> Future:
+        """
+        Method processes one scan in the calling thread and returns a completed future like InferenceEngine.submit
+        :param volume: (torch.Tensor) Preprocessed volume of shape (1, x, y, z)
+        :param coordinates: (torch.Tensor) Coordinates to query (default=None queries a regular grid)
+        :param kwargs: (Any) Parameters of __call__
+        :return: (Future) Future of the result dict
+        """
+        future = Future()
+        try:
+            future.set_result(self(volume, coordinates, **kwargs))
+        except Exception as exception:
+            future.set_exception(exception)
+        return future
+
+    def get_statistics(self) -> Dict[str, float]:
+        """
+        Method returns statistics of all processed scans
+        :return: (Dict[str, float]) Number of scans, share of scans exiting after the coarse stage and mean latency of
+        both exit stages in ms
+        """
+        with self.lock:
+            latencies = np.array(self.latencies)
+            stages = np.array(self.stages)
+        if latencies.shape[0] == 0:
+            return dict(requests=0)
+        statistics = dict(requests=int(latencies.shape[0]), coarse_exit_share=float(np.mean(stages == 'coarse')),
+                          mean_latency_ms=float(latencies.mean()))
+        for stage in ['coarse', 'fine']:
+            if (stages == stage).any():
+                statistics['mean_latency_{}_ms'.format(stage)] = float(latencies[stages == stage].mean())
+        return statistics
+
+    def close(self) -> None:
+        """
+        Method exists for compatibility with the InferenceEngine, scans are processed synchronously
+        """
+        pass
+
+
+def get_scan_paths(path: str) -> List[str]:
+    """
+    Function returns the scans of a directory or a manifest. Directories are searched recursively for raw scans
+    (.mha) and preprocessed volumes (.npy), label files are skipped. A manifest is a text file including one path per
+    line, relative paths are relative to the manifest.
+    :param path: (str) Directory or manifest
+    :return: (List[str]) Sorted paths of the scans
+    """
+    if os.path.isdir(path):
+        paths = []
+        for directory, _, files in os.walk(path):
+            for file in files:
+                if file.endswith(('.mha', '.npy')) and 'label' not in file:
+                    paths.append(os.path.join(directory, file))
+        return sorted(paths)
+    with open(path, 'r') as file:
+        lines = [line.strip() for line in file if line.strip() and not line.startswith('#')]
+    return [os.path.join(os.path.dirname(path), line) if not os.path.isabs(line) else line for line in lines]
+
+
+def get_result_name(path: str, root: str) -> str:
+    """
+    Function returns a unique file name for the result of a scan
+    :param path: (str) Path of the scan
+    :param root: (str) Directory or manifest the scan was listed in
+    :return: (str) Path of the scan relative to the root without extension, separators are replaced by '__'
+    """
+    root = root if os.path.isdir(root) else os.path.dirname(root)
+    name = os.path.splitext(os.path.relpath(path, root))[0]
+    return name.replace(os.sep, '__').replace('..', '_')
+
+
+def write_result(result: Dict[str, Any], path: str) -> None:
+    """
+    Function writes the result of a scan atomically, arrays are saved in an additional npz file. The json file is
+    written last, so it marks a completed scan.
+    :param result: (Dict[str, Any]) Result, see get_result
+    :param path: (str) Path of the json file
+    """
+    arrays = {key: value for key, value in result.items() if isinstance(value, np.ndarray) and key != 'bounding_box'}
+    if len(arrays) > 0:
+        with open(path[:-len('.json')] + '.tmp.npz', 'wb') as file:
+            np.savez_compressed(file, **arrays)
+        os.replace(path[:-len('.json')] + '.tmp.npz', path[:-len('.json')] + '.npz')
+    summary = {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in result.items()
+               if key not in arrays}
+    with open(path + '.tmp', 'w') as json_file:
+        json.dump(summary, json_file)
+    os.replace(path + '.tmp', path)
+
+
+def init_loader_process() -> None:
+    """
+    Function limits the threads of preprocessing processes, so they do not compete with the model
+    """
+    torch.set_num_threads(1)
+
+
+def predict_scans(engine: Union[InferenceEngine, CascadeInference], path: str, output_path: str,
+                  number_of_workers: int = 2,
+                  output: str = 'bounding_box', threshold: float = 0.5, side_len: int = 8, stride: int = None,
+                  prefetch: int = 4, max_in_flight: int = 8) -> Dict[str, int]:
+    """
+    Function streams all scans of a directory or a manifest through loading and preprocessing (process pool), the
+    batched encoding and decoding of the inference engine and writing of the results (thread), all stages overlap.
+    Results are written per scan as soon as they are completed (<name>.json and for masks and scores <name>.npz).
+    Scans with an existing result are skipped, so an interrupted run is resumed by running it again. Failed scans
+    are recorded in errors.jsonl and retried by the next run.
+    :param engine: (Union[InferenceEngine, CascadeInference]) Inference engine or cascade
+    :param path: (str) Directory or manifest of scans
+    :param output_path: (str) Folder to write results to
+    :param number_of_workers: (int) Number of preprocessing processes (0 loads in the main process)
+    :param output: (str) Output type ('bounding_box', 'mask', 'scores' or 'instances'), see get_result
+    :param threshold: (float) Probability threshold
+    :param side_len: (int) Downscale factor of the volumes
+    :param stride: (int) Distance of queried grid points in full resolution (default=None uses side_len)
+    :param prefetch: (int) Number of scans loaded ahead per worker
+    :param max_in_flight: (int) Maximal number of scans submitted to the engine and not written yet, bounds the memory
+    of pending volumes and results (e.g. twice the batch size of the engine)
+    :return: (Dict[str, int]) Number of scans, skipped, predicted and failed scans
+    """
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    paths = get_scan_paths(path)
+    # Skip scans of previous runs
+    todo = [(scan_path, os.path.join(output_path, get_result_name(scan_path, path) + '.json')) for scan_path in paths]
+    todo = [(scan_path, result_path) for scan_path, result_path in todo if not os.path.exists(result_path)]
+    statistics = dict(scans=len(paths), skipped=len(paths) - len(todo), predicted=0, failed=0)
+    lock = threading.Lock()
+    # Released by the writer, so loading waits for slow engines instead of queueing all scans
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def record_error(scan_path: str, error: BaseException) -> None:
+        with lock:
+            statistics['failed'] += 1
+            with open(os.path.join(output_path, 'errors.jsonl'), 'a') as file:
+                file.write(json.dumps(dict(path=scan_path, error=repr(error))) + '\n')
+
+    def write(future: Future, scan_path: str, result_path: str) -> None:
+        try:
+            result = future.result()
+            result['path'] = scan_path
+            write_result(result, result_path)
+        except Exception as error:
+            record_error(scan_path, error)
+            return
+        finally:
+            in_flight.release()
+        with lock:
+            statistics['predicted'] += 1
+
+    loader = ProcessPoolExecutor(number_of_workers, initializer=init_loader_process) if number_of_workers > 0 \
+        else ThreadPoolExecutor(1)
+    # Single writer waits for the results in submission order, so the main thread only feeds the engine
+    writer = ThreadPoolExecutor(1)
+    progress_bar = tqdm(total=len(paths), initial=statistics['skipped'])
+    loading = collections.deque()
+    scans = iter(todo)
+    try:
+        while True:
+            # Keep the preprocessing workers busy
+            while len(loading) < max(number_of_workers, 1) * prefetch:
+                scan = next(scans, None)
+                if scan is None:
+                    break
+                loading.append((loader.submit(load_volume, scan[0], side_len=side_len), *scan))
+            if len(loading) == 0:
+                break
+            volume_future, scan_path, result_path = loading.popleft()
+            try:
+                volume = volume_future.result()
+            except Exception as error:
+                record_error(scan_path, error)
+                progress_bar.update(1)
+                continue
+            in_flight.acquire()
+            try:
+                future = engine.submit(volume, threshold=threshold, output=output, side_len=side_len, stride=stride)
+            except BaseException:
+                in_flight.release()
+                raise
+            writer.submit(write, future, scan_path, result_path).add_done_callback(lambda _: progress_bar.update(1))
+    finally:
+        loader.shutdown(cancel_futures=True)
+        # Results of submitted scans are written before returning, also if interrupted
+        writer.shutdown(wait=True)
+        progress_bar.close()
+    print('Predicted {predicted} scans, skipped {skipped} finished scans, {failed} scans failed'.format(**statistics))
+    return statistics
@@ -25,9 +25,9 @@ class DiceLoss(nn.Module):
         :param label: (torch.tensor) Label tensor (one-hot encoded)
         :return: (torch.tensor) Dice loss
         '''
-        # Flatten prediction and label
-        prediction = prediction.view(-1)
-        label = label.view(-1)
+        # Flatten prediction and label (reductions are performed in float32)
+        prediction = prediction.float().view(-1)
+        label = label.float().view(-1)
         # Calc intersection
         intersect = torch.sum((prediction * label)) + self.smooth
         # Calc union
@@ -65,10 +65,56 @@ class FocalLoss(nn.Module):
         :param label: (torch.tensor) Label tensor (one-hot encoded)
         :return: (torch.tensor) Dice loss
         '''
+        # Loss is computed in float32 since (1 - p) ** gamma is not stable in reduced precision
+        prediction = prediction.float()
+        label = label.float()
         # Calc binary cross entropy loss
         cross_entropy_loss = F.binary_cross_entropy(prediction, label, reduction='none')
         # Calc focal loss
-        focal_loss = self.alpha * (1.0 - prediction) ** self.gamma * cross_entropy_loss
+        focal_loss = self.alpha * (1.0 - prediction).clamp(min=0.0) ** self.gamma * cross_entropy_loss
+        # Reduce loss
+        if self.reduce == 'mean':
+            focal_loss = torch.mean(focal_loss)
+        elif self.reduce == 'sum':
+            focal_loss = torch.sum(focal_loss)
+        return focal_loss
+
+
+class DiceLossWithLogits(DiceLoss):
+    '''
+    Implementation of the dice loss for logits as an input
+    '''
+
+    def forward(self, prediction: torch.Tensor, label: torch.Tensor) -> torch.Tensor:
+        '''
+        Forward method calculates the dice loss
+        :param prediction: (torch.tensor) Prediction tensor including logits
+        :param label: (torch.tensor) Label tensor (one-hot encoded)
+        :return: (torch.tensor) Dice loss
+        '''
+        return super(DiceLossWithLogits, self).forward(torch.sigmoid(prediction.float()), label)
+
+
+class FocalLossWithLogits(FocalLoss):
+    '''
+    Implementation of the binary focal loss for logits as an input. Cross entropy and focal factor are computed in log
+    space, which is stable for saturated predictions.
+    '''
+
+    def forward(self, prediction: torch.Tensor, label: torch.Tensor) -> torch.Tensor:
+        '''
+        Forward method calculates the focal loss
+        :param prediction: (torch.tensor) Prediction tensor including logits
+        :param label: (torch.tensor) Label tensor (one-hot encoded)
+        :return: (torch.tensor) Focal loss
+        '''
+        # Loss is computed in float32
+        prediction = prediction.float()
+        label = label.float()
+        # Calc binary cross entropy loss
+        cross_entropy_loss = F.binary_cross_entropy_with_logits(prediction, label, reduction='none')
+        # Calc focal loss by (1 - sigmoid(x)) ** gamma = exp(gamma * log(sigmoid(-x)))
+        focal_loss = self.alpha * torch.exp(self.gamma * F.logsigmoid(-prediction)) * cross_entropy_loss
         # Reduce loss
         if self.reduce == 'mean':
             focal_loss = torch.mean(focal_loss)
@@ -0,0 +1,215 @@
+from typing import Any, Dict, List
+
+import torch
+import os
+import gc
+import json
+import time
+import resource
+
+
+def get_process_memory_mb(pid: int = None) -> Dict[str, float]:
+    """
+    Function returns the current and the peak resident set size of a process. Values are read from /proc, so they are
+    only available on linux. For the current process the peak falls back to getrusage on other systems.
+    :param pid: (int) Process id (default=None uses the current process)
+    :return: (Dict[str, float]) Current (rss_mb) and peak (peak_rss_mb) resident set size in MB, empty if the process
+    does not exist anymore
+    """
+    path = '/proc/{}/status'.format('self' if pid is None else pid)
+    memory = dict()
+    try:
+        with open(path, 'r') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    memory['rss_mb'] = int(line.split()[1]) / 2 ** 10
+                elif line.startswith('VmHWM:'):
+                    memory['peak_rss_mb'] = int(line.split()[1]) / 2 ** 10
+    except OSError:
+        # Process has exited or /proc is not available
+        if pid is None:
+            # Max rss is given in kB on linux and in bytes on macOS
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            memory['peak_rss_mb'] = max_rss / 2 ** (20 if os.uname().sysname == 'Darwin' else 10)
+    return memory
+
+
+def get_child_pids(pid: int = None) -> List[int]:
+    """
+    Function returns the process ids of all child processes, e.g. the workers of dataloaders
+    :param pid: (int) Process id of the parent (default=None uses the current process)
+    :return: (List[int]) Process ids of the children (empty if /proc is not available)
+    """
+    pid = os.getpid() if pid is None else pid
+    child_pids = []
+    if not os.path.isdir('/proc'):
+        return child_pids
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry), 'r') as file:
+                # Command name in brackets can include spaces, parent id is the second field after it
+                parent_pid = int(file.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if parent_pid == pid:
+            child_pids.append(int(entry))
+    return child_pids
+
+
+def reset_peak_memory(device: str) -> None:
+    """
+    Function resets the peak memory counter of the given device. On cpu the peak resident set size (VmHWM) of the
+    process is reset, which is supported by linux only.
+    :param device: (str) Device utilized
+    """
+    if 'cuda' in device:
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+    elif os.path.exists('/proc/self/clear_refs'):
+        try:
+            with open('/proc/self/clear_refs', 'w') as file:
+                file.write('5')
+        except OSError:
+            pass
+
+
+def get_peak_memory_mb(device: str) -> float:
+    """
+    Function returns the peak memory since the last reset. On cpu this is the peak resident set size of the process
+    including the memory allocated before the reset.
+    :param device: (str) Device utilized
+    :return: (float) Peak memory in MB (None if not available)
+    """
+    if 'cuda' in device:
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return get_process_memory_mb().get('peak_rss_mb')
+
+
+def get_allocator_stats(device: str) -> Dict[str, float]:
+    """
+    Function returns statistics of the caching allocator of a cuda device. Cpu allocations are covered by the resident
+    set size of the process.
+    :param device: (str) Device utilized
+    :return: (Dict[str, float]) Allocated, reserved and peak allocated memory in MB and the number of allocation
+    retries (empty for cpu)
+    """
+    if 'cuda' not in device or not torch.cuda.is_available():
+        return dict()
+    stats = torch.cuda.memory_stats(device)
+    return dict(cuda_allocated_mb=stats.get('allocated_bytes.all.current', 0) / 2 ** 20,
+                cuda_reserved_mb=stats.get('reserved_bytes.all.current', 0) / 2 ** 20,
+                cuda_peak_allocated_mb=stats.get('allocated_bytes.all.peak', 0) / 2 ** 20,
+                cuda_alloc_retries=float(stats.get('num_alloc_retries', 0)))
+
+
+def get_largest_tensors(number_of_tensors: int = 5) -> List[Dict[str, Any]]:
+    """
+    Function finds the largest tensors referenced by python objects. Views sharing a storage are counted once.
+    Tensors only referenced by autograd (saved activations) are not found.
+    :param number_of_tensors: (int) Number of tensors to return
+    :return: (List[Dict[str, Any]]) Shape, dtype, device and size in MB of the largest tensors
+    """
+    storages = dict()
+    for obj in gc.get_objects():
+        # Type is checked without isinstance, which accesses attributes of deprecated module proxies
+        if not issubclass(type(obj), torch.Tensor):
+            continue
+        try:
+            if obj.is_sparse:
+                continue
+            storage = obj.untyped_storage()
+            key = (storage.data_ptr(), str(obj.device))
+            size = storage.nbytes()
+        except (RuntimeError, NotImplementedError, ReferenceError):
+            # Meta tensors, tensors without storage or freed weak references
+            continue
+        # Shape of the tensor with the most elements is reported for a storage
+        if key not in storages or obj.numel() > storages[key][0]:
+            storages[key] = (obj.numel(), dict(shape=list(obj.shape), dtype=str(obj.dtype), device=str(obj.device),
+                                               size_mb=size / 2 ** 20))
+    tensors = [tensor for _, tensor in storages.values()]
+    return sorted(tensors, key=lambda tensor: tensor['size_mb'], reverse=True)[:number_of_tensors]
+
+
+class MemoryMonitor(object):
+    """
+    Class records the memory usage of phases (e.g. train, validate and test). For every phase the current and the peak
+    resident set size of the main process and of its dataloader workers, statistics of the cuda allocator and the
+    largest live tensors are recorded. Worker processes are sampled during the phase, since they exit with the
+    iteration of their dataloader.
+    """
+
+    def __init__(self, device: str = 'cpu', path: str = None, number_of_tensors: int = 5,
+                 sample_interval: float = 1.0, enabled: bool = True) -> None:
+        """
+        Constructor method
+        :param device: (str) Device utilized
+        :param path: (str) Path of a json lines file to append the record of every phase to, including the largest
+        tensors (default=None)
+        :param number_of_tensors: (int) Number of largest tensors recorded
+        :param sample_interval: (float) Minimal time in seconds between two samples of the worker processes
+        :param enabled: (bool) If false all methods do nothing
+        """
+        self.enabled = enabled
+        self.device = device
+        self.path = path
+        self.number_of_tensors = number_of_tensors
+        self.sample_interval = sample_interval
+        # Maxima of the current phase
+        self.phase_name = None
+        self.workers = dict()
+        self.last_sample = 0.0
+
+    def start(self, phase_name: str) -> None:
+        """
+        Method starts a phase and resets the peak memory counters
+        :param phase_name: (str) Name of the phase
+        """
+        if not self.enabled:
+            return
+        self.phase_name = phase_name
+        self.workers = dict(workers_rss_mb=0.0, workers_peak_rss_mb=0.0, number_of_workers=0.0)
+        self.last_sample = 0.0
+        reset_peak_memory('cpu')
+        if 'cuda' in self.device and torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def sample(self) -> None:
+        """
+        Method samples the memory of worker processes, calls within the sample interval are skipped
+        """
+        if self.phase_name is None or time.perf_counter() - self.last_sample < self.sample_interval:
+            return
+        self.last_sample = time.perf_counter()
+        workers = [get_process_memory_mb(pid) for pid in get_child_pids()]
+        workers = [worker for worker in workers if 'rss_mb' in worker]
+        self.workers['workers_rss_mb'] = max(self.workers['workers_rss_mb'],
+                                             sum(worker['rss_mb'] for worker in workers))
+        self.workers['workers_peak_rss_mb'] = max([self.workers['workers_peak_rss_mb']]
+                                                  + [worker['peak_rss_mb'] for worker in workers])
+        self.workers['number_of_workers'] = max(self.workers['number_of_workers'], float(len(workers)))
+
+    def stop(self) -> Dict[str, float]:
+        """
+        Method ends the current phase
+        :return: (Dict[str, float]) Current and peak rss of the main process, maximal summed rss of all workers, peak
+        rss of the largest worker, number of workers, allocator statistics and size of the largest tensor in MB (empty
+        if disabled)
+        """
+        if not self.enabled or self.phase_name is None:
+            return dict()
+        self.sample()
+        memory = get_process_memory_mb()
+        memory.update(self.workers)
+        memory.update(get_allocator_stats(self.device))
+        largest_tensors = get_largest_tensors(self.number_of_tensors)
+        memory['largest_tensor_mb'] = largest_tensors[0]['size_mb'] if len(largest_tensors) > 0 else 0.0
+        # Save record including the largest tensors
+        if self.path is not None:
+            with open(self.path, 'a') as file:
+                file.write(json.dumps(dict(phase=self.phase_name, time=time.time(), memory=memory,
+                                           largest_tensors=largest_tensors)) + '\n')
+        self.phase_name = None
+        return memory
@@ -0,0 +1,226 @@
+from typing import Dict, List
+
+import numpy as np
+import os
+
+
+def load_metric(path: str, metric_name: str) -> np.ndarray:
+    """
+    Function loads all values of a metric saved by a MetricStore as a memory mapped array
+    :param path: (str) Folder of the metric store
+    :param metric_name: (str) Name of the metric
+    :return: (np.ndarray) Values of the metric
+    """
+    file_name = os.path.join(path, metric_name + '.f64')
+    if os.path.getsize(file_name) == 0:
+        return np.zeros(0, dtype='<f8')
+    return np.memmap(file_name, dtype='<f8', mode='r')
+
+
+def load_epoch_offsets(path: str, metric_name: str) -> np.ndarray:
+    """
+    Function loads the epoch offsets of a metric saved by a MetricStore
+    :param path: (str) Folder of the metric store
+    :param metric_name: (str) Name of the metric
+    :return: (np.ndarray) Array of shape (epochs, 2) including the epoch and the index of its first value
+    """
+    file_name = os.path.join(path, metric_name + '.epochs.i64')
+    if not os.path.exists(file_name) or os.path.getsize(file_name) == 0:
+        return np.zeros((0, 2), dtype='<i8')
+    return np.fromfile(file_name, dtype='<i8').reshape(-1, 2)
+
+
+def load_epoch_averages(path: str, metric_name: str) -> np.ndarray:
+    """
+    Function calculates the average of a metric for every epoch in one vectorized pass
+    :param path: (str) Folder of the metric store
+    :param metric_name: (str) Name of the metric
+    :return: (np.ndarray) Array of shape (epochs, 2) including the epoch and the average metric
+    """
+    values = load_metric(path, metric_name)
+    offsets = load_epoch_offsets(path, metric_name)
+    if values.shape[0] == 0:
+        return np.zeros((0, 2), dtype='<f8')
+    # Sum up values between the epoch offsets
+    sums = np.add.reduceat(values, offsets[:, 1])
+    counts = np.diff(np.append(offsets[:, 1], values.shape[0]))
+    return np.stack((offsets[:, 0].astype('<f8'), sums / counts), axis=1)
+
+
+class MetricStore(object):
+    """
+    Append-only columnar store of metrics. Every metric is saved as raw little endian float64 values in one file
+    (<name>.f64), which can be read with load_metric or np.fromfile. The first index of each epoch is saved in a second
+    file (<name>.epochs.i64). Values are buffered and appended to the files incrementally, so no history is rewritten.
+    """
+
+    def __init__(self, path: str, flush_every: int = 1024) -> None:
+        """
+        Constructor method
+        :param path: (str) Folder to save metrics. Existing metrics in this folder are continued.
+        :param flush_every: (int) Number of buffered values of one metric after which the values are written to disk
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self.epoch = 0
+        # Values and epoch offsets not written to disk yet
+        self.buffers = dict()
+        self.offset_buffers = dict()
+        # Number of values, last epoch and running sums (sum, count) per metric and epoch
+        self.lengths = dict()
+        self.last_epochs = dict()
+        self.sums = dict()
+        self.epoch_sums = dict()
+        # Make folder
+        if not os.path.exists(path):
+            os.makedirs(path)
+        # Continue existing metrics
+        for file_name in sorted(os.listdir(path)):
+            if file_name.endswith('.f64'):
+                self.load_state(file_name[:-len('.f64')])
+
+    def restore(self, path: str, lengths: Dict[str, int]) -> None:
+        """
+        Method restores the metrics of another store truncated to the given lengths, e.g. when resuming a training
+        :param path: (str) Folder of the metric store to restore
+        :param lengths: (Dict[str, int]) Number of values to restore per metric
+        """
+        for metric_name, length in lengths.items():
+            values = load_metric(path, metric_name)[:length]
+            offsets = load_epoch_offsets(path, metric_name)
+            offsets = offsets[offsets[:, 1] < length]
+            with open(os.path.join(self.path, metric_name + '.f64'), 'wb') as file:
+                file.write(np.asarray(values, dtype='<f8').tobytes())
+            with open(os.path.join(self.path, metric_name + '.epochs.i64'), 'wb') as file:
+                file.write(np.asarray(offsets, dtype='<i8').tobytes())
+            self.load_state(metric_name)
+
+    def load_state(self, metric_name: str) -> None:
+        """
+        Method restores the running sums and lengths of a metric saved on disk
+        :param metric_name: (str) Name of the metric
+        """
+        values = load_metric(self.path, metric_name)
+        offsets = load_epoch_offsets(self.path, metric_name)
+        self.buffers[metric_name] = []
+        self.offset_buffers[metric_name] = []
+        self.lengths[metric_name] = int(values.shape[0])
+        self.sums[metric_name] = [float(np.sum(values)), int(values.shape[0])]
+        self.epoch_sums[metric_name] = dict()
+        self.last_epochs[metric_name] = None
+        if values.shape[0] > 0:
+            averages = load_epoch_averages(self.path, metric_name)
+            counts = np.diff(np.append(offsets[:, 1], values.shape[0]))
+            for (epoch, average), count in zip(averages, counts):
+                self.epoch_sums[metric_name][int(epoch)] = [float(average * count), int(count)]
+            self.last_epochs[metric_name] = int(offsets[-1, 0])
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Method sets the epoch assigned to appended values
+        :param epoch: (int) Current epoch
+        """
+        self.epoch = epoch
+
+    def append(self, metric_name: str, value: float, epoch: int = None) -> None:
+        """
+        Method appends a value to a metric in O(1)
+        :param metric_name: (str) Name of the metric
+        :param value: (float) Value of the metric
+        :param epoch: (int) Epoch of the value (default=None uses the current epoch)
+        """
+        if epoch is None:
+            epoch = self.epoch
+        if metric_name not in self.lengths:
+            self.buffers[metric_name] = []
+            self.offset_buffers[metric_name] = []
+            self.lengths[metric_name] = 0
+            self.sums[metric_name] = [0.0, 0]
+            self.epoch_sums[metric_name] = dict()
+            self.last_epochs[metric_name] = None
+        # Save offset if value is the first one of a new epoch
+        if self.last_epochs[metric_name] != epoch:
+            self.offset_buffers[metric_name].extend([epoch, self.lengths[metric_name]])
+            self.last_epochs[metric_name] = epoch
+        # Append value
+        self.buffers[metric_name].append(value)
+        self.lengths[metric_name] += 1
+        # Update running sums
+        self.sums[metric_name][0] += value
+        self.sums[metric_name][1] += 1
+        epoch_sum = self.epoch_sums[metric_name].setdefault(epoch, [0.0, 0])
+        epoch_sum[0] += value
+        epoch_sum[1] += 1
+        # Write to disk if buffer is full
+        if len(self.buffers[metric_name]) >= self.flush_every:
+            self.flush_metric(metric_name)
+
+    def flush_metric(self, metric_name: str) -> None:
+        """
+        Method appends the buffered values of a metric to its files
+        :param metric_name: (str) Name of the metric
+        """
+        with open(os.path.join(self.path, metric_name + '.f64'), 'ab') as file:
+            file.write(np.asarray(self.buffers[metric_name], dtype='<f8').tobytes())
+        self.buffers[metric_name] = []
+        if len(self.offset_buffers[metric_name]) > 0:
+            with open(os.path.join(self.path, metric_name + '.epochs.i64'), 'ab') as file:
+                file.write(np.asarray(self.offset_buffers[metric_name], dtype='<i8').tobytes())
+            self.offset_buffers[metric_name] = []
+
+    def flush(self) -> None:
+        """
+        Method appends the buffered values of all metrics to their files
+        """
+        for metric_name in self.lengths.keys():
+            self.flush_metric(metric_name)
+
+    def __contains__(self, metric_name: str) -> bool:
+        """
+        Checks if a metric is included in the store
+        :param metric_name: (str) Name of the metric
+        :return: (bool) True if metric is present
+        """
+        return metric_name in self.lengths
+
+    def get_values(self, metric_name: str) -> np.ndarray:
+        """
+        Method returns all values of a metric
+        :param metric_name: (str) Name of the metric
+        :return: (np.ndarray) Values of the metric
+        """
+        self.flush_metric(metric_name)
+        return load_metric(self.path, metric_name)
+
+    def get_average(self, metric_name: str) -> float:
+        """
+        Method returns the average of a metric in O(1)
+        :param metric_name: (str) Name of the metric
+        :return: (float) Average metric
+        """
+        metric_sum, count = self.sums[metric_name]
+        return metric_sum / count if count > 0 else float('nan')
+
+    def get_average_for_epoch(self, metric_name: str, epoch: int) -> float:
+        """
+        Method returns the average of a metric for a given epoch in O(1)
+        :param metric_name: (str) Name of the metric
+        :param epoch: (int) Epoch to average over
+        :return: (float) Average metric
+        """
+        metric_sum, count = self.epoch_sums[metric_name].get(epoch, [0.0, 0])
+        return metric_sum / count if count > 0 else float('nan')
+
+    def get_lengths(self) -> Dict[str, int]:
+        """
+        Method returns the number of values of every metric
+        :return: (Dict[str, int]) Number of values per metric
+        """
+        return dict(self.lengths)
+
+    def get_metric_names(self) -> List[str]:
+        """
+        Method returns the names of all metrics
+        :return: (List[str]) Metric names
+        """
+        return list(self.lengths.keys())
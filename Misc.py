@@ -9,6 +9,22 @@ from pykdtree.kdtree import KDTree
 import ModelParts
 
 
+def get_occupancy_labels(coordinates: torch.Tensor, label: torch.Tensor) -> torch.Tensor:
+    """
+    Estimates which coordinates belong to a weapon by querying a kd tree of the high resolution label.
+    Works only with one batch!
+    :param coordinates: (torch.tensor) Input coordinates of the O-Net (samples, 3)
+    :param label: (torch.tensor) High resolution label including only ones (samples, 3)
+    :return: (torch.tensor) Bool tensor of shape (samples), true if coordinate belongs to a weapon
+    """
+    # Init kd tree
+    kd_tree = KDTree(label.cpu().numpy(), leafsize=16)
+    # Estimate which coordinates are weapons
+    dist_coordinates_to_label, _ = kd_tree.query(coordinates.cpu().numpy(), k=1)
+    del _  # Help the python garbage collector
+    return torch.from_numpy(dist_coordinates_to_label == 0.0).to(coordinates.device)
+
+
 def intersection_over_union_bounding_box(prediction: torch.Tensor, coordinates: torch.Tensor, label: torch.Tensor,
                                          threshold: float = 0.5,
                                          offset: torch.Tensor = torch.tensor([0.0, 0.0, 0.0])) -> torch.Tensor:
@@ -22,14 +38,27 @@ def intersection_over_union_bounding_box(prediction: torch.Tensor, coordinates:
     :param offset: (torch.Tensor) Bounding box offset used and added to the predicted bounding box
     :return: (torch.tensor) Intersection over union value
     """
-    # Init kd tree
-    kd_tree = KDTree(label.cpu().numpy(), leafsize=16)
-    # Estimate which coordinates are weapons
-    dist_coordinates_to_label, _ = kd_tree.query(coordinates.cpu().numpy(), k=1)
-    del _  # Help the python garbage collector
-    dist_coordinates_to_label = torch.from_numpy(dist_coordinates_to_label).to(prediction.device)
+    return intersection_over_union_bounding_box_from_labels(
+        prediction, coordinates, get_occupancy_labels(coordinates, label).to(prediction.device), threshold=threshold,
+        offset=offset)
+
+
+def intersection_over_union_bounding_box_from_labels(prediction: torch.Tensor, coordinates: torch.Tensor,
+                                                     occupancy_labels: torch.Tensor, threshold: float = 0.5,
+                                                     offset: torch.Tensor = torch.tensor([0.0, 0.0, 0.0])) \
+        -> torch.Tensor:
+    """
+    Calculates the intersection over union of the predicted bounding box with precomputed occupancy labels.
+    Works only with one batch!
+    :param prediction: (torch.tensor) Raw prediction of the O-Net (samples)
+    :param coordinates: (torch.tensor) Input coordinates of the O-Net (samples, 3)
+    :param occupancy_labels: (torch.tensor) Occupancy of each coordinate (samples), see get_occupancy_labels
+    :param threshold: (float) Threshold for prediction (default=0.5)
+    :param offset: (torch.Tensor) Bounding box offset used and added to the predicted bounding box
+    :return: (torch.tensor) Intersection over union value
+    """
     # Estimate which coordinates belongs to a weapon
-    coordinates_label = coordinates[dist_coordinates_to_label == 0.0]  # 1 if weapon 0 if not
+    coordinates_label = coordinates[occupancy_labels.view(-1).bool()]  # 1 if weapon 0 if not
     if coordinates.shape[0] == 0:
         return torch.tensor([1]), torch.tensor([0, 0, 0]), torch.tensor([0, 0, 0])
     # Get max and min coordinates for bounding box
@@ -78,14 +107,22 @@ def intersection_over_union(prediction: torch.tensor, coordinates: torch.tensor,
     :param threshold: (float) Threshold for prediction (default=0.5)
     :return: (torch.tensor) Intersection over union value
     """
-    # Init kd tree
-    kd_tree = KDTree(label.cpu().numpy(), leafsize=16)
-    # Estimate which coordinates are weapons
-    dist_coordinates_to_label, _ = kd_tree.query(coordinates.cpu().numpy(), k=1)
-    del _  # Help the python garbage collector
-    dist_coordinates_to_label = torch.from_numpy(dist_coordinates_to_label).to(prediction.device)
+    return intersection_over_union_from_labels(
+        prediction, get_occupancy_labels(coordinates, label).to(prediction.device), threshold=threshold)
+
+
+def intersection_over_union_from_labels(prediction: torch.tensor, occupancy_labels: torch.tensor,
+                                        threshold: float = 0.5) -> torch.tensor:
+    """
+    Calculates the intersection over union for a given prediction and precomputed occupancy labels.
+    Works only with one batch!
+    :param prediction: (torch.tensor) Raw prediction of the O-Net (samples)
+    :param occupancy_labels: (torch.tensor) Occupancy of each coordinate (samples), see get_occupancy_labels
+    :param threshold: (float) Threshold for prediction (default=0.5)
+    :return: (torch.tensor) Intersection over union value
+    """
     # Estimate which coordinates belongs to a weapon
-    coordinates_label = (dist_coordinates_to_label == 0.0).float()  # 1 if weapon 0 if not
+    coordinates_label = occupancy_labels.view(-1).float()  # 1 if weapon 0 if not
     # Reshape prediction to one dimension
     prediction = prediction.view(-1)
     # Apply threshold
@@ -99,6 +136,45 @@ def intersection_over_union(prediction: torch.tensor, coordinates: torch.tensor,
     return iou
 
 
+def intersection_over_union_boxes(box_prediction: np.ndarray, box_label: np.ndarray) -> float:
+    """
+    Calculates the intersection over union of two axis aligned bounding boxes
+    :param box_prediction: (np.ndarray) Min and max coordinates of the predicted box (2, 3) or None if empty
+    :param box_label: (np.ndarray) Min and max coordinates of the label box (2, 3) or None if empty
+    :return: (float) Intersection over union value (one if both boxes are empty)
+    """
+    if box_prediction is None or box_label is None:
+        return float(box_prediction is None and box_label is None)
+    box_prediction = np.asarray(box_prediction, dtype=np.float64)
+    box_label = np.asarray(box_label, dtype=np.float64)
+    intersection = np.prod(np.clip(np.minimum(box_prediction[1], box_label[1])
+                                   - np.maximum(box_prediction[0], box_label[0]), 0.0, None))
+    union = np.prod(box_prediction[1] - box_prediction[0]) + np.prod(box_label[1] - box_label[0]) - intersection
+    return float(intersection / union) if union > 0 else float(np.array_equal(box_prediction, box_label))
+
+
+def get_autocast(device: str, precision: str = 'float32') -> torch.autocast:
+    """
+    Method returns an autocast context for the given device and precision. For float32 the context is disabled so the
+    existing code paths stay unchanged.
+    :param device: (str) Device utilized ('cpu' or 'cuda')
+    :param precision: (str) Precision to use ('float32' or 'bfloat16')
+    :return: (torch.autocast) Autocast context manager
+    """
+    assert precision in ['float32', 'bfloat16'], 'Precision {} is not available!'.format(precision)
+    return torch.autocast(device_type='cuda' if 'cuda' in device else 'cpu', dtype=torch.bfloat16,
+                          enabled=precision == 'bfloat16')
+
+
+def probability_to_logit(probability: float) -> float:
+    """
+    Method converts a probability threshold into the corresponding threshold in logit space
+    :param probability: (float) Probability in (0, 1)
+    :return: (float) Logit of the probability
+    """
+    return float(np.log(probability / (1.0 - probability)))
+
+
 def get_tensor_size_mb(tensor: torch.Tensor):
     """
     Method that calculates the megabyte needed for a tensor to be stored. Takes into account if tensor is on CPU or GPU.
@@ -300,91 +376,290 @@ def many_to_one_collate_fn_sample_down(batch):
     return volumes, coords, labels, low_volumes
 
 
-def draw_test(locs, actual, volume, side_len: int, batch_index: int, draw_out_path: str = 'obj') -> None:
-    draw_out_path = os.path.join(os.getcwd(), draw_out_path)
-    if not os.path.exists(draw_out_path):
-        os.mkdir(draw_out_path)
-
-    if batch_index % 25 != 0:
-        return
-
-    to_write = locs.cpu().numpy().astype(np.short)
-    # Only each 10th as meshlab crashes otherwise
-    to_write_act = actual[::10, :].cpu().numpy().astype(np.short)  # actual[::10,:]
-    # Mean (shape) centering
-    mean = np.array([volume.shape[2] * side_len / 2, volume.shape[3] * side_len / 2, volume.shape[4] * side_len / 2])
-    to_write_act = to_write_act - mean
-    to_write = to_write - mean  # np.mean(to_write, axis=0)
+def get_random_seed() -> int:
+    """
+    Function draws a random seed without changing the random number generators. In distributed training the seed of
+    rank 0 is broadcast, so all processes get the same seed.
+    :return: (int) Seed
+    """
+    seed = torch.tensor([int.from_bytes(os.urandom(4), 'little') >> 1], dtype=torch.int64)
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        # Nccl only broadcasts cuda tensors
+        if torch.distributed.get_backend() == 'nccl':
+            seed = seed.cuda()
+        torch.distributed.broadcast(seed, src=0)
+    return int(seed.item())
 
-    # print(locs.shape, to_write.shape, actual.shape, to_write_act.shape)
 
-    with open(os.path.join(draw_out_path, str(batch_index) + '_outfile_pred.obj'), 'w') as f:
-        for line in to_write:
-            f.write("v " + " " + str(line[0]) + " " + str(line[1]) + " " + str(line[2]) +
-                    " " + "0.5" + " " + "0.5" + " " + "1.0" + "\n")
-        # for line in to_write_act:
-        #     f.write("v " + " " + str(line[0]) + " " + str(line[1]) + " " + str(line[2]) + 
-        #     " " + "0.19" + " " + "0.8" + " " + "0.19" + "\n")
+class ResumableRandomSampler(torch.utils.data.Sampler):
+    """
+    Random sampler with a permutation seeded by the epoch, which can be resumed at any position within an epoch. If
+    multiple replicas are used (distributed training) each replica gets an equally sized shard of the permutation.
+    """
 
-        # Corners of volume
-        f.write("v " + " " + "0" + " " + "0" + " " + "0" +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
+    def __init__(self, data_source: torch.utils.data.Dataset, seed: int = None, num_replicas: int = 1,
+                 rank: int = 0) -> None:
+        """
+        Constructor method
+        :param data_source: (torch.utils.data.Dataset) Dataset to sample from
+        :param seed: (int) Base seed of the permutations, has to be equal for all replicas (default=None draws a random
+        seed, see get_random_seed, the seed is saved in checkpoints to resume a training exactly)
+        :param num_replicas: (int) Number of processes in distributed training
+        :param rank: (int) Rank of the current process
+        """
+        self.data_source = data_source
+        self.seed = get_random_seed() if seed is None else seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start_index = 0
+        # Number of samples of each replica, permutation is padded to be evenly divisible
+        self.num_samples = int(np.ceil(len(self.data_source) / self.num_replicas))
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Method sets the epoch utilized to seed the permutation
+        :param epoch: (int) Epoch
+        """
+        self.epoch = epoch
 
-        f.write("v " + " " + str(volume.shape[2] * side_len) + " " + "0" + " " + "0" +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
+    def set_start_index(self, start_index: int) -> None:
+        """
+        Method sets the position within the permutation (shard) of the next iteration
+        :param start_index: (int) Number of samples to skip
+        """
+        self.start_index = start_index
 
-        f.write("v " + " " + str(volume.shape[2] * side_len) + " " + str(volume.shape[3] * side_len) + " " + "0" +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        permutation = torch.randperm(len(self.data_source), generator=generator).tolist()
+        # Pad and shard permutation
+        permutation += permutation[:self.num_samples * self.num_replicas - len(permutation)]
+        permutation = permutation[self.rank::self.num_replicas]
+        start_index = self.start_index
+        # Following iterations start at the beginning of the permutation again
+        self.start_index = 0
+        return iter(permutation[start_index:])
 
-        f.write("v " + " " + "0" + " " + str(volume.shape[3] * side_len) + " " + "0" +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
+    def __len__(self) -> int:
+        return self.num_samples - self.start_index
 
-        f.write("v " + " " + "0" + " " + "0" + " " + str(volume.shape[4] * side_len) +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
 
-        f.write("v " + " " + str(volume.shape[2] * side_len) + " " + "0" + " " + str(volume.shape[4] * side_len) +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
+class ShardSampler(torch.utils.data.Sampler):
+    """
+    Sequential sampler returning every num_replicas-th sample starting at rank, used for distributed evaluation
+    """
 
-        f.write("v " + " " + str(volume.shape[2] * side_len) + " " + str(volume.shape[3] * side_len) + " " + str(
-            volume.shape[4] * side_len) +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
+    def __init__(self, data_source: torch.utils.data.Dataset, num_replicas: int = 1, rank: int = 0) -> None:
+        """
+        Constructor method
+        :param data_source: (torch.utils.data.Dataset) Dataset to sample from
+        :param num_replicas: (int) Number of processes in distributed evaluation
+        :param rank: (int) Rank of the current process
+        """
+        self.data_source = data_source
+        self.num_replicas = num_replicas
+        self.rank = rank
 
-        f.write("v " + " " + "0" + " " + str(volume.shape[3] * side_len) + " " + str(volume.shape[4] * side_len) +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
+    def __iter__(self):
+        return iter(range(self.rank, len(self.data_source), self.num_replicas))
 
-    with open(os.path.join(draw_out_path, str(batch_index) + '_outfile_label.obj'), 'w') as f:
-        # for line in to_write:
-        #     f.write("v " + " " + str(line[0]) + " " + str(line[1]) + " " + str(line[2]) + 
-        #         " " + "0.5" + " " + "0.5" + " " + "1.0" + "\n")
-        for line in to_write_act:
-            f.write("v " + " " + str(line[0]) + " " + str(line[1]) + " " + str(line[2]) +
-                    " " + "0.19" + " " + "0.8" + " " + "0.19" + "\n")
+    def __len__(self) -> int:
+        return len(range(self.rank, len(self.data_source), self.num_replicas))
 
-        # Corners of volume
-        f.write("v " + " " + "0" + " " + "0" + " " + "0" +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
 
-        f.write("v " + " " + str(volume.shape[2] * side_len) + " " + "0" + " " + "0" +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
+def voxel_downsample(points: np.ndarray, voxel_size: float, colors: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Function keeps one point per voxel of the given size, the first point of every voxel is kept
+    :param points: (np.ndarray) Points of shape (samples, 3)
+    :param voxel_size: (float) Edge length of the voxels (None or <= 1 keeps all integer points)
+    :param colors: (np.ndarray) Colors of the points of shape (samples, 3) (default=None)
+    :return: (Tuple[np.ndarray, np.ndarray]) Downsampled points and colors (None if no colors are given)
+    """
+    if voxel_size is None or voxel_size <= 1 or points.shape[0] == 0:
+        return points, colors
+    # Linear index of the voxel of every point, unique on one dimension is much faster than on rows
+    voxels = np.floor(points / voxel_size).astype(np.int64)
+    voxels -= voxels.min(axis=0)
+    keys = np.ravel_multi_index(voxels.T, voxels.max(axis=0) + 1)
+    # Index of the first point in every occupied voxel
+    _, indexes = np.unique(keys, return_index=True)
+    indexes = np.sort(indexes)
+    return points[indexes], colors[indexes] if colors is not None else None
+
+
+def get_connected_components(points: torch.Tensor, voxel_size: float = 1.0, connectivity: int = 26,
+                             min_size: int = 1) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Function groups points into instances by connected components of their occupied voxels. Voxels are identified by
+    a linear key, neighbors of all voxels are found at once by a binary search in the sorted keys and the components
+    are computed on the resulting edges by a vectorized union find (hooking of roots to the smaller root followed by
+    pointer jumping), so no python loop runs over voxels and the function also runs on the GPU.
+    :param points: (torch.Tensor) Points of shape (samples, 3), e.g. coordinates predicted as a weapon
+    :param voxel_size: (float) Edge length of the voxels, points in neighboring voxels are connected
+    :param connectivity: (int) Neighborhood of voxels (6 faces, 18 faces and edges or 26 including corners)
+    :param min_size: (int) Instances with fewer points are discarded (label -1)
+    :return: (Tuple[torch.Tensor, torch.Tensor, torch.Tensor]) Instance label of every point (samples), bounding box
+    (min and max) of every instance (instances, 2, 3) and number of points of every instance (instances), instances
+    are sorted by size in descending order
+    """
+    assert connectivity in [6, 18, 26], 'Connectivity {} is not available!'.format(connectivity)
+    device = points.device
+    if points.shape[0] == 0:
+        return torch.zeros(0, dtype=torch.long, device=device), torch.zeros(0, 2, 3, device=device), \
+            torch.zeros(0, dtype=torch.long, device=device)
+    # Voxels are shifted by one, so neighbors of all voxels are inside the padded grid and keys of neighbors are
+    # computed by adding the key of the offset
+    voxels = torch.floor(points / voxel_size).long()
+    voxels = voxels - voxels.min(dim=0)[0] + 1
+    shape = voxels.max(dim=0)[0] + 2
+    strides = torch.stack((shape[1] * shape[2], shape[2], torch.ones_like(shape[2])))
+    keys, inverse = torch.unique((voxels * strides).sum(dim=1), sorted=True, return_inverse=True)
+    # Half of the neighborhood, every edge is found once
+    offsets = torch.tensor([[x, y, z] for x in [-1, 0, 1] for y in [-1, 0, 1] for z in [-1, 0, 1]
+                            if (x, y, z) > (0, 0, 0) and abs(x) + abs(y) + abs(z) <= {6: 1, 18: 2, 26: 3}[connectivity]],
+                           device=device)
+    neighbor_keys = keys.view(-1, 1) + (offsets * strides).sum(dim=1).view(1, -1)
+    neighbors = torch.clamp(torch.searchsorted(keys, neighbor_keys), max=keys.shape[0] - 1)
+    connected = keys[neighbors] == neighbor_keys
+    sources = torch.arange(keys.shape[0], device=device).view(-1, 1).expand_as(neighbors)[connected]
+    targets = neighbors[connected]
+    # Vectorized union find, parents are always smaller or equal to their children
+    parents = torch.arange(keys.shape[0], device=device)
+    while True:
+        roots_sources = parents[sources]
+        roots_targets = parents[targets]
+        unmerged = roots_sources != roots_targets
+        if not unmerged.any():
+            break
+        # Hook the larger root of every unmerged edge to the smaller one
+        parents.scatter_reduce_(0, torch.max(roots_sources, roots_targets)[unmerged],
+                                torch.min(roots_sources, roots_targets)[unmerged], reduce='amin')
+        # Pointer jumping until every voxel points to its root
+        while True:
+            grand_parents = parents[parents]
+            if torch.equal(grand_parents, parents):
+                break
+            parents = grand_parents
+    # Consecutive instance label of every point
+    _, instances = torch.unique(parents, return_inverse=True)
+    labels = instances[inverse]
+    number_of_instances = int(labels.max()) + 1
+    sizes = torch.bincount(labels, minlength=number_of_instances)
+    # Sort instances by size
+    order = torch.argsort(sizes, descending=True)
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(number_of_instances, device=device)
+    labels = rank[labels]
+    sizes = sizes[order]
+    # Bounding box of every instance
+    index = labels.view(-1, 1).expand(-1, 3)
+    minimum = torch.full((number_of_instances, 3), float('inf'), device=device).scatter_reduce(
+        0, index, points.float(), reduce='amin')
+    maximum = torch.full((number_of_instances, 3), -float('inf'), device=device).scatter_reduce(
+        0, index, points.float(), reduce='amax')
+    boxes = torch.stack((minimum, maximum), dim=1)
+    # Discard small instances
+    number_of_instances = int((sizes >= min_size).sum())
+    labels[labels >= number_of_instances] = -1
+    return labels, boxes[:number_of_instances], sizes[:number_of_instances]
+
+
+def write_point_cloud(path: str, points: np.ndarray, colors: np.ndarray = None) -> None:
+    """
+    Function writes a point cloud with one bulk write. The format is chosen by the file extension: binary little
+    endian PLY (.ply), compressed numpy archive (.npz) or text OBJ with vertex colors (.obj).
+    :param path: (str) Path of the file
+    :param points: (np.ndarray) Points of shape (samples, 3)
+    :param colors: (np.ndarray) Colors in [0, 1] of shape (samples, 3) (default=None)
+    """
+    points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+    colors = np.asarray(colors, dtype=np.float32).reshape(-1, 3) if colors is not None else None
+    if path.endswith('.npz'):
+        arrays = dict(points=points) if colors is None else dict(points=points, colors=colors)
+        np.savez_compressed(path, **arrays)
+    elif path.endswith('.ply'):
+        # Vertices are saved as one structured array
+        dtype = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+        if colors is not None:
+            dtype += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+        vertices = np.empty(points.shape[0], dtype=dtype)
+        vertices['x'], vertices['y'], vertices['z'] = points[:, 0], points[:, 1], points[:, 2]
+        if colors is not None:
+            colors = np.round(np.clip(colors, 0.0, 1.0) * 255).astype(np.uint8)
+            vertices['red'], vertices['green'], vertices['blue'] = colors[:, 0], colors[:, 1], colors[:, 2]
+        header = ['ply', 'format binary_little_endian 1.0', 'element vertex {}'.format(points.shape[0]),
+                  'property float x', 'property float y', 'property float z']
+        if colors is not None:
+            header += ['property uchar red', 'property uchar green', 'property uchar blue']
+        header += ['end_header']
+        with open(path, 'wb') as file:
+            file.write(('\n'.join(header) + '\n').encode('ascii') + vertices.tobytes())
+    elif path.endswith('.obj'):
+        # Format all vertices at once
+        values = points if colors is None else np.concatenate((points, colors), axis=1)
+        line = 'v' + ' %g' * values.shape[1] + '\n'
+        with open(path, 'w') as file:
+            file.write((line * values.shape[0]) % tuple(values.ravel().tolist()))
+    else:
+        raise ValueError('Point cloud format of {} is not supported!'.format(path))
 
-        f.write("v " + " " + str(volume.shape[2] * side_len) + " " + str(volume.shape[3] * side_len) + " " + "0" +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
 
-        f.write("v " + " " + "0" + " " + str(volume.shape[3] * side_len) + " " + "0" +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
+def get_volume_corners(volume_shape: Tuple[int, ...], side_len: int) -> np.ndarray:
+    """
+    Function returns the corners of a volume in full resolution coordinates
+    :param volume_shape: (Tuple[int, ...]) Shape of the volume (batch size, channels, x, y, z)
+    :param side_len: (int) Downscale factor of the volume
+    :return: (np.ndarray) Corners of shape (8, 3)
+    """
+    size = np.array(volume_shape[2:5]) * side_len
+    return np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0], [0, 0, 1], [1, 0, 1], [1, 1, 1], [0, 1, 1]]) * size
 
-        f.write("v " + " " + "0" + " " + "0" + " " + str(volume.shape[4] * side_len) +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
 
-        f.write("v " + " " + str(volume.shape[2] * side_len) + " " + "0" + " " + str(volume.shape[4] * side_len) +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
+def draw_test(locs, actual, volume, side_len: int, batch_index: int, draw_out_path: str = 'obj',
+              draw_every: int = 25, file_format: str = 'obj', voxel_size: float = 2) -> None:
+    """
+    Function saves the predicted weapon points and the label points of a test scan, both files include the corners of
+    the volume. Points are centered by the center of the volume.
+    :param locs: (torch.Tensor) Coordinates predicted as weapon (samples, 3)
+    :param actual: (torch.Tensor) Coordinates of the label (samples, 3)
+    :param volume: (torch.Tensor) Input volume (1, channels, x, y, z)
+    :param side_len: (int) Downscale factor of the volume
+    :param batch_index: (int) Index of the scan used in the file names
+    :param draw_out_path: (str) Folder to save the files to
+    :param draw_every: (int) Only every n-th scan is saved (1 saves all scans)
+    :param file_format: (str) File format ('obj', 'ply' or 'npz'), npz saves prediction, label and corners into one
+    file
+    :param voxel_size: (float) Points are downsampled to one point per voxel of this size, so viewers like meshlab can
+    display dense labels (None keeps all points)
+    """
+    assert file_format in ['obj', 'ply', 'npz'], 'File format {} is not available!'.format(file_format)
+    draw_out_path = os.path.join(os.getcwd(), draw_out_path)
+    if not os.path.exists(draw_out_path):
+        os.makedirs(draw_out_path, exist_ok=True)
 
-        f.write("v " + " " + str(volume.shape[2] * side_len) + " " + str(volume.shape[3] * side_len) + " " + str(
-            volume.shape[4] * side_len) +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
+    if batch_index % draw_every != 0:
+        return
 
-        f.write("v " + " " + "0" + " " + str(volume.shape[3] * side_len) + " " + str(volume.shape[4] * side_len) +
-                " " + "1.0" + " " + "0.5" + " " + "0.5" + "\n")
+    to_write, _ = voxel_downsample(locs.cpu().numpy().astype(np.short), voxel_size)
+    to_write_act, _ = voxel_downsample(actual.cpu().numpy().astype(np.short), voxel_size)
+    # Mean (shape) centering
+    mean = np.array([volume.shape[2] * side_len / 2, volume.shape[3] * side_len / 2, volume.shape[4] * side_len / 2])
+    to_write_act = to_write_act - mean
+    to_write = to_write - mean
+    # Corners of volume
+    corners = get_volume_corners(volume.shape, side_len)
+
+    if file_format == 'npz':
+        np.savez_compressed(os.path.join(draw_out_path, str(batch_index) + '_outfile.npz'),
+                            prediction=to_write.astype(np.float32), label=to_write_act.astype(np.float32),
+                            corners=corners.astype(np.float32))
+        return
+    for name, points, color in [('pred', to_write, [0.5, 0.5, 1.0]), ('label', to_write_act, [0.19, 0.8, 0.19])]:
+        colors = np.concatenate((np.tile(color, (points.shape[0], 1)), np.tile([1.0, 0.5, 0.5], (8, 1))), axis=0)
+        write_point_cloud(os.path.join(draw_out_path, '{}_outfile_{}.{}'.format(batch_index, name, file_format)),
+                          np.concatenate((points, corners), axis=0), colors)
 
 
 def get_number_of_network_parameters(network: nn.Module) -> int:
@@ -402,7 +677,11 @@ class FilePermutation(object):
     Class to shuffle data files
     """
 
-    def __init__(self) -> None:
+    def __init__(self, path: str = '/fastdata/Smiths_LKA_Weapons_Down/len_8/') -> None:
+        """
+        Constructor method
+        :param path: (str) Folder including the label files (<index>_label.npy) to be considered
+        """
         self.permute = [756, 1796, 1918, 1115, 139, 1650, 1002, 1906, 519, 1250, 2655,
                         793, 999, 390, 1444, 1519, 2777, 843, 955, 2917, 784, 875,
                         1944, 2009, 2608, 1679, 1507, 202, 2912, 179, 2274, 1052, 2418,
@@ -676,9 +955,7 @@ class FilePermutation(object):
         # TODO: fix permutation
 
         # custom permutation that only considers files that are in the directory
-        import os
-        file_names = os.listdir(
-            "/fastdata/Smiths_LKA_Weapons_Down/len_8/")  # '/fastdata/Smiths_LKA_WeaponsDown/len_8/'
+        file_names = os.listdir(path)  # '/fastdata/Smiths_LKA_WeaponsDown/len_8/'
         ending = '_label.npy'
         permutation = []
         for file_name in file_names:
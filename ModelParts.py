@@ -196,12 +196,10 @@ class ConditionalBatchNorm1d(nn.Module):
         beta = self.linear_beta(latent_vector)
         # Perform normalization
         output_normalized = self.normalization(input)
-        # Repeat gamma and beta to apply factors to every coordinate
-        gamma = torch.repeat_interleave(gamma, int(output_normalized.shape[0] / gamma.shape[0]), dim=0)
-        beta = torch.repeat_interleave(beta, int(output_normalized.shape[0] / beta.shape[0]), dim=0)
-        # Add factors
-        output = gamma * output_normalized + beta
-        return output
+        # Apply factors to every coordinate of the corresponding volume by broadcasting
+        output = output_normalized.view(gamma.shape[0], -1, gamma.shape[1]) * gamma.unsqueeze(dim=1) \
+                 + beta.unsqueeze(dim=1)
+        return output.view(-1, gamma.shape[1])
 
 
 class InstanceNorm1d(nn.Module):
@@ -209,9 +207,14 @@ class InstanceNorm1d(nn.Module):
     Implementation of instance normalization for a 2D tensor of shape (batch size, features)
     """
 
-    def __init__(self) -> None:
+    def __init__(self, eps: float = 1e-05) -> None:
         # Call super constructor
         super(InstanceNorm1d, self).__init__()
+        # Save minimal standard deviation to avoid a division by zero
+        self.eps = eps
 
     def forward(self, input: torch.Tensor) -> torch.Tensor:
-        return (input - input.mean(dim=1, keepdim=True)) / input.std(dim=1, keepdim=True)
\ No newline at end of file
+        # Normalize in float32 since mean and std are not stable in reduced precision (e.g. bfloat16)
+        output = input.float()
+        output = (output - output.mean(dim=1, keepdim=True)) / output.std(dim=1, keepdim=True).clamp(min=self.eps)
+        return output.to(input.dtype)
@@ -1,4 +1,4 @@
-from typing import Callable, Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Tuple
 
 import numpy as np
 import torch
@@ -6,7 +6,18 @@ import torch.nn as nn
 from tqdm import tqdm
 from torch.utils.data.dataloader import DataLoader
 import datetime
+import copy
+from concurrent.futures import Future, ThreadPoolExecutor
 import Misc
+import Datasets
+import Metrics
+import Checkpoint
+import Profiler
+import Memory
+import Telemetry
+import Evaluation
+import Inference
+import Augmentation
 import os
 import json
 
@@ -21,7 +32,11 @@ class OccupancyNetworkWrapper(object):
                  test_data: torch.utils.data.dataloader,
                  validation_data: torch.utils.data.dataloader,
                  loss_function: Callable[[torch.tensor, torch.tensor], torch.tensor], device: str = 'cuda',
-                 save_data_path: str = 'Saved_data_', data_folder: str = None) -> None:
+                 save_data_path: str = 'Saved_data_', data_folder: str = None, precision: str = 'float32',
+                 logits: bool = False, frozen_validation: bool = False,
+                 cache_validation_latents: bool = False, profile_path: str = None,
+                 profile_steps: int = None, memory_monitoring: bool = True, decoder_only: bool = False,
+                 augmentation: Augmentation.VolumeAugmentation = None) -> None:
         """
         Class constructor
         :param occupancy_network: (nn.Module) Occupancy network for binary segmentation
@@ -32,7 +47,26 @@ class OccupancyNetworkWrapper(object):
         :param loss_function: (Callable[[torch.tensor], torch.tensor]) Loss function to use
         :param device: (str) Device to use while training, validation and testing
         :param data_folder: (str) Folder name inside the main save path
+        :param precision: (str) Precision of forward passes ('float32' or 'bfloat16' autocast), loss and metrics are
+        always computed in float32
+        :param logits: (bool) True if the network outputs logits, thresholds are then applied in logit space
+        :param frozen_validation: (bool) True if the validation set should be materialized once with fixed coordinates
+        and precomputed labels and evaluated in batches
+        :param cache_validation_latents: (bool) True if latents of the frozen validation set should be cached until
+        the encoder is updated, so they are reused between validations of decoder only training
+        :param profile_path: (str) Folder to save a Chrome trace and a summary of the phases of each training step
+        (default=None disables profiling)
+        :param profile_steps: (int) Number of training steps to profile (default=None profiles the whole training)
+        :param memory_monitoring: (bool) If true the memory of the process, its dataloader workers and the allocator
+        is recorded for every training epoch, validation and test and logged as memory_<phase>_<statistic> metrics
+        :param decoder_only: (bool) If true the encoder is frozen and training batches include cached latents
+        (Datasets.LatentDataset) instead of volumes, so only the decoder is trained. Validation and test still encode
+        the volumes.
+        :param augmentation: (Augmentation.VolumeAugmentation) Augmentation applied to training batches on the device
+        (default=None disables augmentation)
+        If a process group is initialized (distributed training) only rank 0 saves logs and checkpoints.
         """
+        assert precision in ['float32', 'bfloat16'], 'Precision {} is not available!'.format(precision)
         # Init class variables
         self.occupancy_network = occupancy_network.to(device)
         self.occupancy_network_optimizer = occupancy_network_optimizer
@@ -41,152 +75,454 @@ class OccupancyNetworkWrapper(object):
         self.validation_data = validation_data
         self.loss_function = loss_function
         self.device = device
-        self.metrics = dict()
+        self.precision = precision
+        self.logits = logits
+        self.frozen_validation = frozen_validation
+        self.cache_validation_latents = cache_validation_latents
+        # Frozen validation set is materialized at the first validation
+        self.frozen_validation_set = None
+        self.decoder_only = decoder_only
+        self.augmentation = augmentation
+        assert augmentation is None or not decoder_only, 'Cached latents can not be augmented!'
+        # Get rank and number of processes in distributed training
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            self.rank = torch.distributed.get_rank()
+            self.world_size = torch.distributed.get_world_size()
+        else:
+            self.rank, self.world_size = 0, 1
+        self.is_main_process = self.rank == 0
+        # Separate process group for validation, so validation can run concurrently to gradient synchronization
+        self.validation_group = torch.distributed.new_group() if self.world_size > 1 else None
+        if decoder_only:
+            assert self.world_size == 1, 'Decoder only training is not supported in distributed training!'
+            # Freeze encoder, its cached latents would be outdated otherwise
+            self.get_model().encoding.requires_grad_(False)
+        # Init training state
+        self.epoch = 0
+        self.step_in_epoch = 0
+        self.global_step = 0
+        # Version of the encoder weights, bumped whenever the encoder is updated or loaded
+        self.encoder_version = 0
+        self.best_loss = np.inf
+        self.validation_metrics = (np.inf, 0.0, 0.0)
+        # Init profiler of training steps
+        self.profiler = Profiler.StepProfiler(profile_path, device=device, number_of_steps=profile_steps)
+        # Telemetry server is started by the training loop
+        self.telemetry = Telemetry.TelemetryServer()
+        # Init background checkpoint writer
+        self.checkpoint_writer = Checkpoint.CheckpointWriter(profiler=self.profiler)
         # Init folder to save models and logs
         if data_folder is None:
             data_folder = str(datetime.datetime.now())
         else:
             data_folder = data_folder + '_' + str(datetime.datetime.now())
         self.path_save_models = os.path.join(save_data_path, 'models_' + data_folder)
+        self.path_save_plots = os.path.join(save_data_path, 'plots_' + data_folder)
+        self.path_save_metrics = os.path.join(save_data_path, 'metrics_' + data_folder)
+        # Init memory monitor, records including the largest tensors are saved next to the metrics
+        self.memory_monitor = Memory.MemoryMonitor(
+            device, path=os.path.join(self.path_save_metrics, 'memory.jsonl') if self.is_main_process else None,
+            enabled=memory_monitoring)
+        # Only the main process saves logs and models
+        self.metrics = None
+        if not self.is_main_process:
+            return
         if not os.path.exists(self.path_save_models):
             os.makedirs(self.path_save_models)
-        self.path_save_plots = os.path.join(save_data_path, 'plots_' + data_folder)
         if not os.path.exists(self.path_save_plots):
             os.makedirs(self.path_save_plots)
-        self.path_save_metrics = os.path.join(save_data_path, 'metrics_' + data_folder)
         if not os.path.exists(self.path_save_metrics):
             os.makedirs(self.path_save_metrics)
+        # Init append-only metric store
+        self.metrics = Metrics.MetricStore(self.path_save_metrics)
         # Save hyperparameters
         hyperparameter = dict()
         hyperparameter['model'] = str(self.occupancy_network)
         hyperparameter['optim'] = str(occupancy_network_optimizer)
         hyperparameter['loss'] = str(loss_function)
+        hyperparameter['precision'] = precision
+        hyperparameter['logits'] = logits
+        hyperparameter['augmentation'] = augmentation.get_parameters() if augmentation is not None else None
         # Save to file
         with open(os.path.join(self.path_save_metrics, 'hyperparameter.txt'), 'w') as json_file:
             json.dump(hyperparameter, json_file)
 
-    def train(self, epochs: int = 100, save_best_model: bool = True, save_model_every_n_epoch: int = 10) -> None:
+    def train(self, epochs: int = 100, save_best_model: bool = True, save_model_every_n_epoch: int = 10,
+              save_checkpoint_every_n_steps: int = None, asynchronous_validation: bool = False,
+              telemetry_port: int = None) -> None:
         """
         Training loop
         :param epochs: (int) Number of epochs to perform
         :param save_best_model: (int) If true the best model is saved
-        :param model_save_path: (str) Path to save the best model
+        :param save_model_every_n_epoch: (int) Frequency of epochs to save a checkpoint
+        :param save_checkpoint_every_n_steps: (int) If given the last checkpoint is additionally saved every n steps
+        :param asynchronous_validation: (bool) If true a snapshot of the model is validated in a background thread
+        while the next epoch is trained. Metrics are logged to the epoch of the snapshot when the validation finished.
+        :param telemetry_port: (int) If given live metrics (step rate, points per second, loader wait fraction, loss,
+        validation metrics, memory and ETA) are served in the Prometheus text format on this port plus the rank
         """
-        # Model into train mode
-        self.occupancy_network.train()
+        # Model to device
         self.occupancy_network.to(self.device)
         # Init progress bar
-        progress_bar = tqdm(total=epochs * len(self.training_data.dataset))
-        # Init best loss variable
-        best_loss = np.inf
-        # Init variables for progress bar
-        validation_loss, validation_iou, validation_bb_iou = np.inf, 0, 0
-        for epoch in range(epochs):
-            # Validate model
-            for volumes, coordinates, labels in self.training_data:
+        progress_bar = tqdm(total=epochs * len(self.training_data.dataset),
+                            initial=self.epoch * len(self.training_data.dataset)
+                                    + self.step_in_epoch * self.training_data.batch_size * self.world_size,
+                            disable=not self.is_main_process)
+        # Start telemetry server, every process of distributed training serves its own port
+        if telemetry_port is not None:
+            self.telemetry = Telemetry.TelemetryServer(telemetry_port + self.rank, labels=dict(rank=self.rank))
+            self.telemetry.set_total_steps(epochs * len(self.training_data))
+        # Init worker thread for asynchronous validation and pending validation (future, epoch, training state)
+        validation_executor = ThreadPoolExecutor(max_workers=1) if asynchronous_validation else None
+        pending_validation = None
+        # Frozen validation set is materialized on the main thread before any validation is submitted
+        if self.frozen_validation:
+            self.get_frozen_validation_set()
+        for epoch in range(self.epoch, epochs):
+            # Model into train mode (validation sets eval mode)
+            self.occupancy_network.train()
+            # Assign logged metrics to current epoch
+            if self.is_main_process:
+                self.metrics.set_epoch(epoch)
+            self.memory_monitor.start('train')
+            # Set permutation of the epoch and skip already performed steps if training is resumed
+            if isinstance(self.training_data.sampler, Misc.ResumableRandomSampler):
+                self.training_data.sampler.set_epoch(epoch)
+                self.training_data.sampler.set_start_index(self.step_in_epoch * self.training_data.batch_size)
+            # Waiting time for every batch is profiled
+            for volumes, coordinates, labels in self.telemetry.iterate(self.profiler.iterate(self.training_data,
+                                                                                             'dataloader')):
                 # Update progress bar
-                progress_bar.update(volumes.shape[0])
+                progress_bar.update(volumes.shape[0] * self.world_size)
                 # Reset gradients
                 self.occupancy_network.zero_grad()
                 # Data to device
-                volumes = volumes.to(self.device)
-                coordinates = coordinates.to(self.device)
-                labels = labels.to(self.device)
-                # Perform model prediction
-                prediction = self.occupancy_network(volumes, coordinates)
-                # Compute loss
-                loss = self.loss_function(prediction, labels)
+                with self.profiler.phase('host_to_device'):
+                    volumes = volumes.to(self.device)
+                    coordinates = coordinates.to(self.device)
+                    labels = labels.to(self.device)
+                # Augment batch on the device
+                if self.augmentation is not None:
+                    with self.profiler.phase('augmentation'):
+                        volumes, coordinates, labels = self.augmentation(volumes, coordinates, labels)
+                # Perform model prediction, volumes are latents in decoder only training
+                with self.profiler.forward(self.get_model(), decoder_only=self.decoder_only), \
+                        Misc.get_autocast(self.device, self.precision):
+                    prediction = self.get_model().decode(volumes, coordinates) if self.decoder_only \
+                        else self.occupancy_network(volumes, coordinates)
+                # Compute loss in float32
+                with self.profiler.phase('loss'):
+                    loss = self.loss_function(prediction.float(), labels)
                 # Compute gradients
-                loss.backward()
+                with self.profiler.phase('backward'):
+                    loss.backward()
                 # Update parameters
-                self.occupancy_network_optimizer.step()
-                # Update loss info in progress bar
-                progress_bar.set_description(
-                    'Epoch {}/{}, Best val Loss={:.4f}, Cur val Loss={:.4f}, Cur val IoU={:.4f}, Cur val BB IoU={:.4f}, Loss={:.4f}'.format(
-                        epoch + 1, epochs, best_loss, validation_loss, validation_iou, validation_bb_iou, loss.item()))
-                # Save loss value and current epoch
-                self.logging(metric_name='train_loss', value=loss.item())
-                self.logging(metric_name='epoch', value=epoch)
-            validation_loss, validation_iou, validation_bb_iou = self.validate()
-            # Save validation values
-            self.logging(metric_name='validation_loss', value=validation_loss)
-            self.logging(metric_name='validation_iou', value=validation_iou)
-            self.logging(metric_name='validation_bb_iou', value=validation_bb_iou)
-            # Save best model
-            if save_best_model and (best_loss > validation_loss):
-                torch.save(self.occupancy_network,
-                           os.path.join(self.path_save_models, 'occupancy_network_best_' + self.device + '.pt'))
-                best_loss = validation_loss
+                with self.profiler.phase('optimizer_step'):
+                    self.occupancy_network_optimizer.step()
+                self.step_in_epoch += 1
+                self.global_step += 1
+                # Frozen encoder of decoder only training keeps its version
+                if not self.decoder_only:
+                    self.encoder_version += 1
+                with self.profiler.phase('metrics'):
+                    # Update loss info in progress bar
+                    progress_bar.set_description(
+                        'Epoch {}/{}, Best val Loss={:.4f}, Cur val Loss={:.4f}, Cur val IoU={:.4f}, Cur val BB IoU={:.4f}, Loss={:.4f}'.format(
+                            epoch + 1, epochs, self.best_loss, *self.validation_metrics, loss.item()))
+                    # Save loss value
+                    self.logging(metric_name='train_loss', value=loss.item())
+                    self.telemetry.step(self.global_step, coordinates.shape[0], loss=loss.item(), epoch=epoch)
+                # Save checkpoint to resume within the epoch
+                if save_checkpoint_every_n_steps is not None and self.step_in_epoch % save_checkpoint_every_n_steps == 0:
+                    self.save_checkpoint('checkpoint_last.pt')
+                self.profiler.step()
+                # Sample memory of dataloader workers
+                self.memory_monitor.sample()
+                # Log asynchronous validation as soon as it is finished
+                if pending_validation is not None and pending_validation[0].done():
+                    self.finish_validation(pending_validation, save_best_model=save_best_model)
+                    pending_validation = None
+            self.epoch, self.step_in_epoch = epoch + 1, 0
+            self.log_memory('train', epoch=epoch)
+            if asynchronous_validation:
+                # Only one validation is performed at a time
+                if pending_validation is not None:
+                    self.finish_validation(pending_validation, save_best_model=save_best_model)
+                # Snapshot weights and training state at the end of the epoch
+                snapshot = copy.deepcopy(self.get_model())
+                snapshot.zero_grad(set_to_none=True)
+                state = Checkpoint.copy_to_cpu(self.get_checkpoint_state()) if self.is_main_process else None
+                pending_validation = (validation_executor.submit(self.validate, occupancy_network=snapshot), epoch,
+                                      state)
+            else:
+                self.memory_monitor.start('validation')
+                with self.profiler.phase('validation'):
+                    validation_metrics = self.validate()
+                self.log_memory('validation', epoch=epoch)
+                self.log_validation(validation_metrics, epoch, save_best_model=save_best_model)
             # Save model
             if epoch % save_model_every_n_epoch == 0:
-                torch.save(self.occupancy_network,
-                           os.path.join(self.path_save_models,
-                                        'occupancy_network_best_' + str(epoch) + '_' + self.device + '.pt'))
-            self.save_metrics(self.metrics, path=self.path_save_metrics)
+                self.save_checkpoint('occupancy_network_best_' + str(epoch) + '_' + self.device + '.pt')
+            # Asynchronous validation updates the last checkpoint again as soon as it is finished
+            self.save_checkpoint('checkpoint_last.pt')
         progress_bar.close()
+        # Log last asynchronous validation
+        if pending_validation is not None:
+            self.finish_validation(pending_validation, save_best_model=save_best_model)
+        if validation_executor is not None:
+            validation_executor.shutdown()
+        # Wait for pending checkpoints
+        self.checkpoint_writer.wait()
+        # Save trace and summary if profiling did not stop already
+        self.profiler.save()
+        self.telemetry.close()
+
+    def get_model(self) -> nn.Module:
+        """
+        Method returns the occupancy network without (distributed) data parallel wrapper
+        :return: (nn.Module) Occupancy network
+        """
+        if isinstance(self.occupancy_network, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            return self.occupancy_network.module
+        return self.occupancy_network
+
+    def get_frozen_validation_set(self) -> Datasets.FrozenValidationSet:
+        """
+        Method returns the frozen validation set, the set is materialized on the first call
+        :return: (Datasets.FrozenValidationSet) Frozen validation set
+        """
+        if self.frozen_validation_set is None:
+            self.frozen_validation_set = Datasets.FrozenValidationSet(
+                self.validation_data, device=self.device, cache_latents=self.cache_validation_latents)
+        return self.frozen_validation_set
+
+    def finish_validation(self, pending_validation: Tuple[Future, int, Dict[str, Any]],
+                          save_best_model: bool = True) -> None:
+        """
+        Method waits for an asynchronous validation, logs its metrics and updates the last checkpoint, so the
+        checkpoint includes the validation metrics and the best loss
+        :param pending_validation: (Tuple[Future, int, Dict[str, Any]]) Future of the validation, epoch of the
+        snapshot and training state at the end of the epoch
+        :param save_best_model: (int) If true the best model is saved
+        """
+        future, validation_epoch, state = pending_validation
+        self.log_validation(future.result(), validation_epoch, state=state, save_best_model=save_best_model)
+        self.save_checkpoint('checkpoint_last.pt')
+
+    def log_validation(self, validation_metrics: Tuple[float, float, float], epoch: int,
+                       state: Dict[str, Any] = None, save_best_model: bool = True) -> None:
+        """
+        Method logs the validation metrics of an epoch and saves the best model
+        :param validation_metrics: (Tuple[float, float, float]) Validation metrics: loss, iou & bounding box iou
+        :param epoch: (int) Epoch the validated model was trained for
+        :param state: (Dict[str, Any]) Training state at the end of the epoch used for saving the best model
+        (default=None uses the current state)
+        :param save_best_model: (int) If true the best model is saved
+        """
+        self.validation_metrics = validation_metrics
+        validation_loss, validation_iou, validation_bb_iou = validation_metrics
+        # Save validation values
+        self.logging(metric_name='validation_loss', value=validation_loss, epoch=epoch)
+        self.logging(metric_name='validation_iou', value=validation_iou, epoch=epoch)
+        self.logging(metric_name='validation_bb_iou', value=validation_bb_iou, epoch=epoch)
+        self.telemetry.update(validation_loss=validation_loss, validation_iou=validation_iou,
+                              validation_bb_iou=validation_bb_iou, validation_epoch=epoch)
+        # Save best model
+        if save_best_model and (self.best_loss > validation_loss):
+            self.best_loss = validation_loss
+            if state is not None:
+                state['best_loss'] = self.best_loss
+                state['validation_metrics'] = validation_metrics
+            self.save_checkpoint('occupancy_network_best_' + self.device + '.pt', state=state)
+
+    def get_checkpoint_state(self) -> Dict[str, Any]:
+        """
+        Method returns the current training state including the model, optimizer, training progress, metrics and rng
+        states. Tensors are not copied.
+        :return: (Dict[str, Any]) Training state
+        """
+        # Append buffered metrics to disk, so the saved lengths match the files
+        self.metrics.flush()
+        state = dict()
+        state['model_state_dict'] = self.get_model().state_dict()
+        state['optimizer_state_dict'] = self.occupancy_network_optimizer.state_dict()
+        state['epoch'] = self.epoch
+        state['step_in_epoch'] = self.step_in_epoch
+        state['global_step'] = self.global_step
+        state['best_loss'] = self.best_loss
+        state['validation_metrics'] = self.validation_metrics
+        state['path_save_metrics'] = self.path_save_metrics
+        state['metric_lengths'] = self.metrics.get_lengths()
+        state['rng_state'] = Checkpoint.get_rng_state()
+        # Base seed of the permutations, so a resumed training continues the same permutation
+        if isinstance(self.training_data.sampler, Misc.ResumableRandomSampler):
+            state['sampler_seed'] = self.training_data.sampler.seed
+        return state
+
+    def save_checkpoint(self, file_name: str, state: Dict[str, Any] = None) -> None:
+        """
+        Method saves a checkpoint including the model, optimizer, training progress, metrics and rng states. A snapshot
+        is taken synchronously and written to disk in a background thread.
+        :param file_name: (str) File name of the checkpoint inside the model folder
+        :param state: (Dict[str, Any]) Training state to save (default=None uses the current state)
+        """
+        if not self.is_main_process:
+            return
+        # Snapshot to cpu is profiled, writing is profiled by the checkpoint writer thread
+        with self.profiler.phase('checkpoint'):
+            if state is None:
+                state = self.get_checkpoint_state()
+            self.checkpoint_writer.save(state, os.path.join(self.path_save_models, file_name))
+
+    def resume(self, path: str) -> None:
+        """
+        Method resumes a training from a checkpoint. Metrics logged up to the checkpoint are copied into the metric
+        folder of this run.
+        :param path: (str) Path of the checkpoint
+        """
+        state = Checkpoint.load_checkpoint(path, map_location=self.device)
+        self.get_model().load_state_dict(state['model_state_dict'])
+        self.encoder_version += 1
+        self.occupancy_network_optimizer.load_state_dict(state['optimizer_state_dict'])
+        self.epoch = state['epoch']
+        self.step_in_epoch = state['step_in_epoch']
+        self.global_step = state['global_step']
+        self.best_loss = state['best_loss']
+        self.validation_metrics = tuple(state['validation_metrics'])
+        if self.is_main_process:
+            self.metrics.restore(state['path_save_metrics'], state['metric_lengths'])
+        Checkpoint.set_rng_state(state['rng_state'])
+        # Checkpoints of runs with a fixed sampler seed do not include it
+        if 'sampler_seed' in state and isinstance(self.training_data.sampler, Misc.ResumableRandomSampler):
+            self.training_data.sampler.seed = state['sampler_seed']
 
     @torch.no_grad()
-    def validate(self, threshold: float = 0.5, offset: torch.Tensor = torch.tensor([10.0, 10.0, 10.0])) -> Tuple[
-        float, float, float]:
+    def validate(self, threshold: float = 0.5, offset: torch.Tensor = torch.tensor([10.0, 10.0, 10.0]),
+                 occupancy_network: nn.Module = None) -> Tuple[float, float, float]:
         '''
         Validation method
         :param threshold: (bool) Threshold utilized to calc metrics
         :param offset: (torch.Tensor) Offset used for bounding box prediction
+        :param occupancy_network: (nn.Module) Snapshot of the model to validate (default=None uses the current model)
         :return: (Tuple[float, float, float]) Validation metrics: loss, iou & bounding box iou
         '''
+        # Latents of a snapshot are not cached
+        is_snapshot = occupancy_network is not None
+        encoder_version = None if is_snapshot else self.encoder_version
+        if occupancy_network is None:
+            occupancy_network = self.get_model()
         # Model into eval mode
-        self.occupancy_network.eval()
+        occupancy_network.eval()
+        # Convert threshold into logit space if needed
+        if self.logits:
+            threshold = Misc.probability_to_logit(threshold)
         # Init list to save loss, iou, bb iou
         loss_values = []
         iou_values = []
         bb_iou_values = []
-        # Loop over all indexes
         # Calc no grads
         with torch.no_grad():
-            # Get data
-            for volume, coordinates, labels, actual in self.validation_data:
-                # Add batch size dim to data and to device
-                volume = volume.to(self.device)
-                coordinates = coordinates.to(self.device)
-                labels = labels.to(self.device)
-                actual = actual.to(self.device)
-                # Get prediction of model
-                if isinstance(self.occupancy_network, nn.DataParallel):
-                    prediction = self.occupancy_network.module(volume, coordinates)
-                else:
-                    prediction = self.occupancy_network(volume, coordinates)
-                # Calc loss
-                loss_values.append(self.loss_function(prediction, labels).item())
-                # Calc iou
-                iou_values.append(
-                    Misc.intersection_over_union(prediction, coordinates, actual[0], threshold=threshold).item())
-                # Calc bb iou
-                bb_iou_values.append(
-                    Misc.intersection_over_union_bounding_box(prediction, coordinates, actual[0],
-                                                              threshold=threshold, offset=offset)[0].item())
+            if self.frozen_validation:
+                # Materialize validation set once
+                frozen_validation_set = self.get_frozen_validation_set()
+                # Encode all scans, latents are reused if the encoder has not been updated since the last validation
+                with Misc.get_autocast(self.device, self.precision):
+                    latents = frozen_validation_set.get_latents(occupancy_network, version=encoder_version)
+                for (_, coordinates, labels, occupancy_labels), latent in zip(frozen_validation_set, latents):
+                    # Decode all scans of the batch at once
+                    with Misc.get_autocast(self.device, self.precision):
+                        predictions = occupancy_network.decode(latent, coordinates)
+                    # Metrics are computed in float32 for each scan
+                    number_of_points = [scan_labels.shape[0] for scan_labels in labels]
+                    for prediction, scan_coordinates, scan_labels, scan_occupancy_labels in zip(
+                            predictions.float().split(number_of_points), coordinates.split(number_of_points),
+                            labels, occupancy_labels):
+                        loss_values.append(self.loss_function(prediction, scan_labels).item())
+                        iou_values.append(Misc.intersection_over_union_from_labels(
+                            prediction, scan_occupancy_labels, threshold=threshold).item())
+                        bb_iou_values.append(Misc.intersection_over_union_bounding_box_from_labels(
+                            prediction, scan_coordinates, scan_occupancy_labels, threshold=threshold,
+                            offset=offset)[0].item())
+            else:
+                # Loop over all indexes
+                for volume, coordinates, labels, actual in self.validation_data:
+                    # Sample memory of dataloader workers, validation of snapshots is recorded as part of the training
+                    if not is_snapshot:
+                        self.memory_monitor.sample()
+                    # Add batch size dim to data and to device
+                    volume = volume.to(self.device)
+                    coordinates = coordinates.to(self.device)
+                    labels = labels.to(self.device)
+                    actual = actual.to(self.device)
+                    # Get prediction of model
+                    with Misc.get_autocast(self.device, self.precision):
+                        prediction = occupancy_network(volume, coordinates)
+                    # Metrics are computed in float32
+                    prediction = prediction.float()
+                    # Calc loss
+                    loss_values.append(self.loss_function(prediction, labels).item())
+                    # Calc iou
+                    iou_values.append(
+                        Misc.intersection_over_union(prediction, coordinates, actual[0], threshold=threshold).item())
+                    # Calc bb iou
+                    bb_iou_values.append(
+                        Misc.intersection_over_union_bounding_box(prediction, coordinates, actual[0],
+                                                                  threshold=threshold, offset=offset)[0].item())
+        # Average metrics over all processes in distributed training
+        if self.world_size > 1:
+            sums = torch.tensor([np.sum(loss_values), np.sum(iou_values), np.sum(bb_iou_values), len(loss_values)],
+                                dtype=torch.float64,
+                                device=self.device if torch.distributed.get_backend() == 'nccl' else 'cpu')
+            torch.distributed.all_reduce(sums, group=self.validation_group)
+            return float(sums[0] / sums[3]), float(sums[1] / sums[3]), float(sums[2] / sums[3])
         return float(np.mean(loss_values)), float(np.mean(iou_values)), float(np.mean(bb_iou_values))
 
     @torch.no_grad()
     def test(self, draw: bool = True, side_len: int = 1, threshold: float = 0.5,
-             offset: torch.tensor = torch.tensor([10.0, 10.0, 10.0])) -> Tuple[float, float, float, float, float]:
+             offset: torch.tensor = torch.tensor([10.0, 10.0, 10.0]), draw_every: int = 25, draw_format: str = 'obj',
+             draw_voxel_size: float = 2, threshold_sweep: bool = False,
+             instance_voxel_size: float = None,
+             test_time_augmentation: List[str] = None) -> Tuple[float, float, float, float, float]:
         '''
         Testing method
         :param draw: (bool) True if predictions should be drawn and save to .obj file
         :param side_len: (int) Downscale of labels used
         :param threshold: (bool) Threshold utilized to calc metrics
         :param offset: (torch.Tensor) Offset used for bounding box prediction
+        :param draw_every: (int) Only every n-th scan is drawn (1 draws all scans)
+        :param draw_format: (str) File format of drawn point clouds ('obj', 'ply' or 'npz')
+        :param draw_voxel_size: (float) Drawn points are downsampled to one point per voxel of this size (None keeps
+        all points)
+        :param threshold_sweep: (bool) If true iou, bounding box iou, precision and recall are additionally computed
+        for 201 thresholds in the same pass and saved with precision recall and ROC curves into the metrics folder
+        :param instance_voxel_size: (float) If given predicted weapon points are grouped into instances by connected
+        components of voxels of this size, the box and size of every instance are saved to instances.jsonl and the
+        bounding box iou of the largest instance is logged (default=None)
+        :param test_time_augmentation: (List[str]) Flips and rotations of the volume and the coordinates, see
+        Inference.AUGMENTATIONS. All augmentations are encoded and decoded in batched calls and the predictions are
+        averaged in the original frame (default=None)
         :return: (Tuple[float, float, float, float]) Test metrics: iou, iou bounding box, precision, recall & loss
         '''
         # Init progress bar
         progress_bar = tqdm(total=len(self.test_data))
-        # Get downsampling factor for input and calculate usampling factor
-        upsample_factor = self.test_data.dataset.side_len ** 3
+        # Record memory of the test phase
+        self.memory_monitor.start('test')
+        # Init histograms of all thresholds
+        sweep = Evaluation.ThresholdSweep(logits=self.logits, offset=offset) if threshold_sweep else None
+        # Instances of every scan are saved line by line
+        instances_file = open(os.path.join(self.path_save_metrics, 'instances.jsonl'), 'w') \
+            if instance_voxel_size is not None else None
+        # Convert threshold into logit space if needed
+        if self.logits:
+            threshold = Misc.probability_to_logit(threshold)
         # Calc no grads
         with torch.no_grad():
             # Iterate over test dataset
             for index, batch in enumerate(self.test_data):
                 # Update progress bar
                 progress_bar.update(1)
+                # Sample memory of dataloader workers
+                self.memory_monitor.sample()
                 # Model into eval mode
                 self.occupancy_network.eval()
                 # Get batch data
@@ -197,10 +533,18 @@ class OccupancyNetworkWrapper(object):
                 labels = labels.to(self.device)
                 actual = actual.to(self.device)
                 # Make prediction
-                if isinstance(self.occupancy_network, nn.DataParallel):
-                    prediction = self.occupancy_network.module(volume, coordinates)
-                else:
-                    prediction = self.occupancy_network(volume, coordinates)
+                with Misc.get_autocast(self.device, self.precision):
+                    if test_time_augmentation is not None:
+                        # Voxels of pooled volumes cover side length times pooling factor coordinates
+                        prediction = Inference.decode_augmented(
+                            self.get_model(), Inference.encode_augmented(self.get_model(), volume,
+                                                                         test_time_augmentation),
+                            coordinates.view(volume.shape[0], -1, 3), volume.shape, test_time_augmentation,
+                            side_len=self.test_data.dataset.side_len * self.test_data.dataset.pooling_factor)
+                    else:
+                        prediction = self.get_model()(volume, coordinates)
+                # Metrics are computed in float32
+                prediction = prediction.float()
                 # Set offset
                 prediction_offset = (prediction > threshold).float()
                 # Reshape prediction offset tensor by removing dimension
@@ -212,7 +556,8 @@ class OccupancyNetworkWrapper(object):
                 # Draw weapon prediction
                 if draw:
                     Misc.draw_test(weapon_prediction, actual_, volume, side_len, index,
-                                   draw_out_path=self.path_save_metrics)
+                                   draw_out_path=self.path_save_metrics, draw_every=draw_every,
+                                   file_format=draw_format, voxel_size=draw_voxel_size)
                 # Calc intersection over union
                 iou = Misc.intersection_over_union(prediction, coordinates, actual[0], threshold=threshold)
                 self.logging('iou', iou.item())
@@ -227,6 +572,19 @@ class OccupancyNetworkWrapper(object):
                 self.logging('bounding_box_error_x', bounding_box_error[0].item())
                 self.logging('bounding_box_error_y', bounding_box_error[1].item())
                 self.logging('bounding_box_error_z', bounding_box_error[2].item())
+                # Group weapon prediction into instances
+                if instances_file is not None:
+                    instance_labels, instance_boxes, instance_sizes = Misc.get_connected_components(
+                        weapon_prediction, voxel_size=instance_voxel_size)
+                    self.logging('number_of_instances', float(instance_sizes.shape[0]))
+                    # Bounding box iou of the largest instance, stray false positives are excluded
+                    largest_instance = torch.zeros_like(prediction_offset)
+                    largest_instance[prediction_offset == 1.0] = (instance_labels == 0).float()
+                    self.logging('iou_bounding_box_largest_instance', Misc.intersection_over_union_bounding_box(
+                        largest_instance, coordinates, actual[0], offset=offset)[0].item())
+                    instances_file.write(json.dumps(dict(scan=index, instances=[
+                        dict(bounding_box=box.tolist(), number_of_points=size) for box, size
+                        in zip(instance_boxes.cpu().numpy(), instance_sizes.tolist())])) + '\n')
                 # Calc precision
                 precision = Misc.precision(prediction, coordinates, actual[0], threshold=threshold)
                 self.logging('precision', precision.item())
@@ -236,18 +594,18 @@ class OccupancyNetworkWrapper(object):
                 # Calc loss
                 loss = self.loss_function(prediction, labels)
                 self.logging('test_loss', loss.item())
-                # Get memory consumption of tensors (upsample volume to original)
-                size_volume = Misc.get_tensor_size_mb(volume) * upsample_factor
-                size_prediction = Misc.get_tensor_size_mb(prediction)
-                size_actual = Misc.get_tensor_size_mb(actual)
-                self.logging('size_volume', size_volume)
-                self.logging('size_prediction', size_prediction)
-                self.logging('size_actual', size_actual)
+                # Add scan to threshold sweep
+                if sweep is not None:
+                    sweep.add(prediction, coordinates, Misc.get_occupancy_labels(coordinates, actual[0]))
 
             # Close progress bar
             progress_bar.close()
-        # Save metrics
-        self.save_metrics(self.metrics, path=self.path_save_metrics)
+            if instances_file is not None:
+                instances_file.close()
+            # Log memory while tensors of the last sample are still alive
+            memory = self.log_memory('test')
+        # Append buffered metrics to disk
+        self.metrics.flush()
         # Get average metrics
         test_iou = self.get_average_metric('iou')
         test_iou_bounding_box = self.get_average_metric('iou_bounding_box')
@@ -260,9 +618,6 @@ class OccupancyNetworkWrapper(object):
         test_precision = self.get_average_metric('precision')
         test_recall = self.get_average_metric('recall')
         test_loss = self.get_average_metric('test_loss')
-        test_size_volume = self.get_average_metric('size_volume')
-        test_size_prediction = self.get_average_metric('size_prediction')
-        test_size_actual = self.get_average_metric('size_actual')
         # Print metrics
         print('Intersection over union = {}'.format(test_iou))
         print('Intersection over union bounding box = {}'.format(test_iou_bounding_box))
@@ -273,23 +628,49 @@ class OccupancyNetworkWrapper(object):
         print('Precision = {}'.format(test_precision))
         print('Recall = {}'.format(test_recall))
         print('Test loss = {}'.format(test_loss))
-        print('Average memory usage per sample: Original volume = {}MB, Label = {}MB, Prediction = {}MB'.format(
-            round(test_size_volume, 2), round(test_size_actual, 2), round(test_size_prediction, 2)))
+        if instance_voxel_size is not None:
+            print('Mean number of instances = {}'.format(self.get_average_metric('number_of_instances')))
+            print('Intersection over union bounding box of the largest instance = {}'.format(
+                self.get_average_metric('iou_bounding_box_largest_instance')))
+        if sweep is not None:
+            # Save curves and print best operating points
+            best_thresholds = sweep.save(self.path_save_metrics)
+            for metric_name in ['iou', 'bounding_box_iou', 'f1']:
+                print('Best threshold for {} = {} ({})'.format(metric_name, best_thresholds[metric_name]['threshold'],
+                                                               best_thresholds[metric_name]['value']))
+            print('Average precision = {}, ROC AUC = {}'.format(best_thresholds['average_precision'],
+                                                               best_thresholds['roc_auc']))
+        if len(memory) > 0:
+            print('Memory usage: Peak RSS = {:.1f}MB, RSS of dataloader workers = {:.1f}MB, Largest tensor = '
+                  '{:.1f}MB'.format(memory.get('peak_rss_mb', float('nan')), memory['workers_rss_mb'],
+                                    memory['largest_tensor_mb']))
+            if 'cuda_peak_allocated_mb' in memory:
+                print('CUDA memory: Peak allocated = {:.1f}MB, Reserved = {:.1f}MB'.format(
+                    memory['cuda_peak_allocated_mb'], memory['cuda_reserved_mb']))
         return test_iou, test_iou_bounding_box, test_precision, test_recall, test_loss
 
-    def logging(self, metric_name: str, value: float) -> None:
+    def log_memory(self, phase_name: str, epoch: int = None) -> Dict[str, float]:
+        """
+        Method ends the current phase of the memory monitor and logs its statistics as memory_<phase>_<statistic>
+        :param phase_name: (str) Name of the phase used in the metric names
+        :param epoch: (int) Epoch of the values (default=None uses the current epoch)
+        :return: (Dict[str, float]) Memory statistics of the phase (empty if memory monitoring is disabled)
+        """
+        memory = self.memory_monitor.stop()
+        for statistic_name, value in memory.items():
+            self.logging('memory_{}_{}'.format(phase_name, statistic_name), value, epoch=epoch)
+        return memory
+
+    def logging(self, metric_name: str, value: float, epoch: int = None) -> None:
         """
-        Method writes a given metric value into a dict including list for every metric
+        Method appends a given metric value to the metric store
         :param metric_name: (str) Name of the metric
         :param value: (float) Value of the metric
+        :param epoch: (int) Epoch of the value (default=None uses the current epoch)
         """
-        if metric_name in self.metrics:
-            if value is None:
-                return
-            else:
-                self.metrics[metric_name].append(value)
-        else:
-            self.metrics[metric_name] = [value]
+        if value is None or not self.is_main_process:
+            return
+        self.metrics.append(metric_name, value, epoch=epoch)
 
     def get_average_metric_for_epoch(self, metric_name: str, epoch: int) -> float:
         """
@@ -298,12 +679,7 @@ class OccupancyNetworkWrapper(object):
         :param epoch: (int) Epoch to average over
         :return: (float) Average metric
         """
-        # Convert lists to np.array
-        metric = np.array(self.metrics[metric_name])
-        epochs = np.array(self.metrics['epoch'])
-        # Calc mean
-        metric_average = np.mean(metric[np.argwhere(epochs == epoch)])
-        return float(metric_average)
+        return self.metrics.get_average_for_epoch(metric_name, epoch)
 
     def get_average_metric(self, metric_name: str) -> float:
         """
@@ -311,26 +687,4 @@ class OccupancyNetworkWrapper(object):
         :param metric_name: (str) Name of the metric
         :return: (float) Average metric
         """
-        # Convert lists to np.array
-        metric = np.array(self.metrics[metric_name])
-        # Calc mean
-        metric_average = np.mean(metric)
-        return float(metric_average)
-
-    @staticmethod
-    def save_metrics(metrics: Dict[str, List[float]], path: str, add_time_to_file_name: bool = False) -> None:
-        """
-        Static method to save dict of metrics
-        :param metrics: (Dict[str, List[float]]) Dict including metrics
-        :param path: (str) Path to save metrics
-        :param add_time_to_file_name: (bool) True if time has to be added to filename of every metric
-        """
-        # Iterate items in metrics dict
-        for metric_name, values in metrics.items():
-            # Convert list of values to torch tensor to use build in save method from torch
-            values = torch.tensor(values)
-            # Save values
-            if add_time_to_file_name:
-                torch.save(values, path + '/' + metric_name + '_' + datetime.now().strftime("%H:%M:%S") + '.pt')
-            else:
-                torch.save(values, path + '/' + metric_name + '.pt')
+        return self.metrics.get_average(metric_name)
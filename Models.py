@@ -130,20 +130,36 @@ class OccupancyNetwork(nn.Module):
         :param coordinates: (torch.tensor) Input tensor including coordinates
         :return: (torch.tensor) Output tensor
         """
+        return self.decode(self.encode(volume), coordinates)
+
+    def encode(self, volume: torch.tensor) -> torch.tensor:
+        """
+        Encoding path of the occupancy network
+        :param volume: (torch.tensor) Input tensor including 3D volume
+        :return: (torch.tensor) Flattened latent tensor of shape (batch size, features)
+        """
         # Perform encoding path
         output_encoding = self.encoding(volume)
         # Flatten latent vector for decoding path
-        output_encoding_flatten = output_encoding.view(output_encoding.shape[0], -1)
-        # Repeat latent vector
-        input_decoding = torch.cat((torch.repeat_interleave(output_encoding_flatten,
-                                                            int(coordinates.shape[0] / volume.shape[0]), dim=0),
-                                    coordinates), dim=1)
+        return output_encoding.view(output_encoding.shape[0], -1)
+
+    def decode(self, latent: torch.tensor, coordinates: torch.tensor) -> torch.tensor:
+        """
+        Decoding path of the occupancy network
+        :param latent: (torch.tensor) Flattened latent tensor of shape (batch size, features)
+        :param coordinates: (torch.tensor) Coordinates of all volumes of shape (batch size * points, 3)
+        :return: (torch.tensor) Output tensor
+        """
+        # Repeat latent vector for every coordinate of the corresponding volume by broadcasting
+        coordinates_batched = coordinates.view(latent.shape[0], -1, coordinates.shape[1])
+        input_decoding = torch.cat((latent.unsqueeze(dim=1).expand(-1, coordinates_batched.shape[1], -1),
+                                    coordinates_batched), dim=2).view(-1, latent.shape[1] + coordinates.shape[1])
         # Perform decoding path
         for index, block in enumerate(self.decoding):
             if index == 0:
-                output_decoding = block(input_decoding, output_encoding_flatten.clone())
+                output_decoding = block(input_decoding, latent)
             else:
-                output_decoding = block(output_decoding, output_encoding_flatten.clone())
+                output_decoding = block(output_decoding, latent)
         # Perform last linear layer + sigmoid activation
         output = self.output_block(output_decoding)
         return output
@@ -273,16 +289,32 @@ class OccupancyNetworkNoCat(nn.Module):
         :param coordinates: (torch.tensor) Input tensor including coordinates
         :return: (torch.tensor) Output tensor
         """
+        return self.decode(self.encode(volume), coordinates)
+
+    def encode(self, volume: torch.tensor) -> torch.tensor:
+        """
+        Encoding path of the occupancy network
+        :param volume: (torch.tensor) Input tensor including 3D volume
+        :return: (torch.tensor) Flattened latent tensor of shape (batch size, features)
+        """
         # Perform encoding path
         output_encoding = self.encoding(volume)
         # Flatten latent vector for decoding path
-        output_encoding_flatten = output_encoding.view(output_encoding.shape[0], -1)
+        return output_encoding.view(output_encoding.shape[0], -1)
+
+    def decode(self, latent: torch.tensor, coordinates: torch.tensor) -> torch.tensor:
+        """
+        Decoding path of the occupancy network
+        :param latent: (torch.tensor) Flattened latent tensor of shape (batch size, features)
+        :param coordinates: (torch.tensor) Coordinates of all volumes of shape (batch size * points, 3)
+        :return: (torch.tensor) Output tensor
+        """
         # Perform decoding path
         for index, block in enumerate(self.decoding):
             if index == 0:
-                output_decoding = block(coordinates, output_encoding_flatten)
+                output_decoding = block(coordinates, latent)
             else:
-                output_decoding = block(output_decoding, output_encoding_flatten)
+                output_decoding = block(output_decoding, latent)
         # Perform last linear layer + sigmoid activation
         output = self.output_block(output_decoding)
         return output
@@ -313,7 +345,8 @@ class OccupancyNetworkNoCatCNN(nn.Module):
                  downsampling_factor_decoding: Union[int, List[int]] = 2,
                  normalization_decoding: Union[str, List[str]] = 'none',
                  dropout_rate_decoding: Union[float, List[float]] = 0.0,
-                 bias_decoding: Union[bool, List[bool]] = False) -> None:
+                 bias_decoding: Union[bool, List[bool]] = False,
+                 output_activation: str = 'sigmoid') -> None:
         # Call super constructor
         super(OccupancyNetworkNoCatCNN, self).__init__()
         # Convert encoding parameters to lists
@@ -395,20 +428,63 @@ class OccupancyNetworkNoCatCNN(nn.Module):
             for index in range(number_of_decoding_blocks)])
 
         # Init final classification layer
-        self.classification = nn.Sequential(nn.Flatten(), nn.Linear(60, 1), nn.Sigmoid())
+        self.classification = nn.Sequential(nn.Flatten(), nn.Linear(60, 1), Misc.get_activation(output_activation))
 
     def forward(self, volume: torch.tensor, coordinates: torch.tensor) -> torch.Tensor:
-        # Perform encoding path
-        output_encoding = self.encoding(volume)
+        return self.decode(self.encode(volume), coordinates)
+
+    def encode(self, volume: torch.tensor) -> torch.Tensor:
+        # Perform encoding path (latent volume is not flattened)
+        return self.encoding(volume)
+
+    def decode(self, output_encoding: torch.tensor, coordinates: torch.tensor) -> torch.Tensor:
         # Map coordinates
         mapped_coordinates = self.coordinate_mapping(coordinates.view(coordinates.shape[0], 1, 1, 3)).unsqueeze(
             dim=1).permute(0, 1, 3, 2, 4)
         # Concat output of encoder and coordinates
         input_decoding = torch.cat((
-            torch.repeat_interleave(output_encoding, int(coordinates.shape[0] / volume.shape[0]),
+            torch.repeat_interleave(output_encoding, int(coordinates.shape[0] / output_encoding.shape[0]),
                                     dim=0), mapped_coordinates), dim=1)
         # Perform decoding path
         output_decoding = self.decoding(input_decoding)
         # Perform classification
         classification_output = self.classification(output_decoding)
         return classification_output
+
+
+def get_occupancy_network(use_cat: bool = True, use_cbn: bool = True, small_encoder: bool = False,
+                          use_cnn_decoder: bool = False, logits: bool = False, pooling_factor: int = 1) -> nn.Module:
+    """
+    Function returns one of the occupancy network variants
+    :param use_cat: (bool) True if the latent vector is concatenated to the coordinates (OccupancyNetwork) else
+    OccupancyNetworkNoCat is used
+    :param use_cbn: (bool) True if conditional batch normalization is utilized in the decoding path
+    :param small_encoder: (bool) True if the smaller encoder is utilized
+    :param use_cnn_decoder: (bool) True if OccupancyNetworkNoCatCNN is used, use_cat and use_cbn are ignored
+    :param logits: (bool) True if the network should output logits instead of probabilities
+    :param pooling_factor: (int) Factor the input volumes are downsampled by in addition to the side length (1, 2 or
+    4), the encoder performs less pooling operations so the latent keeps its size (cheap coarse network of a cascade)
+    :return: (nn.Module) Occupancy network
+    """
+    if small_encoder:
+        channels_in_encoding_blocks = [(1, 32), (32, 32), (32, 64), (64, 64), (64, 8)]
+    else:
+        channels_in_encoding_blocks = [(1, 64), (64, 64), (64, 128), (128, 128), (128, 8)]
+    output_activation = 'identity' if logits else 'sigmoid'
+    assert pooling_factor in [1, 2, 4], 'Pooling factor {} is not available!'.format(pooling_factor)
+    # Last pooling operations are removed for downsampled inputs
+    number_of_poolings = 4 - {1: 0, 2: 1, 4: 2}[pooling_factor]
+    downsampling_encoding = ['averagepool'] * number_of_poolings + ['none'] * (5 - number_of_poolings)
+    if use_cnn_decoder:
+        return OccupancyNetworkNoCatCNN(channels_in_encoding_blocks=channels_in_encoding_blocks,
+                                        downsampling_encoding=downsampling_encoding,
+                                        output_activation=output_activation)
+    if use_cat:
+        return OccupancyNetwork(normalization_decoding='cbatchnorm' if use_cbn else 'batchnorm',
+                                channels_in_encoding_blocks=channels_in_encoding_blocks,
+                                downsampling_encoding=downsampling_encoding,
+                                output_activation=output_activation)
+    return OccupancyNetworkNoCat(normalization_decoding='cbatchnorm' if use_cbn else 'batchnorm',
+                                 channels_in_encoding_blocks=channels_in_encoding_blocks,
+                                 downsampling_encoding=downsampling_encoding,
+                                 output_activation=output_activation)
@@ -0,0 +1,279 @@
+from typing import Any, Dict, Iterable, Iterator, List
+
+import torch
+import torch.nn as nn
+import numpy as np
+import os
+import json
+import time
+import threading
+import contextlib
+
+
+def get_time_us() -> float:
+    """
+    Function returns the current time in microseconds. The monotonic clock is shared between all processes of a
+    machine, so events of dataset workers and of the training process can be merged into one trace.
+    :return: (float) Time in microseconds
+    """
+    return time.perf_counter() * 1e6
+
+
+class WorkerProfiler(object):
+    """
+    Class records the stages of dataset workers. Every process appends its events to an own file
+    (dataset_<pid>.jsonl) immediately, since worker processes can be terminated at any time.
+    """
+
+    def __init__(self, path: str = None) -> None:
+        """
+        Constructor method
+        :param path: (str) Folder to save events (default=None disables profiling)
+        """
+        self.path = path
+        self.file = None
+        self.pid = None
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Context manager records the duration of a stage
+        :param name: (str) Name of the stage
+        """
+        if self.path is None:
+            yield
+            return
+        start = get_time_us()
+        yield
+        end = get_time_us()
+        # Open file lazily, since the profiler is copied into every worker process
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            if not os.path.exists(self.path):
+                os.makedirs(self.path, exist_ok=True)
+            self.file = open(os.path.join(self.path, 'dataset_{}.jsonl'.format(self.pid)), 'a', buffering=1)
+        self.file.write(json.dumps(dict(name=name, cat='dataset', ph='X', ts=start, dur=end - start, pid=self.pid,
+                                        tid=threading.get_ident())) + '\n')
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """
+        Open files are not copied to worker processes
+        :return: (Dict[str, Any]) State of the profiler
+        """
+        return dict(path=self.path, file=None, pid=None)
+
+
+class StepProfiler(object):
+    """
+    Class times the phases of every training step (dataloader wait, host to device copy, encoder and decoder forward,
+    loss, backward, optimizer step, metrics and checkpoint I/O). Phases are also annotated with record_function, so
+    they show up in traces of the torch profiler. Results are saved as a Chrome trace (chrome://tracing or Perfetto),
+    merged with the events of WorkerProfiler, and as a per phase summary table.
+    """
+
+    def __init__(self, path: str = None, device: str = 'cpu', number_of_steps: int = None,
+                 torch_profiler: bool = False) -> None:
+        """
+        Constructor method
+        :param path: (str) Folder to save the trace and summary (default=None disables profiling)
+        :param device: (str) Device utilized, cuda is synchronized at phase boundaries to get actual durations
+        :param number_of_steps: (int) Number of steps to profile (default=None profiles all steps)
+        :param torch_profiler: (bool) If true the torch profiler is run additionally and its trace is saved
+        """
+        self.path = path
+        self.enabled = path is not None
+        self.synchronize = 'cuda' in device and torch.cuda.is_available()
+        self.number_of_steps = number_of_steps
+        self.step_index = 0
+        # Chrome trace events, appended by the training and the checkpoint writer thread
+        self.events = []
+        self.lock = threading.Lock()
+        # Start time of open phases per name, used by hooks which can not use context managers
+        self.open_phases = dict()
+        self.pid = os.getpid()
+        # Make folder
+        if self.enabled and not os.path.exists(path):
+            os.makedirs(path)
+        # Init torch profiler
+        self.torch_profiler = None
+        if self.enabled and torch_profiler:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.synchronize:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(activities=activities)
+            self.torch_profiler.start()
+
+    def begin(self, name: str) -> None:
+        """
+        Method starts a phase
+        :param name: (str) Name of the phase
+        """
+        if not self.enabled:
+            return
+        if self.synchronize:
+            torch.cuda.synchronize()
+        self.open_phases[name] = get_time_us()
+
+    def end(self, name: str) -> None:
+        """
+        Method ends a phase started with begin
+        :param name: (str) Name of the phase
+        """
+        if not self.enabled or name not in self.open_phases:
+            return
+        if self.synchronize:
+            torch.cuda.synchronize()
+        start = self.open_phases.pop(name)
+        event = dict(name=name, cat='step', ph='X', ts=start, dur=get_time_us() - start, pid=self.pid,
+                     tid=threading.get_ident(), args=dict(step=self.step_index))
+        with self.lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Context manager records the duration of a phase
+        :param name: (str) Name of the phase
+        """
+        if not self.enabled:
+            yield
+            return
+        self.begin(name)
+        with torch.profiler.record_function(name):
+            yield
+        self.end(name)
+
+    @contextlib.contextmanager
+    def forward(self, occupancy_network: nn.Module, decoder_only: bool = False) -> Iterator[None]:
+        """
+        Context manager records the encoder and the decoder forward pass. The end of the encoding path is detected by
+        hooks, so the forward pass of (distributed) data parallel wrappers is not changed.
+        :param occupancy_network: (nn.Module) Occupancy network including an encoding module
+        :param decoder_only: (bool) If true only the decoder is run (e.g. on cached latents), the whole context is
+        recorded as decoder forward pass
+        """
+        if not self.enabled:
+            yield
+            return
+        # Encoding module is not called, thus its hooks would never start the decoder phase
+        if decoder_only:
+            with self.phase('decoder_forward'):
+                yield
+            return
+
+        def encoder_pre_hook(*_) -> None:
+            self.begin('encoder_forward')
+
+        def encoder_hook(*_) -> None:
+            # Decoding path starts after the encoding module
+            self.end('encoder_forward')
+            self.begin('decoder_forward')
+
+        handles = [occupancy_network.encoding.register_forward_pre_hook(encoder_pre_hook),
+                   occupancy_network.encoding.register_forward_hook(encoder_hook)]
+        try:
+            yield
+        finally:
+            for handle in handles:
+                handle.remove()
+        self.end('decoder_forward')
+
+    def iterate(self, iterable: Iterable, name: str = 'dataloader') -> Iterator[Any]:
+        """
+        Generator records the time waiting for every element of an iterable, e.g. a dataloader
+        :param iterable: (Iterable) Iterable
+        :param name: (str) Name of the phase
+        :return: (Iterator[Any]) Elements of the iterable
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    element = next(iterator)
+                except StopIteration:
+                    return
+            yield element
+
+    def step(self) -> None:
+        """
+        Method marks the end of a training step, profiling stops after the given number of steps
+        """
+        if not self.enabled:
+            return
+        self.step_index += 1
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+        if self.number_of_steps is not None and self.step_index >= self.number_of_steps:
+            self.save()
+            self.enabled = False
+
+    def get_summary(self, events: List[Dict[str, Any]] = None) -> Dict[str, Dict[str, float]]:
+        """
+        Method summarizes the duration of every phase
+        :param events: (List[Dict[str, Any]]) Events to summarize (default=None uses the events of the step phases)
+        :return: (Dict[str, Dict[str, float]]) Count, total time in s, mean and max time in ms and share of the
+        profiled time for each phase
+        """
+        events = self.get_events() if events is None else events
+        if len(events) == 0:
+            return dict()
+        # Wall time between the first and the last event
+        start = min(event['ts'] for event in events)
+        wall_time = max(event['ts'] + event['dur'] for event in events) - start
+        summary = dict()
+        for name in dict.fromkeys(event['name'] for event in events):
+            durations = np.array([event['dur'] for event in events if event['name'] == name])
+            summary[name] = dict(count=int(durations.shape[0]), total_s=float(durations.sum() * 1e-6),
+                                 mean_ms=float(durations.mean() * 1e-3), max_ms=float(durations.max() * 1e-3),
+                                 share=float(durations.sum() / max(wall_time, 1e-9)))
+        return summary
+
+    def get_events(self) -> List[Dict[str, Any]]:
+        """
+        Method returns a snapshot of the events of the step phases
+        :return: (List[Dict[str, Any]]) Events
+        """
+        with self.lock:
+            return list(self.events)
+
+    def load_worker_events(self) -> List[Dict[str, Any]]:
+        """
+        Method loads the events saved by dataset workers into the same folder
+        :return: (List[Dict[str, Any]]) Events of dataset workers
+        """
+        events = []
+        for file_name in sorted(os.listdir(self.path)):
+            if file_name.startswith('dataset_') and file_name.endswith('.jsonl'):
+                with open(os.path.join(self.path, file_name), 'r') as file:
+                    events.extend(json.loads(line) for line in file if line.strip())
+        return events
+
+    def save(self) -> None:
+        """
+        Method saves the Chrome trace (trace.json) including dataset worker events and the summary table
+        (summary.txt), the table is printed as well
+        """
+        if not self.enabled:
+            return
+        # Events of the checkpoint writer thread may be appended while saving
+        events = self.get_events()
+        worker_events = self.load_worker_events()
+        # Save chrome trace
+        with open(os.path.join(self.path, 'trace.json'), 'w') as json_file:
+            json.dump(dict(traceEvents=events + worker_events, displayTimeUnit='ms'), json_file)
+        # Save trace of the torch profiler
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler.export_chrome_trace(os.path.join(self.path, 'torch_trace.json'))
+            self.torch_profiler = None
+        # Make summary table of step phases and dataset worker stages
+        lines = ['{:<20} {:>8} {:>10} {:>10} {:>10} {:>8}'.format('Phase', 'Count', 'Total [s]', 'Mean [ms]',
+                                                                  'Max [ms]', 'Share')]
+        for phase_events in [events, worker_events]:
+            for name, values in self.get_summary(phase_events).items():
+                lines.append('{:<20} {:>8d} {:>10.3f} {:>10.3f} {:>10.3f} {:>7.1f}%'.format(
+                    name, values['count'], values['total_s'], values['mean_ms'], values['max_ms'],
+                    values['share'] * 100))
+        with open(os.path.join(self.path, 'summary.txt'), 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        print('\n'.join(lines))
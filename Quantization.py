@@ -0,0 +1,159 @@
+from typing import Dict, List
+
+import torch
+import torch.nn as nn
+import numpy as np
+import copy
+import time
+
+import Misc
+
+
+class QuantizationStage(nn.Module):
+    """
+    Module quantizes the input of a linear or convolution operation and dequantizes the output again. This allows
+    static quantization of single operations while normalizations and activations stay in float32.
+    """
+
+    def __init__(self, operation: nn.Module) -> None:
+        """
+        Constructor method
+        :param operation: (nn.Module) Linear or convolution operation to be quantized
+        """
+        # Call super constructor
+        super(QuantizationStage, self).__init__()
+        # Init stubs and save operation
+        self.quantization = torch.quantization.QuantStub()
+        self.operation = operation
+        self.dequantization = torch.quantization.DeQuantStub()
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        """
+        Forward pass
+        :param input: (torch.Tensor) Float input tensor
+        :return: (torch.Tensor) Float output tensor
+        """
+        return self.dequantization(self.operation(self.quantization(input)))
+
+
+def get_decoder_linear_names(occupancy_network: nn.Module) -> List[str]:
+    """
+    Function returns the names of all per point linear operations in the decoding path. The operations of the first
+    block which get the raw coordinates as an input are excluded, since int8 can not resolve the coordinate range.
+    :param occupancy_network: (nn.Module) OccupancyNetwork or OccupancyNetworkNoCat
+    :return: (List[str]) Names of the linear operations
+    """
+    assert isinstance(occupancy_network.decoding, nn.ModuleList), \
+        'Only occupancy networks with a fully connected decoding path can be quantized!'
+    names = []
+    for index, block in enumerate(occupancy_network.decoding):
+        for name in ['linear_1', 'linear_2', 'residual_mapping']:
+            if index == 0 and name != 'linear_2':
+                continue
+            if isinstance(getattr(block, name), nn.Linear):
+                names.append('decoding.{}.{}'.format(index, name))
+    names.append('output_block.0')
+    return names
+
+
+def get_encoder_convolution_names(occupancy_network: nn.Module) -> List[str]:
+    """
+    Function returns the names of all convolutions in the encoding path
+    :param occupancy_network: (nn.Module) Occupancy network
+    :return: (List[str]) Names of the convolutions
+    """
+    return ['encoding.' + name for name, module in occupancy_network.encoding.named_modules()
+            if isinstance(module, nn.Conv3d)]
+
+
+def quantize_dynamic(occupancy_network: nn.Module) -> nn.Module:
+    """
+    Function performs a dynamic int8 quantization of the linear operations in the decoding path. Weights are
+    quantized ahead of time and activations are quantized on the fly, so no calibration is needed.
+    :param occupancy_network: (nn.Module) OccupancyNetwork or OccupancyNetworkNoCat
+    :return: (nn.Module) Quantized copy of the occupancy network for cpu inference
+    """
+    # Get model if data parallel is utilized
+    if isinstance(occupancy_network, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        occupancy_network = occupancy_network.module
+    occupancy_network = copy.deepcopy(occupancy_network).cpu().eval()
+    return torch.quantization.quantize_dynamic(occupancy_network,
+                                               qconfig_spec=set(get_decoder_linear_names(occupancy_network)),
+                                               dtype=torch.qint8)
+
+
+@torch.no_grad()
+def quantize_static(occupancy_network: nn.Module, calibration_data: torch.utils.data.DataLoader,
+                    number_of_scans: int = 4, quantize_encoder: bool = False, backend: str = 'fbgemm') -> nn.Module:
+    """
+    Function performs a static int8 quantization of the linear operations in the decoding path and optionally of
+    the convolutions in the encoding path. Activation ranges are calibrated on the given data.
+    :param occupancy_network: (nn.Module) OccupancyNetwork or OccupancyNetworkNoCat
+    :param calibration_data: (torch.utils.data.DataLoader) Dataloader of a WeaponDataset used for calibration
+    :param number_of_scans: (int) Number of batches utilized for calibration
+    :param quantize_encoder: (bool) True if encoding convolutions should be quantized
+    :param backend: (str) Quantization backend ('fbgemm' for x86 or 'qnnpack' for arm)
+    :return: (nn.Module) Quantized copy of the occupancy network for cpu inference
+    """
+    # Get model if data parallel is utilized
+    if isinstance(occupancy_network, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        occupancy_network = occupancy_network.module
+    occupancy_network = copy.deepcopy(occupancy_network).cpu().eval()
+    torch.backends.quantized.engine = backend
+    qconfig = torch.quantization.get_default_qconfig(backend)
+    # Wrap operations to be quantized into quantization stages
+    names = get_decoder_linear_names(occupancy_network)
+    if quantize_encoder:
+        names += get_encoder_convolution_names(occupancy_network)
+    for name in names:
+        parent_name, _, operation_name = name.rpartition('.')
+        parent = occupancy_network.get_submodule(parent_name)
+        stage = QuantizationStage(getattr(parent, operation_name))
+        stage.qconfig = qconfig
+        setattr(parent, operation_name, stage)
+    # Insert observers
+    torch.quantization.prepare(occupancy_network, inplace=True)
+    # Calibrate activation ranges
+    for index, batch in enumerate(calibration_data):
+        if index >= number_of_scans:
+            break
+        occupancy_network(batch[0], batch[1])
+    # Convert observed operations into int8 operations
+    torch.quantization.convert(occupancy_network, inplace=True)
+    return occupancy_network
+
+
+@torch.no_grad()
+def evaluate_quantization(occupancy_networks: Dict[str, nn.Module], test_data: torch.utils.data.DataLoader,
+                          number_of_scans: int = 10, threshold: float = 0.5) -> Dict[str, Dict[str, float]]:
+    """
+    Function compares the intersection over union and the cpu throughput of float32 and quantized networks
+    :param occupancy_networks: (Dict[str, nn.Module]) Occupancy networks with name
+    :param test_data: (torch.utils.data.DataLoader) Dataloader of a WeaponDataset with test=True
+    :param number_of_scans: (int) Number of batches to evaluate
+    :param threshold: (float) Threshold utilized to calc intersection over union
+    :return: (Dict[str, Dict[str, float]]) Mean iou and points per second for each network
+    """
+    # Load scans once to measure only the networks
+    batches = []
+    for index, batch in enumerate(test_data):
+        if index >= number_of_scans:
+            break
+        batches.append(batch)
+    results = dict()
+    for name, occupancy_network in occupancy_networks.items():
+        occupancy_network = occupancy_network.cpu().eval()
+        iou_values = []
+        number_of_points = 0
+        duration = 0.0
+        for volume, coordinates, labels, actual in batches:
+            start = time.perf_counter()
+            prediction = occupancy_network(volume, coordinates)
+            duration += time.perf_counter() - start
+            number_of_points += coordinates.shape[0]
+            iou_values.append(
+                Misc.intersection_over_union(prediction, coordinates, actual[0], threshold=threshold).item())
+        results[name] = dict(iou=float(np.mean(iou_values)), points_per_second=number_of_points / duration)
+        print('{}: IoU = {:.4f}, points/sec = {:.0f}'.format(name, results[name]['iou'],
+                                                              results[name]['points_per_second']))
+    return results
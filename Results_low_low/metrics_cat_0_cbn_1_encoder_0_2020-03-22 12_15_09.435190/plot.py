@@ -1,13 +1,23 @@
+import os
+import sys
 import matplotlib.pyplot as plt
 import matplotlib2tikz
-import torch
 import numpy as np
 
-bb_iou = torch.load('validation_bb_iou.pt').numpy()
+path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(path, '..', '..'))
+import Metrics
+
+# Metric stores (validation_bb_iou.f64) are averaged per epoch, runs before the metric store saved torch tensors
+if os.path.exists(os.path.join(path, 'validation_bb_iou.f64')):
+    bb_iou = Metrics.load_epoch_averages(path, 'validation_bb_iou')[:, 1]
+else:
+    import torch
+    bb_iou = torch.load(os.path.join(path, 'validation_bb_iou.pt')).numpy()
 
 plt.plot(bb_iou)
 plt.grid()
 plt.xlabel('Training Epochs')
 plt.ylabel('BB Iou')
-matplotlib2tikz.save('bb_iou_cat_no_cbn.tex', figureheight = '\\figH', figurewidth = '\\figW')
+matplotlib2tikz.save(os.path.join(path, 'bb_iou_cat_no_cbn.tex'), figureheight = '\\figH', figurewidth = '\\figW')
 plt.show()
\ No newline at end of file
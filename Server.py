@@ -0,0 +1,210 @@
+from typing import Any, Dict
+
+import torch
+import numpy as np
+import os
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import Inference
+
+
+def to_json(result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Function converts numpy arrays of a result into lists
+    :param result: (Dict[str, Any]) Result of the inference engine
+    :return: (Dict[str, Any]) Json serializable result
+    """
+    return {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in result.items()}
+
+
+class InferenceServer(object):
+    """
+    Class serves an inference engine over HTTP. Every connection is handled by an own thread, which loads and
+    preprocesses the scan, so preprocessing of requests overlaps with the batched model execution.
+    POST /predict with a json body {"path": "<scan.mha or volume.npy>"} or {"volume": [[[[...]]]]} and the optional
+    keys "coordinates", "threshold", "output" ('bounding_box', 'mask', 'scores' or 'instances') and "stride".
+    Preprocessed volumes can also be sent as raw float32 bytes (Content-Type application/octet-stream) with the header
+    X-Volume-Shape: 1,x,y,z, options are then given as query parameters. Paths are only loaded if they are located
+    inside of the data root.
+    GET /health and GET /statistics return the state of the server and latency statistics.
+    """
+
+    def __init__(self, engine: Inference.InferenceEngine, port: int = 8080, host: str = '127.0.0.1',
+                 side_len: int = 8, data_root: str = None) -> None:
+        """
+        Constructor method
+        :param engine: (Inference.InferenceEngine) Inference engine
+        :param port: (int) Port to serve on
+        :param host: (str) Host to bind to, use 0.0.0.0 to accept requests of other machines
+        :param side_len: (int) Downscale factor of the volumes
+        :param data_root: (str) Folder including the scans, which can be requested by path (default=None rejects
+        requests including a path)
+        """
+        self.engine = engine
+        self.side_len = side_len
+        self.data_root = os.path.realpath(data_root) if data_root is not None else None
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def send_json(self, status: int, body: Dict[str, Any]) -> None:
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self) -> None:
+                if self.path == '/health':
+                    self.send_json(200, dict(status='ok'))
+                elif self.path == '/statistics':
+                    self.send_json(200, server.engine.get_statistics())
+                else:
+                    self.send_json(404, dict(error='Unknown path {}'.format(self.path)))
+
+            def do_POST(self) -> None:
+                path, _, query = self.path.partition('?')
+                if path != '/predict':
+                    self.send_json(404, dict(error='Unknown path {}'.format(path)))
+                    return
+                try:
+                    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                    if self.headers.get('Content-Type', '') == 'application/octet-stream':
+                        shape = [int(value) for value in self.headers['X-Volume-Shape'].split(',')]
+                        request = dict(volume=torch.from_numpy(np.frombuffer(body, dtype='<f4').reshape(shape).copy()))
+                        request.update(urllib.parse.parse_qsl(query))
+                    else:
+                        request = json.loads(body)
+                    result = server.predict(request)
+                except (KeyError, ValueError, TypeError, RuntimeError, OSError) as error:
+                    self.send_json(400, dict(error=str(error)))
+                    return
+                self.send_json(200, to_json(result))
+
+            def log_message(self, *_) -> None:
+                # Requests are not printed
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def predict(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Method loads the volume of a request and waits for its result
+        :param request: (Dict[str, Any]) Request including a path or a volume and optional parameters
+        :return: (Dict[str, Any]) Result, see Inference.get_result
+        """
+        if 'path' in request:
+            volume = Inference.load_volume(self.get_path(request['path']), side_len=self.side_len)
+        else:
+            volume = torch.as_tensor(request['volume'], dtype=torch.float32)
+        coordinates = torch.tensor(request['coordinates'], dtype=torch.float32) \
+            if request.get('coordinates') is not None else None
+        stride = int(request['stride']) if request.get('stride') is not None else None
+        return self.engine(volume, coordinates, threshold=float(request.get('threshold', 0.5)),
+                           output=request.get('output', 'bounding_box'), side_len=self.side_len, stride=stride)
+
+    def get_path(self, path: str) -> str:
+        """
+        Method resolves the path of a request, paths outside of the data root are rejected
+        :param path: (str) Path of the scan, relative paths are relative to the data root
+        :return: (str) Resolved path including symbolic links
+        """
+        if self.data_root is None:
+            raise ValueError('Requests including a path are disabled, start the server with --data_root!')
+        # Symbolic links and .. are resolved before the path is checked
+        resolved_path = os.path.realpath(os.path.join(self.data_root, path))
+        if os.path.commonpath([self.data_root, resolved_path]) != self.data_root:
+            raise ValueError('Path {} is outside of the data root!'.format(path))
+        return resolved_path
+
+    def start(self) -> None:
+        """
+        Method serves requests in a background thread
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, name='server', daemon=True)
+        self.thread.start()
+
+    def serve_forever(self) -> None:
+        """
+        Method serves requests in the current thread
+        """
+        self.server.serve_forever()
+
+    def close(self) -> None:
+        """
+        Method stops the server and the inference engine
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        self.engine.close()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    # Process command line arguments
+    parser = ArgumentParser()
+
+    parser.add_argument('--model', type=str, required=True,
+                        help='Path to model or checkpoint to be served')
+
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Port to serve on (default=8080)')
+
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Host to bind to (default=127.0.0.1)')
+
+    parser.add_argument('--device', type=str, default='cuda',
+                        help='Device to use (default=cuda)')
+
+    parser.add_argument('--precision', type=str, default='float32', choices=['float32', 'bfloat16'],
+                        help='Precision of forward passes, bfloat16 utilizes autocast (default=float32)')
+
+    parser.add_argument('--max_batch_size', type=int, default=8,
+                        help='Maximal number of requests processed together (default=8)')
+
+    parser.add_argument('--max_latency_ms', type=float, default=10.0,
+                        help='Maximal time a request waits for further requests of its batch (default=10.0)')
+
+    parser.add_argument('--max_points_per_batch', type=int, default=2 ** 20,
+                        help='Maximal number of points decoded in one call (default=2^20)')
+
+    parser.add_argument('--side_len', type=int, default=8,
+                        help='Downscale factor of the volumes (default=8)')
+
+    parser.add_argument('--data_root', type=str, default=None,
+                        help='Folder including the scans, which can be requested by path (default=None rejects '
+                             'requests including a path)')
+
+    parser.add_argument('--use_cat', type=int, default=1,
+                        help='True if concatenation is utilized in O-Net, used for checkpoints (default=1 (True))')
+
+    parser.add_argument('--use_cbn', type=int, default=1,
+                        help='True if conditional batch normalization is utilized, used for checkpoints '
+                             '(default=1 (True))')
+
+    parser.add_argument('--small_encoder', type=int, default=0, choices=[0, 1],
+                        help='If true the smaller encoder is utilized, used for checkpoints (default=0 (False))')
+
+    parser.add_argument('--logits', type=int, default=0, choices=[0, 1],
+                        help='If true the model outputs logits (default=0 (False))')
+
+    args = parser.parse_args()
+
+    occupancy_network = Inference.load_occupancy_network(args.model, device=args.device, use_cat=bool(args.use_cat),
+                                                         use_cbn=bool(args.use_cbn),
+                                                         small_encoder=bool(args.small_encoder),
+                                                         logits=bool(args.logits))
+    engine = Inference.InferenceEngine(occupancy_network, device=args.device, max_batch_size=args.max_batch_size,
+                                       max_latency_ms=args.max_latency_ms,
+                                       max_points_per_batch=args.max_points_per_batch, precision=args.precision,
+                                       logits=bool(args.logits))
+    print('Serving on http://{}:{}/predict'.format(args.host, args.port))
+    InferenceServer(engine, port=args.port, host=args.host, side_len=args.side_len,
+                    data_root=args.data_root).serve_forever()
@@ -0,0 +1,249 @@
+from typing import Any, Dict, List
+
+import os
+import sys
+import json
+import time
+import queue
+import itertools
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import Metrics
+
+
+def get_configurations(grid: Dict[str, List[str]]) -> List[Dict[str, str]]:
+    """
+    Function returns all configurations of a grid
+    :param grid: (Dict[str, List[str]]) Values of every argument of main.py, e.g. dict(use_cat=['0', '1'])
+    :return: (List[Dict[str, str]]) Cartesian product of the values
+    """
+    return [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+
+
+def get_run_name(configuration: Dict[str, str]) -> str:
+    """
+    Function returns the name of a run
+    :param configuration: (Dict[str, str]) Configuration of the run
+    :return: (str) Name including all arguments and values, e.g. use_cat_1_use_cbn_0
+    """
+    return '_'.join('{}_{}'.format(key, value) for key, value in configuration.items())
+
+
+def get_core_sets(cores: List[int], threads_per_run: int) -> List[List[int]]:
+    """
+    Function splits cores into disjoint sets, one for every concurrent run
+    :param cores: (List[int]) Cores to be used
+    :param threads_per_run: (int) Number of cores of every run
+    :return: (List[List[int]]) Cores of every slot, remaining cores are not used
+    """
+    assert len(cores) >= threads_per_run, 'At least {} cores are required!'.format(threads_per_run)
+    return [cores[index:index + threads_per_run]
+            for index in range(0, len(cores) - threads_per_run + 1, threads_per_run)]
+
+
+def get_final_metrics(path: str) -> Dict[str, float]:
+    """
+    Function loads the result of every metric of a run. Training, validation and memory metrics (train_, validation_
+    and memory_ prefix) are averaged over their last epoch, test metrics are logged per scan and averaged over all
+    scans.
+    :param path: (str) Save data path of the run including the folders metrics_<folder>
+    :return: (Dict[str, float]) Result of every metric (empty if no metrics were saved)
+    """
+    metrics = dict()
+    if not os.path.isdir(path):
+        return metrics
+    for metric_folder in sorted(os.listdir(path)):
+        if not metric_folder.startswith('metrics_'):
+            continue
+        for file_name in sorted(os.listdir(os.path.join(path, metric_folder))):
+            if not file_name.endswith('.f64'):
+                continue
+            metric_name = file_name[:-len('.f64')]
+            if metric_name.startswith(('train_', 'validation_', 'memory_')):
+                epoch_averages = Metrics.load_epoch_averages(os.path.join(path, metric_folder), metric_name)
+                value = epoch_averages[-1, 1] if epoch_averages.shape[0] > 0 else np.nan
+            else:
+                values = Metrics.load_metric(os.path.join(path, metric_folder), metric_name)
+                value = np.mean(values) if values.shape[0] > 0 else np.nan
+            if np.isfinite(value):
+                metrics[metric_name] = float(value)
+    return metrics
+
+
+class SweepRunner(object):
+    """
+    Class runs main.py for every configuration of a grid. Runs are scheduled on a fixed number of slots, each slot
+    owns a disjoint set of cores. A run is pinned to the cores of its slot (including its dataloader workers) and its
+    thread pools are limited to the number of cores, so concurrent runs do not oversubscribe the machine. All runs
+    read the scans from one memory mapped scan cache (--scan_cache of main.py), so the operating system keeps one copy
+    of the data in memory. Every finished run is appended to an index (index.jsonl) including its configuration, return
+    code, duration and final metrics, runs finished successfully are skipped when the sweep is restarted.
+    """
+
+    def __init__(self, grid: Dict[str, List[str]], path: str, arguments: List[str] = None, cores: List[int] = None,
+                 threads_per_run: int = 4, scan_cache: str = None,
+                 script: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')) -> None:
+        """
+        Constructor method
+        :param grid: (Dict[str, List[str]]) Values of every argument of main.py, e.g. dict(use_cat=['0', '1'])
+        :param path: (str) Folder to save the logs, models and metrics of the runs and the index to
+        :param arguments: (List[str]) Arguments passed to every run, e.g. ['--epochs', '50'] (default=None)
+        :param cores: (List[int]) Cores to be used (default=None uses all cores available to the process)
+        :param threads_per_run: (int) Number of cores and threads of every run
+        :param scan_cache: (str) Folder of the scan cache shared by all runs (default=None runs load files)
+        :param script: (str) Script to run (default=main.py next to this file)
+        """
+        self.configurations = get_configurations(grid)
+        self.path = path
+        self.arguments = arguments if arguments is not None else []
+        cores = sorted(os.sched_getaffinity(0)) if cores is None else cores
+        self.threads_per_run = threads_per_run
+        self.core_sets = get_core_sets(cores, threads_per_run)
+        self.scan_cache = scan_cache
+        self.script = script
+        self.index_path = os.path.join(path, 'index.jsonl')
+        self.lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def get_finished_runs(self) -> List[str]:
+        """
+        Method returns the names of the runs finished successfully
+        :return: (List[str]) Names of the runs
+        """
+        if not os.path.exists(self.index_path):
+            return []
+        with open(self.index_path, 'r') as file:
+            runs = [json.loads(line) for line in file if line.strip()]
+        return [run['name'] for run in runs if run['return_code'] == 0]
+
+    def get_command(self, configuration: Dict[str, str]) -> List[str]:
+        """
+        Method returns the command of a run
+        :param configuration: (Dict[str, str]) Configuration of the run
+        :return: (List[str]) Command
+        """
+        command = [sys.executable, self.script] + self.arguments
+        for key, value in configuration.items():
+            command += ['--' + key, value]
+        if self.scan_cache is not None:
+            command += ['--scan_cache', self.scan_cache]
+        return command + ['--save_data_path', os.path.join(self.path, get_run_name(configuration), '')]
+
+    def run(self, configuration: Dict[str, str], core_sets: queue.Queue) -> Dict[str, Any]:
+        """
+        Method performs one run on the cores of a free slot and appends it to the index
+        :param configuration: (Dict[str, str]) Configuration of the run
+        :param core_sets: (queue.Queue) Cores of the free slots
+        :return: (Dict[str, Any]) Entry of the run in the index
+        """
+        name = get_run_name(configuration)
+        save_data_path = os.path.join(self.path, name, '')
+        if not os.path.exists(save_data_path):
+            os.makedirs(save_data_path)
+        cores = core_sets.get()
+        try:
+            # Thread pools of torch, OpenMP and BLAS are limited to the cores of the slot
+            environment = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), MKL_NUM_THREADS=str(len(cores)),
+                               OPENBLAS_NUM_THREADS=str(len(cores)))
+            start = time.time()
+            with open(os.path.join(save_data_path, 'log.txt'), 'w') as log:
+                # Run is pinned by taskset before python starts, the affinity is inherited by its dataloader workers
+                command = ['taskset', '-c', ','.join(str(core) for core in cores)] + self.get_command(configuration)
+                return_code = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, env=environment)
+            duration = time.time() - start
+        finally:
+            core_sets.put(cores)
+        entry = dict(name=name, configuration=configuration, return_code=return_code, duration_seconds=duration,
+                     cores=cores, path=save_data_path, metrics=get_final_metrics(save_data_path))
+        with self.lock:
+            with open(self.index_path, 'a') as file:
+                file.write(json.dumps(entry) + '\n')
+        print('{} finished with code {} after {:.1f}s'.format(name, return_code, duration))
+        return entry
+
+    def __call__(self) -> List[Dict[str, Any]]:
+        """
+        Method performs all runs not finished yet
+        :return: (List[Dict[str, Any]]) Entries of the performed runs in the index
+        """
+        finished_runs = self.get_finished_runs()
+        configurations = [configuration for configuration in self.configurations
+                          if get_run_name(configuration) not in finished_runs]
+        core_sets = queue.Queue()
+        for cores in self.core_sets:
+            core_sets.put(cores)
+        print('Sweep of {} runs ({} finished) on {} slots of {} cores'.format(
+            len(self.configurations), len(self.configurations) - len(configurations), len(self.core_sets),
+            self.threads_per_run))
+        with ThreadPoolExecutor(max_workers=len(self.core_sets)) as executor:
+            return list(executor.map(lambda configuration: self.run(configuration, core_sets), configurations))
+
+
+def parse_grid(values: List[str]) -> Dict[str, List[str]]:
+    """
+    Function parses a grid given on the command line
+    :param values: (List[str]) Arguments and values, e.g. ['use_cat=0,1', 'use_cbn=0,1']
+    :return: (Dict[str, List[str]]) Values of every argument
+    """
+    grid = dict()
+    for value in values:
+        key, _, options = value.partition('=')
+        assert len(options) > 0, 'Values of {} are missing, use {}=<value>,<value>!'.format(key, key)
+        grid[key.lstrip('-')] = options.split(',')
+    return grid
+
+
+def parse_cores(value: str) -> List[int]:
+    """
+    Function parses a list of cores
+    :param value: (str) Cores and ranges of cores, e.g. 0-7,16-23
+    :return: (List[int]) Cores
+    """
+    cores = []
+    for part in value.split(','):
+        first, _, last = part.partition('-')
+        cores += list(range(int(first), int(last or first) + 1))
+    return cores
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    # Process command line arguments, unknown arguments are passed to every run
+    parser = ArgumentParser()
+
+    parser.add_argument('--grid', type=str, nargs='+', default=['use_cat=0,1', 'use_cbn=0,1', 'small_encoder=0,1'],
+                        help='Arguments of main.py and their values (default=use_cat=0,1 use_cbn=0,1 '
+                             'small_encoder=0,1)')
+
+    parser.add_argument('--sweep_path', type=str, default='Sweep/',
+                        help='Folder to save the runs and the index to (default=Sweep/)')
+
+    parser.add_argument('--cores', type=str, default=None,
+                        help='Cores to be used, e.g. 0-15 (default=None uses all available cores)')
+
+    parser.add_argument('--threads_per_run', type=int, default=4,
+                        help='Number of cores and threads of every run (default=4)')
+
+    parser.add_argument('--scan_cache', type=str, default=None,
+                        help='Folder of the scan cache shared by all runs (default=None)')
+
+    args, arguments = parser.parse_known_args()
+
+    if args.scan_cache is not None:
+        # Cache is built once before the runs start, runs only open it
+        import Datasets
+        import Misc
+
+        Datasets.build_scan_cache(target_path_volume='/fastdata/Smiths_LKA_Weapons_Down/len_8/',
+                                  target_path_label='/visinf/home/vilab15/Projects/3D_baggage_segmentation/Data_len_1/',
+                                  file_indices=Misc.FilePermutation().permute, path=args.scan_cache)
+    runner = SweepRunner(parse_grid(args.grid), path=args.sweep_path, arguments=arguments,
+                         cores=parse_cores(args.cores) if args.cores is not None else None,
+                         threads_per_run=args.threads_per_run, scan_cache=args.scan_cache)
+    runner()
@@ -0,0 +1,168 @@
+from typing import Any, Dict, Iterable, Iterator
+
+import time
+import threading
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import Memory
+
+
+class TelemetryServer(object):
+    """
+    Class serves live training metrics in the Prometheus text format (http://<host>:<port>/metrics). The training
+    loop only updates counters under a lock, rates and the ETA are computed by the server thread when scraped.
+    """
+
+    def __init__(self, port: int = None, host: str = '127.0.0.1', prefix: str = 'occupancy_network',
+                 window: int = 100, labels: Dict[str, str] = None) -> None:
+        """
+        Constructor method
+        :param port: (int) Port to serve metrics on (default=None disables the server)
+        :param host: (str) Host to bind to, use 0.0.0.0 to allow scrapers of other machines
+        :param prefix: (str) Prefix of all metric names
+        :param window: (int) Number of last steps used to compute rates
+        :param labels: (Dict[str, str]) Labels added to every metric, e.g. the rank (default=None)
+        """
+        self.enabled = port is not None
+        self.prefix = prefix
+        self.labels = '{' + ','.join('{}="{}"'.format(key, value) for key, value in labels.items()) + '}' \
+            if labels else ''
+        self.lock = threading.Lock()
+        # Counters and gauges set by the training loop
+        self.counters = dict(steps_total=0, points_total=0, loader_wait_seconds_total=0.0)
+        self.gauges = dict()
+        # End time, number of points and loader wait of the last steps
+        self.steps = collections.deque(maxlen=window)
+        self.total_steps = None
+        self.start_time = time.time()
+        self.last_step_time = None
+        self.loader_wait = 0.0
+        self.server = None
+        if not self.enabled:
+            return
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self) -> None:
+                if self.path.split('?')[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = telemetry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_) -> None:
+                # Requests of scrapers are not printed
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='telemetry', daemon=True).start()
+
+    def iterate(self, iterable: Iterable) -> Iterator[Any]:
+        """
+        Generator measures the time waiting for every element of an iterable, e.g. a dataloader
+        :param iterable: (Iterable) Iterable
+        :return: (Iterator[Any]) Elements of the iterable
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                element = next(iterator)
+            except StopIteration:
+                return
+            self.loader_wait += time.perf_counter() - start
+            yield element
+
+    def set_total_steps(self, total_steps: int) -> None:
+        """
+        Method sets the number of steps of the whole training used to estimate the remaining time
+        :param total_steps: (int) Total number of training steps
+        """
+        self.total_steps = total_steps
+
+    def step(self, global_step: int, number_of_points: int, **gauges: float) -> None:
+        """
+        Method records a finished training step
+        :param global_step: (int) Number of performed steps
+        :param number_of_points: (int) Number of points processed in this step
+        :param gauges: (float) Further values to expose, e.g. loss or epoch
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        with self.lock:
+            self.counters['steps_total'] = global_step
+            self.counters['points_total'] += number_of_points
+            self.counters['loader_wait_seconds_total'] += self.loader_wait
+            self.steps.append((now, number_of_points, self.loader_wait))
+            self.gauges.update(gauges)
+            self.last_step_time = now
+        self.loader_wait = 0.0
+
+    def update(self, **gauges: float) -> None:
+        """
+        Method sets gauges, e.g. validation metrics
+        :param gauges: (float) Values to expose
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges.update(gauges)
+
+    def get_values(self) -> Dict[str, float]:
+        """
+        Method computes all exposed values. Rates are averaged over the window of last steps.
+        :return: (Dict[str, float]) Values by metric name (without prefix)
+        """
+        with self.lock:
+            values = dict(self.counters)
+            values.update(self.gauges)
+            steps = list(self.steps)
+            last_step_time = self.last_step_time
+        now = time.time()
+        values['uptime_seconds'] = now - self.start_time
+        if last_step_time is not None:
+            # Stalled loaders or steps show up as a growing age
+            values['seconds_since_last_step'] = now - last_step_time
+        if len(steps) > 1:
+            duration = steps[-1][0] - steps[0][0]
+            values['steps_per_second'] = (len(steps) - 1) / duration
+            values['points_per_second'] = sum(step[1] for step in steps[1:]) / duration
+            values['loader_wait_fraction'] = min(sum(step[2] for step in steps[1:]) / duration, 1.0)
+            if self.total_steps is not None:
+                values['eta_seconds'] = max(self.total_steps - values['steps_total'], 0) / values['steps_per_second']
+        values.update({'memory_' + key: value for key, value in Memory.get_process_memory_mb().items()})
+        return values
+
+    def render(self) -> str:
+        """
+        Method renders all values in the Prometheus text format
+        :return: (str) Metrics page
+        """
+        lines = []
+        for name, value in self.get_values().items():
+            if value is None:
+                continue
+            name = '{}_{}'.format(self.prefix, name)
+            lines.append('# TYPE {} {}'.format(name, 'counter' if name.endswith('_total') else 'gauge'))
+            lines.append('{}{} {}'.format(name, self.labels, float(value)))
+        return '\n'.join(lines) + '\n'
+
+    def close(self) -> None:
+        """
+        Method stops the server
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -33,15 +33,142 @@ parser.add_argument('--use_cbn', type=int, default=1,
 parser.add_argument('--loss', type=str, default='cross_entropy', choices=['cross_entropy', 'dice', 'focal'],
                     help='Loss function to be used (default=cross_entropy (cross_entropy, dice or focal))')
 
+parser.add_argument('--logits', type=int, default=0, choices=[0, 1],
+                    help='If true the model outputs logits and fused losses with logits are used (default=0 (False))')
+
 parser.add_argument('--small_encoder', type=int, default=0, choices=[0, 1],
                     help='If true a smaller encoder is utilized')
 
+parser.add_argument('--pooling_factor', type=int, default=1, choices=[1, 2, 4],
+                    help='Volumes are additionally downsampled by this factor, used to train the coarse network of '
+                         'the cascade (default=1)')
+
+parser.add_argument('--device', type=str, default='cuda',
+                    help='Device to use (default=cuda)')
+
+parser.add_argument('--precision', type=str, default='float32', choices=['float32', 'bfloat16'],
+                    help='Precision of forward passes, bfloat16 utilizes autocast (default=float32)')
+
+parser.add_argument('--draw_format', type=str, default='obj', choices=['obj', 'ply', 'npz'],
+                    help='File format of point clouds drawn while testing (default=obj)')
+
+parser.add_argument('--draw_every', type=int, default=25,
+                    help='Draw every n-th test scan, 1 draws all scans (default=25)')
+
+parser.add_argument('--threshold_sweep', type=int, default=0, choices=[0, 1],
+                    help='Evaluate 201 thresholds and PR/ROC curves in the same test pass (default=0 (False))')
+
+parser.add_argument('--test_time_augmentation', type=str, nargs='+', default=None,
+                    choices=['identity', 'flip_x', 'flip_y', 'flip_z', 'rot90_xy', 'rot90_xz', 'rot90_yz'],
+                    help='Augmentations averaged in testing and prediction, e.g. identity flip_x flip_y flip_z '
+                         '(default=None)')
+
+parser.add_argument('--instance_voxel_size', type=float, default=None,
+                    help='Voxel size to group predicted weapon points into instances in testing (default=None)')
+
 parser.add_argument('--load_model', type=str, default=None,
                     help='Path to model to be loaded (default=None)')
 
+parser.add_argument('--resume', type=str, default=None,
+                    help='Path to a checkpoint to resume training from (default=None)')
+
+parser.add_argument('--save_checkpoint_every_n_steps', type=int, default=None,
+                    help='Save a checkpoint to resume from every n training steps (default=None)')
+
+parser.add_argument('--export_path', type=str, default=None,
+                    help='Path to export TorchScript and ONNX graphs of the model to (default=None)')
+
+parser.add_argument('--quantization', type=str, default='none', choices=['none', 'dynamic', 'static'],
+                    help='Int8 quantization of the decoder evaluated against float32 on CPU (default=none)')
+
+parser.add_argument('--frozen_validation', type=int, default=0, choices=[0, 1],
+                    help='Materialize the validation set once with fixed coordinates and labels (default=0 (False))')
+
+parser.add_argument('--cache_validation_latents', type=int, default=0, choices=[0, 1],
+                    help='Cache latents of the frozen validation set until the encoder is updated, reused between '
+                         'validations of decoder only training (--latent_cache) (default=0 (False))')
+
+parser.add_argument('--asynchronous_validation', type=int, default=0, choices=[0, 1],
+                    help='Validate a snapshot of the model in a background thread while training continues '
+                         '(default=0 (False))')
+
+parser.add_argument('--latent_cache', type=str, default=None,
+                    help='Folder of a memory mapped cache of the latents of the loaded encoder, if given the encoder '
+                         'is frozen and only the decoder is trained on the cached latents (default=None)')
+
+parser.add_argument('--augmentation', type=int, default=0, choices=[0, 1],
+                    help='Randomly flip, translate, permute and intensity jitter training batches on the device '
+                         '(default=0 (False))')
+
+parser.add_argument('--max_translation', type=int, default=2,
+                    help='Maximal translation of the augmentation in voxels of the volumes (default=2)')
+
+parser.add_argument('--scan_cache', type=str, default=None,
+                    help='Folder of a memory mapped cache of all volumes and labels, built if missing and shared by '
+                         'concurrent runs (default=None)')
+
+parser.add_argument('--save_data_path', type=str, default='Save_data_',
+                    help='Folder to save models, plots and metrics to (default=Save_data_)')
+
+parser.add_argument('--profile_path', type=str, default=None,
+                    help='Folder to save a Chrome trace and summary of training step phases (default=None)')
+
+parser.add_argument('--profile_steps', type=int, default=200,
+                    help='Number of training steps to profile (default=200)')
+
+parser.add_argument('--memory_monitoring', type=int, default=1, choices=[0, 1],
+                    help='Log memory of the process, dataloader workers and allocator per phase (default=1 (True))')
+
+parser.add_argument('--telemetry_port', type=int, default=None,
+                    help='Port to serve live training metrics in the Prometheus text format on (default=None)')
+
+parser.add_argument('--predict', type=str, default=None,
+                    help='Directory or manifest of scans to predict with the loaded model instead of training and '
+                         'testing, results are written per scan and interrupted runs are resumed (default=None)')
+
+parser.add_argument('--predict_output', type=str, default='predictions',
+                    help='Folder to write predictions to (default=predictions)')
+
+parser.add_argument('--predict_output_type', type=str, default='bounding_box',
+                    choices=['bounding_box', 'mask', 'scores', 'instances'],
+                    help='Output of predictions, masks and scores are saved as npz (default=bounding_box)')
+
+parser.add_argument('--coarse_model', type=str, default=None,
+                    help='Coarse network (trained with --pooling_factor) of a cascade in prediction, scans without a '
+                         'point above the coarse threshold exit early (default=None)')
+
+parser.add_argument('--coarse_threshold', type=float, default=0.3,
+                    help='Probability threshold of the coarse network of the cascade (default=0.3)')
+
+parser.add_argument('--coarse_use_cat', type=int, default=None, choices=[0, 1],
+                    help='Concatenation of the coarse network of the cascade (default=None uses --use_cat)')
+
+parser.add_argument('--coarse_use_cbn', type=int, default=None, choices=[0, 1],
+                    help='Conditional batch normalization of the coarse network of the cascade (default=None uses '
+                         '--use_cbn)')
+
+parser.add_argument('--coarse_small_encoder', type=int, default=None, choices=[0, 1],
+                    help='Small encoder of the coarse network of the cascade (default=None uses --small_encoder)')
+
+parser.add_argument('--predict_workers', type=int, default=2,
+                    help='Number of processes loading and preprocessing scans in prediction (default=2)')
+
+parser.add_argument('--predict_batch_size', type=int, default=4,
+                    help='Maximal number of scans encoded and decoded together in prediction (default=4)')
+
+parser.add_argument('--distributed', type=int, default=0, choices=[0, 1],
+                    help='Use multi process distributed data parallel, also on CPU (default=0 (False))')
+
+parser.add_argument('--world_size', type=int, default=2,
+                    help='Number of processes spawned in distributed training (default=2)')
+
+parser.add_argument('--distributed_backend', type=str, default='gloo', choices=['gloo', 'nccl'],
+                    help='Backend of distributed training, gloo works on CPU and GPU (default=gloo)')
+
 args = parser.parse_args()
 
 import os
+import copy
 
 # Batch size has to be a factor of the number of devices used in data parallel
 os.environ['CUDA_VISIBLE_DEVICES'] = args.gpus_to_use
@@ -51,61 +178,126 @@ from torch.utils.data.dataloader import DataLoader
 
 import Models
 import Datasets
+import Augmentation
 from ModelWrapper import OccupancyNetworkWrapper
 import Misc
 import Lossfunctions
+import Export
+import Quantization
+import Checkpoint
+import Inference
 
-if __name__ == '__main__':
-    if args.load_model is None:
-        if bool(args.small_encoder):
-            channels_in_encoding_blocks = [(1, 32), (32, 32), (32, 64), (64, 64), (64, 8)]
-        else:
-            channels_in_encoding_blocks = [(1, 64), (64, 64), (64, 128), (128, 128), (128, 8)]
-        # Init model
-        if bool(args.use_cat):
-            model = Models.OccupancyNetwork(
-                normalization_decoding='cbatchnorm' if bool(args.use_cbn) else 'batchnorm',
-                channels_in_encoding_blocks=channels_in_encoding_blocks).cuda()
+
+def main(rank: int = 0, world_size: int = 1) -> None:
+    """
+    Function trains, tests and exports the occupancy network. If the world size is larger than one, the function is
+    executed by every process of distributed training.
+    :param rank: (int) Rank of the process
+    :param world_size: (int) Number of processes
+    """
+    device = args.device
+    distributed = world_size > 1
+    if distributed:
+        # Init process group, address and port are set by torchrun or default to the local machine
+        os.environ.setdefault('MASTER_ADDR', 'localhost')
+        os.environ.setdefault('MASTER_PORT', '29500')
+        torch.distributed.init_process_group(backend=args.distributed_backend, rank=rank, world_size=world_size)
+        if 'cuda' in device:
+            # One GPU per process
+            device = 'cuda:{}'.format(int(os.environ.get('LOCAL_RANK', rank)))
+            torch.cuda.set_device(device)
         else:
-            model = Models.OccupancyNetworkNoCat(
-                normalization_decoding='cbatchnorm' if bool(args.use_cbn) else 'batchnorm',
-                channels_in_encoding_blocks=channels_in_encoding_blocks).cuda()
+            # Share cores of the machine between processes
+            local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    # Every process saves an own trace
+    profile_path = args.profile_path
+    if profile_path is not None and distributed:
+        profile_path = os.path.join(profile_path, 'rank_{}'.format(rank))
+    # Batch size is split between processes
+    batch_size = args.batch_size // world_size
+    assert batch_size > 0, 'Batch size has to be at least the number of processes!'
+    # Load pickled model or checkpoint including a state dict
+    checkpoint = Checkpoint.load_checkpoint(args.load_model, map_location=device) \
+        if args.load_model is not None else None
+    if isinstance(checkpoint, torch.nn.Module):
+        model = checkpoint
     else:
-        model = torch.load(args.load_model).cuda()
-    # Utilize data parallel
-    if (args.use_data_parallel):
+        # Init model
+        model = Models.get_occupancy_network(use_cat=bool(args.use_cat), use_cbn=bool(args.use_cbn),
+                                             small_encoder=bool(args.small_encoder),
+                                             logits=bool(args.logits),
+                                             pooling_factor=args.pooling_factor).to(device)
+        if checkpoint is not None:
+            model.load_state_dict(checkpoint['model_state_dict'])
+    # Utilize (distributed) data parallel
+    if distributed:
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[device] if 'cuda' in device else None)
+    elif (args.use_data_parallel):
         model = torch.nn.DataParallel(model)
-    # Print model
-    print(model)
-    # Print number of parameters included in the model
-    print(Misc.get_number_of_network_parameters(model))
+    if rank == 0:
+        # Print model
+        print(model)
+        # Print number of parameters included in the model
+        print(Misc.get_number_of_network_parameters(model))
     # Init loss function
     if args.loss == 'cross_entropy':
-        loss_function = torch.nn.BCELoss(reduction='mean')
+        loss_function = torch.nn.BCEWithLogitsLoss(reduction='mean') if bool(args.logits) \
+            else torch.nn.BCELoss(reduction='mean')
     elif args.loss == 'focal':
-        loss_function = Lossfunctions.FocalLoss(reduce='mean')
+        loss_function = Lossfunctions.FocalLossWithLogits(reduce='mean') if bool(args.logits) \
+            else Lossfunctions.FocalLoss(reduce='mean')
     else:
-        loss_function = Lossfunctions.DiceLoss()
+        loss_function = Lossfunctions.DiceLossWithLogits() if bool(args.logits) else Lossfunctions.DiceLoss()
     # Construct folder name to save logs
     folder_name = 'cat_' + str(args.use_cat) + '_cbn_' + str(args.use_cbn) + '_encoder_' + str(args.small_encoder)
+    if args.pooling_factor > 1:
+        folder_name += '_pooling_' + str(args.pooling_factor)
+    # Build or reuse the cache of all scans, concurrent runs of a sweep share its pages
+    scan_cache = None
+    if args.scan_cache is not None:
+        if rank == 0:
+            Datasets.build_scan_cache(target_path_volume='/fastdata/Smiths_LKA_Weapons_Down/len_8/',
+                                      target_path_label='/visinf/home/vilab15/Projects/3D_baggage_segmentation/Data_len_1/',
+                                      file_indices=Misc.FilePermutation().permute, path=args.scan_cache)
+        if distributed:
+            torch.distributed.barrier()
+        scan_cache = Datasets.ScanCache(args.scan_cache)
+    # Init training dataset
+    training_dataset = Datasets.WeaponDataset(
+        target_path_volume='/fastdata/Smiths_LKA_Weapons_Down/len_8/',
+        target_path_label='/visinf/home/vilab15/Projects/3D_baggage_segmentation/Data_len_1/',
+        npoints=2 ** 14,
+        side_len=8,
+        pooling_factor=args.pooling_factor,
+        scan_cache=scan_cache,
+        length=2600,
+        profile_path=profile_path)
+    if args.latent_cache is not None:
+        # Encode all training scans once with the loaded encoder and train the decoder on the cached latents
+        assert args.load_model is not None, 'Decoder only training requires a trained encoder (--load_model)!'
+        assert not distributed, 'Decoder only training is not supported in distributed training!'
+        Datasets.build_latent_cache(model.module if hasattr(model, 'module') else model, training_dataset,
+                                    path=args.latent_cache, device=device, precision=args.precision)
+        training_dataset = Datasets.LatentDataset(training_dataset, path=args.latent_cache)
     # Init model wrapper
     model_wrapper = OccupancyNetworkWrapper(occupancy_network=model,
                                             occupancy_network_optimizer=torch.optim.Adam(
                                                 model.parameters(), lr=args.lr),
-                                            training_data=DataLoader(Datasets.WeaponDataset(
-                                                target_path_volume='/fastdata/Smiths_LKA_Weapons_Down/len_8/',
-                                                target_path_label='/visinf/home/vilab15/Projects/3D_baggage_segmentation/Data_len_1/',
-                                                npoints=2 ** 14,
-                                                side_len=8,
-                                                length=2600),
-                                                batch_size=args.batch_size, shuffle=True,
+                                            training_data=DataLoader(training_dataset,
+                                                batch_size=batch_size,
+                                                sampler=Misc.ResumableRandomSampler(range(2600),
+                                                                                    num_replicas=world_size,
+                                                                                    rank=rank),
                                                 collate_fn=Misc.many_to_one_collate_fn_sample,
-                                                num_workers=args.batch_size, pin_memory=True),
+                                                num_workers=batch_size, pin_memory=True),
                                             test_data=DataLoader(Datasets.WeaponDataset(
                                                 target_path_volume='/fastdata/Smiths_LKA_Weapons_Down/len_8/',
                                                 target_path_label='/visinf/home/vilab15/Projects/3D_baggage_segmentation/Data_len_1/',
                                                 npoints=2 ** 18,
                                                 side_len=8,
+                                                pooling_factor=args.pooling_factor,
+                                                scan_cache=scan_cache,
                                                 length=306,  # 200,
                                                 offset=2600,  # 2600,
                                                 test=True,
@@ -119,20 +311,112 @@ if __name__ == '__main__':
                                                 target_path_label='/visinf/home/vilab15/Projects/3D_baggage_segmentation/Data_len_1/',
                                                 npoints=2 ** 16,
                                                 side_len=8,
+                                                pooling_factor=args.pooling_factor,
+                                                scan_cache=scan_cache,
                                                 length=36,  # 200,
                                                 offset=2906,  # 2600,
                                                 test=True,
                                                 share_box=0.0),
-                                                batch_size=1, shuffle=True,
+                                                batch_size=1, shuffle=not distributed,
+                                                sampler=Misc.ShardSampler(range(36), num_replicas=world_size,
+                                                                          rank=rank) if distributed else None,
                                                 collate_fn=Misc.many_to_one_collate_fn_sample_down,
                                                 num_workers=1, pin_memory=True,
                                             ),
                                             loss_function=loss_function,
-                                            device='cuda',
+                                            device=device,
                                             data_folder=folder_name,
-                                            save_data_path='Save_data_')
+                                            save_data_path=args.save_data_path,
+                                            precision=args.precision,
+                                            logits=bool(args.logits),
+                                            frozen_validation=bool(args.frozen_validation),
+                                            cache_validation_latents=bool(args.cache_validation_latents),
+                                            profile_path=profile_path,
+                                            profile_steps=args.profile_steps,
+                                            memory_monitoring=bool(args.memory_monitoring),
+                                            decoder_only=args.latent_cache is not None,
+                                            augmentation=Augmentation.VolumeAugmentation(
+                                                side_len=8 * args.pooling_factor,
+                                                max_translation=args.max_translation)
+                                            if bool(args.augmentation) else None)
 
+    if args.resume is not None:
+        model_wrapper.resume(args.resume)
     if bool(args.train):
-        model_wrapper.train(epochs=args.epochs)
-    if bool(args.test):
-        model_wrapper.test(side_len=1)
+        model_wrapper.train(epochs=args.epochs, save_checkpoint_every_n_steps=args.save_checkpoint_every_n_steps,
+                            asynchronous_validation=bool(args.asynchronous_validation),
+                            telemetry_port=args.telemetry_port)
+    # Testing, export and quantization are performed by the main process only
+    if rank == 0:
+        if bool(args.test):
+            model_wrapper.test(side_len=1, draw_every=args.draw_every, draw_format=args.draw_format,
+                               threshold_sweep=bool(args.threshold_sweep),
+                               instance_voxel_size=args.instance_voxel_size,
+                               test_time_augmentation=args.test_time_augmentation)
+        if args.export_path is not None:
+            Export.export_occupancy_network(model, path=args.export_path)
+            # Compare latency of exported graphs with eager mode on one test sample
+            volume, coordinates, _, _ = next(iter(model_wrapper.test_data))
+            Export.compare_latency(model, {'torchscript': Export.ExportedOccupancyNetwork(args.export_path),
+                                           'onnx': Export.ExportedOccupancyNetwork(args.export_path,
+                                                                                   backend='onnx')},
+                                   volume=volume, coordinates=coordinates)
+        if args.quantization != 'none':
+            float_model = copy.deepcopy(model_wrapper.get_model()).cpu()
+            if args.quantization == 'dynamic':
+                quantized_model = Quantization.quantize_dynamic(float_model)
+            else:
+                quantized_model = Quantization.quantize_static(float_model,
+                                                               calibration_data=model_wrapper.validation_data)
+            # Compare iou and throughput of the quantized model with float32, logits are thresholded at logit(0.5)
+            Quantization.evaluate_quantization({'float32': float_model, args.quantization + ' int8': quantized_model},
+                                               test_data=model_wrapper.test_data,
+                                               threshold=Misc.probability_to_logit(0.5) if bool(args.logits) else 0.5)
+    if distributed:
+        torch.distributed.destroy_process_group()
+
+
+def predict() -> None:
+    """
+    Function streams the scans of a directory or manifest through the loaded model and writes the result of every scan
+    """
+    assert args.load_model is not None, 'A model or checkpoint has to be loaded for prediction!'
+    occupancy_network = Inference.load_occupancy_network(args.load_model, device=args.device,
+                                                         use_cat=bool(args.use_cat), use_cbn=bool(args.use_cbn),
+                                                         small_encoder=bool(args.small_encoder),
+                                                         logits=bool(args.logits))
+    if args.coarse_model is not None:
+        # Coarse network uses the pooling factor and an own architecture, the loaded model is the fine network
+        coarse_network = Inference.load_occupancy_network(
+            args.coarse_model, device=args.device,
+            use_cat=bool(args.use_cat if args.coarse_use_cat is None else args.coarse_use_cat),
+            use_cbn=bool(args.use_cbn if args.coarse_use_cbn is None else args.coarse_use_cbn),
+            small_encoder=bool(args.small_encoder if args.coarse_small_encoder is None else args.coarse_small_encoder),
+            logits=bool(args.logits), pooling_factor=args.pooling_factor)
+        engine = Inference.CascadeInference(coarse_network, occupancy_network, pooling_factor=args.pooling_factor,
+                                            coarse_threshold=args.coarse_threshold, device=args.device,
+                                            precision=args.precision, logits=bool(args.logits))
+    else:
+        engine = Inference.InferenceEngine(occupancy_network, device=args.device,
+                                           max_batch_size=args.predict_batch_size, precision=args.precision,
+                                           logits=bool(args.logits), augmentations=args.test_time_augmentation)
+    try:
+        Inference.predict_scans(engine, args.predict, output_path=args.predict_output,
+                                number_of_workers=args.predict_workers, output=args.predict_output_type,
+                                max_in_flight=2 * args.predict_batch_size)
+        print(engine.get_statistics())
+    finally:
+        engine.close()
+
+
+if __name__ == '__main__':
+    if args.predict is not None:
+        predict()
+    elif bool(args.distributed) and 'WORLD_SIZE' in os.environ:
+        # Processes are launched by torchrun, e.g. on multiple nodes
+        main(rank=int(os.environ['RANK']), world_size=int(os.environ['WORLD_SIZE']))
+    elif bool(args.distributed):
+        # Spawn processes on the local machine
+        torch.multiprocessing.spawn(main, args=(args.world_size,), nprocs=args.world_size)
+    else:
+        main()
@@ -0,0 +1,93 @@
+import os
+import sys
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Models
+import Misc
+import Checkpoint
+from ModelWrapper import OccupancyNetworkWrapper
+
+
+class SyntheticDataset(Dataset):
+    """
+    Dataset of random volumes including a cubic weapon, labels are given by the cube
+    """
+
+    def __init__(self, length: int, npoints: int, test: bool = False) -> None:
+        self.length = length
+        self.npoints = npoints
+        self.test = test
+        self.side_len = 8
+        self.pooling_factor = 1
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int):
+        return self.get_sample(index)
+
+    def get_sample(self, index: int, random_state: np.random.RandomState = None):
+        seed = index if random_state is None else int(random_state.randint(2 ** 31))
+        generator = torch.Generator().manual_seed(seed)
+        volume = torch.rand(1, 40, 24, 32, generator=generator)
+        coordinates = torch.randint(0, 190, (self.npoints, 3), generator=generator).float()
+        # Half of the points are sampled inside of the weapon, so every scan includes weapon points
+        coordinates[:self.npoints // 2] = 50 + torch.randint(0, 40, (self.npoints // 2, 3), generator=generator)
+        labels = ((coordinates >= 50) & (coordinates < 90)).all(dim=1, keepdim=True).float()
+        if not self.test:
+            return volume, coordinates, labels
+        weapon = torch.stack(torch.meshgrid(torch.arange(50, 90), torch.arange(50, 90), torch.arange(50, 90),
+                                            indexing='ij'), dim=-1).view(-1, 3).float()
+        return volume, coordinates, labels, weapon
+
+
+def get_model_wrapper(path: str, **kwargs) -> OccupancyNetworkWrapper:
+    torch.manual_seed(0)
+    occupancy_network = Models.OccupancyNetwork(
+        channels_in_encoding_blocks=[(1, 8), (8, 8), (8, 8), (8, 8), (8, 8)],
+        downsampling_encoding=['averagepool', 'averagepool', 'averagepool', 'none', 'none'])
+    return OccupancyNetworkWrapper(
+        occupancy_network=occupancy_network,
+        occupancy_network_optimizer=torch.optim.Adam(occupancy_network.parameters(), lr=1e-03),
+        training_data=DataLoader(SyntheticDataset(4, 256), batch_size=2,
+                                 sampler=Misc.ResumableRandomSampler(range(4)),
+                                 collate_fn=Misc.many_to_one_collate_fn_sample),
+        test_data=DataLoader(SyntheticDataset(1, 512, test=True), batch_size=1,
+                             collate_fn=Misc.many_to_one_collate_fn_sample_down),
+        validation_data=DataLoader(SyntheticDataset(2, 512, test=True), batch_size=1,
+                                   collate_fn=Misc.many_to_one_collate_fn_sample_down),
+        loss_function=torch.nn.BCELoss(), device='cpu', save_data_path=path, **kwargs)
+
+
+def test_train_one_epoch_with_validation(tmp_path) -> None:
+    model_wrapper = get_model_wrapper(str(tmp_path))
+    model_wrapper.train(epochs=1, save_model_every_n_epoch=1)
+    assert model_wrapper.global_step == 2
+    assert model_wrapper.best_loss < float('inf')
+
+
+def test_asynchronous_frozen_validation_updates_last_checkpoint(tmp_path) -> None:
+    model_wrapper = get_model_wrapper(str(tmp_path), frozen_validation=True)
+    random_state = np.random.get_state()
+    model_wrapper.train(epochs=2, save_model_every_n_epoch=1, asynchronous_validation=True)
+    # Frozen validation set is built with its own random state
+    assert model_wrapper.frozen_validation_set is not None
+    assert np.array_equal(np.random.get_state()[1], random_state[1])
+    state = Checkpoint.load_checkpoint(os.path.join(model_wrapper.path_save_models, 'checkpoint_last.pt'))
+    assert state['epoch'] == 2
+    assert state['best_loss'] == model_wrapper.best_loss < float('inf')
+    assert tuple(state['validation_metrics']) == model_wrapper.validation_metrics
+
+
+def test_resume_restores_random_sampler_seed(tmp_path) -> None:
+    model_wrapper = get_model_wrapper(str(tmp_path / 'run'))
+    model_wrapper.train(epochs=1, save_model_every_n_epoch=1)
+    resumed_model_wrapper = get_model_wrapper(str(tmp_path / 'resumed'))
+    resumed_model_wrapper.resume(os.path.join(model_wrapper.path_save_models, 'checkpoint_last.pt'))
+    assert resumed_model_wrapper.training_data.sampler.seed == model_wrapper.training_data.sampler.seed
+    assert resumed_model_wrapper.epoch == 1